@@ -8,6 +8,48 @@ SSL_HOST_CERT=${SSL_HOST_CERT:-/etc/grid-security/hostcert.pem}
 SSL_HOST_KEY=${SSL_HOST_KEY:-/etc/grid-security/hostkey.pem}
 SSL_CERT_DIR=${SSL_CERT_DIR:-/etc/grid-security/certificates}
 DEBUG=${DEBUG:-false}
+IO_THREADS=${IO_THREADS:-16}
+IO_MAX_QUEUE=${IO_MAX_QUEUE:-65536}
+CKSUM_THREADS=${CKSUM_THREADS:-4}
+READ_SENDFILE=${READ_SENDFILE:-on}
+READ_SENDFILE_MAX_CHUNK=${READ_SENDFILE_MAX_CHUNK:-2m}
+READ_AIO=${READ_AIO:-threads}
+READ_DIRECTIO=${READ_DIRECTIO:-8m}
+READ_DIRECTIO_ALIGNMENT=${READ_DIRECTIO_ALIGNMENT:-4k}
+READ_OUTPUT_BUFFERS=${READ_OUTPUT_BUFFERS:-2 2m}
+READ_RANGE_READAHEAD=${READ_RANGE_READAHEAD:-4m}
+
+# Thread pools for blocking disk I/O (see lua/diskio.lua)
+cat <<EOF > /etc/nginx/conf.d/threadpool.main
+thread_pool webdav_io threads=$IO_THREADS max_queue=$IO_MAX_QUEUE;
+thread_pool webdav_cksum threads=$CKSUM_THREADS max_queue=$IO_MAX_QUEUE;
+EOF
+
+# Read path tuning (included by locations.conf)
+# Whole-file GETs: files smaller than READ_DIRECTIO go through sendfile, larger
+# ones are read with O_DIRECT in the webdav_io thread pool so that they neither
+# block the worker nor evict the page cache
+if [ "$READ_AIO" == "threads" ]; then
+  READ_AIO="threads=webdav_io"
+fi
+cat <<EOF > /etc/nginx/conf.d/include/read.conf
+sendfile $READ_SENDFILE;
+sendfile_max_chunk $READ_SENDFILE_MAX_CHUNK;
+aio $READ_AIO;
+directio $READ_DIRECTIO;
+directio_alignment $READ_DIRECTIO_ALIGNMENT;
+output_buffers $READ_OUTPUT_BUFFERS;
+EOF
+# Range GETs: buffered reads with a large sequential readahead, since clients
+# usually walk through a file with consecutive ranges
+cat <<EOF > /etc/nginx/conf.d/include/read_range.conf
+sendfile $READ_SENDFILE;
+sendfile_max_chunk $READ_SENDFILE_MAX_CHUNK;
+aio $READ_AIO;
+directio off;
+read_ahead $READ_RANGE_READAHEAD;
+output_buffers $READ_OUTPUT_BUFFERS;
+EOF
 
 if [ "$USE_SSL" == "true" ]; then
   cat <<EOF > /etc/nginx/conf.d/site.conf
@@ -0,0 +1,149 @@
+local ngx = require("ngx")
+local ffi = require("ffi")
+local semaphore = require("ngx.semaphore")
+local config = require("config")
+local metrics = require("metrics")
+
+-- Per-worker pool of receive buffers for uploads and third-party pulls
+-- Received data is copied into a buffer, checksummed there and written to disk
+-- from it in the thread pool, which gets the buffer's address rather than a
+-- copy of the data (see Writer:write_buffer). At most io_buffer_pool_size
+-- buffers of receive_buffer_size exist per worker, allocated on first use and
+-- then reused, so the memory held for in-flight writes does not grow with the
+-- number of transfers. When all are in use, transfers wait for one.
+-- A request that ends with writes still running in the thread pool gives their
+-- buffers back only once the thread is done with them, see bufpool.log.
+
+local bufpool = {}
+
+-- How long (seconds) a transfer waits for a free buffer before failing
+local ACQUIRE_TIMEOUT = 60
+-- Longest pause (seconds) between checks for the writes of an ended request
+local WRITING_POLL_INTERVAL = 0.5
+
+---@class IOBuffer
+---@field data ffi.cdata* char[size]
+---@field size integer
+---@field address number the address of data, to pass it to the thread pool
+---@field writing ffi.cdata* int[1], non-zero while the thread pool writes from data
+---@field writing_address number the address of writing, which the thread clears
+
+local free = {}
+local available = nil
+-- Buffers whose writes outlived their request and could not be waited for
+local abandoned = {}
+
+---@type function
+---@return IOBuffer? buffer, string? err
+---Take a buffer from the pool, waiting if none is free
+---It must be given back with bufpool.release, or it is by bufpool.log
+function bufpool.acquire()
+    if not available then
+        available = semaphore.new(config.data.io_buffer_pool_size)
+    end
+    local ok, err = available:wait(0)
+    if not ok then
+        metrics.incr("webdav_io_buffer_waits_total", "")
+        ok, err = available:wait(ACQUIRE_TIMEOUT)
+        if not ok then
+            return nil, "no free I/O buffer: " .. err
+        end
+    end
+    local buffer = table.remove(free)
+    if not buffer then
+        local size = config.data.receive_buffer_size
+        local data = ffi.new("char[?]", size)
+        local writing = ffi.new("int[1]")
+        buffer = {
+            data = data,
+            size = size,
+            address = tonumber(ffi.cast("uintptr_t", data)),
+            writing = writing,
+            writing_address = tonumber(ffi.cast("uintptr_t", writing)),
+        }
+        metrics.incr("webdav_io_buffers_allocated", "", 1)
+    end
+    local held = ngx.ctx.io_buffers
+    if not held then
+        held = {}
+        ngx.ctx.io_buffers = held
+    end
+    held[buffer] = true
+    metrics.incr("webdav_io_buffers_in_use", "", 1)
+    return buffer
+end
+
+---@type function
+---@param buffer IOBuffer
+---@return nil
+---Give a buffer back to the pool once nothing reads or writes it any more
+function bufpool.release(buffer)
+    local held = ngx.ctx.io_buffers
+    if held then
+        held[buffer] = nil
+    end
+    -- e.g. the write could not be handed to the thread pool
+    buffer.writing[0] = 0
+    table.insert(free, buffer)
+    metrics.incr("webdav_io_buffers_in_use", "", -1)
+    available:post(1)
+end
+
+---@type function
+---@param premature boolean
+---@param buffers IOBuffer[]
+---Give back buffers once the thread pool has finished writing from them
+local function release_when_written(premature, buffers)
+    local interval = 0.001
+    while true do
+        local writing = false
+        for _, buffer in ipairs(buffers) do
+            if buffer.writing[0] ~= 0 then
+                writing = true
+                break
+            end
+        end
+        if not writing then
+            break
+        end
+        ngx.sleep(interval)
+        interval = math.min(interval * 2, WRITING_POLL_INTERVAL)
+    end
+    for _, buffer in ipairs(buffers) do
+        bufpool.release(buffer)
+    end
+end
+
+---@type function
+---@return nil
+---Give back the buffers of the current request, called from log_by_lua
+---Only a request that failed with writes in flight still holds any. The writes
+---were to a file that is being abandoned, but the thread pool may still be
+---reading from their buffers, so those are given back only once it is done.
+function bufpool.log()
+    local held = ngx.ctx.io_buffers
+    if not held then
+        return
+    end
+    local writing = {}
+    for buffer in pairs(held) do
+        if buffer.writing[0] ~= 0 then
+            table.insert(writing, buffer)
+        else
+            bufpool.release(buffer)
+        end
+    end
+    ngx.ctx.io_buffers = nil
+    if #writing > 0 then
+        local ok, err = ngx.timer.at(0, release_when_written, writing)
+        if not ok then
+            -- never reused, and kept alive since the thread may still read them
+            ngx.log(ngx.ERR, "failed to start the timer to release I/O buffers: ", err)
+            for _, buffer in ipairs(writing) do
+                table.insert(abandoned, buffer)
+            end
+        end
+    end
+end
+
+return bufpool
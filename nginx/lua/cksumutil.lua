@@ -1,6 +1,8 @@
 local ffi = require("ffi")
 local config = require("config")
-local zlib = require("zlib")
+local sys_stat = require("posix.sys.stat")
+local diskio = require("diskio")
+local metrics = require("metrics")
 
 -- some lua-isms added from https://github.com/user-none/lua-hashings/
 
@@ -11,33 +13,130 @@ local adler_xattr_locations = {
   "user.nginx-webdav.adler32"
 }
 
+-- The size and mtime of the file when its adler32 was stored, to tell if it is
+-- stale (see indexer.lua). Checksums stored by other tools have none.
+cksumutil.STAMP_XATTR = "user.nginx-webdav.adler32-stamp"
+
+-- Returned as the error by get_adler32 when the computation did not finish in time
+cksumutil.PENDING = "adler32 computation in progress"
+
+-- How long (seconds) a background computation may claim a path before another
+-- request is allowed to start a new one, e.g. if the worker running it died
+local JOB_TTL = 600
+-- How long (seconds) a computed result stays available to waiting requests
+local RESULT_TTL = 60
+
+---@type function
+---@param value integer
+---@return string
+---Format a numeric adler32 value as hex string
+function cksumutil.adler32_format(value)
+  return string.format("%08x", value)
+end
+local adler32_format = cksumutil.adler32_format
+
+---@type function
+---@param premature boolean
+---@param path string
+---Timer callback computing the adler32 of path in the checksum thread pool
+local function adler32_job(premature, path)
+  local jobs = ngx.shared.checksum_jobs
+  if premature then
+    jobs:delete("running:" .. path)
+    return
+  end
+  ngx.update_time()
+  local start = ngx.now()
+  local err, adler32, bytes, mtime = cksumutil.compute_adler32(path)
+  ngx.update_time()
+  metrics.incr("webdav_checksum_seconds_total", "", ngx.now() - start)
+  metrics.incr("webdav_checksum_bytes_total", "", bytes or 0)
+  metrics.incr("webdav_checksums_total", adler32 and 'result="success"' or 'result="failure"')
+  if adler32 then
+    local set_err = cksumutil.set_adler32(path, adler32, bytes, mtime)
+    if set_err then
+      ngx.log(ngx.ERR, "Failed to set adler32 for " .. path .. " err: " .. set_err)
+    end
+    jobs:set("result:" .. path, adler32, RESULT_TTL)
+  else
+    jobs:set("result:" .. path, "error:" .. err, RESULT_TTL)
+  end
+  jobs:delete("running:" .. path)
+end
+
+---@type function
+---@param path string
+---@param timeout number
+---@param cancelled (fun(): boolean)? checked while waiting, to stop early
+---@return string? err, string? val
+---Computes the adler32 of a file in the background, waiting up to timeout seconds
+---Concurrent requests for the same path (from any worker) share one computation.
+---If the computation does not finish in time, or cancelled returns true, returns
+---cksumutil.PENDING; the computation goes on and stores its result anyway.
+function cksumutil.wait_adler32(path, timeout, cancelled)
+  local jobs = ngx.shared.checksum_jobs
+  if jobs:add("running:" .. path, true, JOB_TTL) then
+    jobs:delete("result:" .. path)
+    local ok, err = ngx.timer.at(0, adler32_job, path)
+    if not ok then
+      jobs:delete("running:" .. path)
+      return "failed to start adler32 computation: " .. err, nil
+    end
+  end
+
+  local deadline = ngx.now() + timeout
+  local interval = 0.01
+  while true do
+    local result = jobs:get("result:" .. path)
+    if result then
+      if result:sub(1, 6) == "error:" then
+        return result:sub(7), nil
+      end
+      return nil, result
+    end
+    local remaining = deadline - ngx.now()
+    if remaining <= 0 or (cancelled and cancelled()) then
+      return cksumutil.PENDING, nil
+    end
+    ngx.sleep(math.min(interval, remaining))
+    interval = math.min(interval * 2, 0.5)
+  end
+end
+
 ---@type function
 ---@param path string
 ---@return string? err, string? val
 ---Gets the adler32 of a file, calculating it if it doesn't exist
+---The calculation runs in the background, see wait_adler32
 function cksumutil.get_adler32(path)
   local err, val = cksumutil.check_adler32(path)
   if err or val == nil then
     -- We checked and didn't see an adler32, so make one
-    local get_err, get_val = cksumutil.compute_adler32(path)
-    if not get_val then
-      return get_err, nil
-    end
-    local set_err = cksumutil.set_adler32(path, get_val)
-    if set_err then
-      ngx.log(ngx.ERR, "Failed to set adler32 for " .. path .. " err: " .. set_err)
-    end
-    val = get_val
+    return cksumutil.wait_adler32(path, config.data.checksum_wait_timeout)
   end
   return nil, val
 end
 
+---@type function
+---@param size integer
+---@param mtime integer
+---@return string
+---Format the size and mtime of a file as stored in STAMP_XATTR
+function cksumutil.adler32_stamp(size, mtime)
+  return string.format("%d:%d", size, mtime)
+end
+
 ---@type function
 ---@param path string
 ---@param value string
+---@param size integer? with mtime, the file's as of before value was computed
+---@param mtime integer?
 ---@return string? err
----Sets the adler32 of a file
-function cksumutil.set_adler32(path, value)
+---Sets the adler32 of a file, stamped with its size and mtime
+---Without them the current ones are taken. A value computed from the file must
+---pass those from before it was read, so that changes made meanwhile leave a
+---stale stamp instead of stamping the old value as current.
+function cksumutil.set_adler32(path, value, size, mtime)
   local total_err = nil
   for i=1,#adler_xattr_locations do
     local err = cksumutil.setxattr(path,
@@ -47,33 +146,59 @@ function cksumutil.set_adler32(path, value)
       total_err = err
     end
   end
+  if not size then
+    local stat = sys_stat.stat(path)
+    if stat then
+      size, mtime = stat.st_size, stat.st_mtime
+    end
+  end
+  if size then
+    local err = cksumutil.setxattr(path, cksumutil.STAMP_XATTR,
+      cksumutil.adler32_stamp(size, mtime))
+    if err then
+      total_err = err
+    end
+  end
   return total_err
 end
 
 
+-- adler32 from zlib through the FFI, so that it can be computed on pooled
+-- buffers (see bufpool.lua) as well as strings
+pcall(ffi.cdef, "unsigned long adler32(unsigned long adler, const char *buf, unsigned int len);")
+local zlib
+do
+  local ok, lib = pcall(ffi.load, "libz.so.1")
+  zlib = ok and lib or ffi.load("z")
+end
+
+---@class Adler32State
+---@field value integer
+
 ---@type function
----@return function state
+---@return Adler32State state
 ---Makes a blank adler32 state
 function cksumutil.adler32_initialize()
-  return zlib.adler32()
+  return { value = 1 }
 end
 
 ---@type function
----@param state function
----@param buf string
----@return function state
+---@param state Adler32State
+---@param buf string|ffi.cdata* a string, or a char pointer with len
+---@param len integer? the length of buf, required for a pointer
+---@return Adler32State state
 ---increments state with the value in buf
-function cksumutil.adler32_increment(state, buf)
-  state(buf)
+function cksumutil.adler32_increment(state, buf, len)
+  state.value = tonumber(zlib.adler32(state.value, buf, len or #buf))
   return state
 end
 
 ---@type function
----@param state function
+---@param state Adler32State
 ---@return string adler32
 ---Export adler32 state as hex string
 function cksumutil.adler32_to_string(state)
-  local digest = state()
+  local digest = state.value
   local bytes = {
     bit.band(bit.rshift(digest,24), 0xFF),
     bit.band(bit.rshift(digest,16), 0xFF),
@@ -88,31 +213,356 @@ function cksumutil.adler32_to_string(state)
 end
 
 ---@type function
----@param path string
----@return string? err, string? val
----Given a path, compute adler32 of the file
-function cksumutil.compute_adler32(path)
-  local adler_state = cksumutil.adler32_initialize()
+---@param state Adler32State
+---@return integer adler32
+---Export adler32 state as a number
+function cksumutil.adler32_value(state)
+  return state.value
+end
+
+local ADLER_BASE = 65521
+
+---@type function
+---@param adler1 integer
+---@param adler2 integer
+---@param len2 integer
+---@return integer adler32
+---Combine the adler32 of two consecutive blocks of data, given the length of the second
+---Same arithmetic as zlib's adler32_combine, so no data needs to be re-read
+function cksumutil.adler32_combine(adler1, adler2, len2)
+  local rem = len2 % ADLER_BASE
+  local sum1 = adler1 % 65536
+  local sum2 = (rem * sum1) % ADLER_BASE
+  sum1 = sum1 + (adler2 % 65536) + ADLER_BASE - 1
+  sum2 = sum2 + math.floor(adler1 / 65536) + math.floor(adler2 / 65536) + ADLER_BASE - rem
+  if sum1 >= ADLER_BASE then sum1 = sum1 - ADLER_BASE end
+  if sum1 >= ADLER_BASE then sum1 = sum1 - ADLER_BASE end
+  if sum2 >= 2 * ADLER_BASE then sum2 = sum2 - 2 * ADLER_BASE end
+  if sum2 >= ADLER_BASE then sum2 = sum2 - ADLER_BASE end
+  return sum2 * 65536 + sum1
+end
+
+-- crc32c (Castagnoli), using the hardware-accelerated google/crc32c library
+-- (installed in the image, see nginx.dockerfile) if it can be loaded, otherwise
+-- a table-driven implementation that consumes 8 bytes per step (slicing-by-8)
+ffi.cdef[[
+uint32_t crc32c_extend(uint32_t crc, const uint8_t *data, size_t count);
+]]
+local crc32c_lib = nil
+do
+  local ok, lib = pcall(ffi.load, "crc32c")
+  if ok then
+    crc32c_lib = lib
+  end
+end
+-- crc32c_tables[k*256 + b] is the crc of byte b followed by k zero bytes
+local crc32c_tables = ffi.new("uint32_t[?]", 8 * 256)
+for i=0,255 do
+  local c = i
+  for _=1,8 do
+    if bit.band(c, 1) ~= 0 then
+      c = bit.bxor(bit.rshift(c, 1), 0x82F63B78)
+    else
+      c = bit.rshift(c, 1)
+    end
+  end
+  crc32c_tables[i] = c
+end
+for k=1,7 do
+  for i=0,255 do
+    local c = crc32c_tables[(k - 1) * 256 + i]
+    crc32c_tables[k * 256 + i] = bit.bxor(bit.rshift(c, 8), crc32c_tables[bit.band(c, 0xFF)])
+  end
+end
+-- the 8-byte steps read the data as two little-endian words
+local SLICING = ffi.abi("le")
 
-  local fd, err = io.open(path, "r")
-  if not fd then
-    return "Failed to open " .. path .. ": " .. err, nil
+---@type function
+---@param crc integer
+---@param buf string|ffi.cdata* a string, or a char pointer with len
+---@param len integer? the length of buf, required for a pointer
+---@return integer crc
+---Extend a crc32c with the data in buf
+function cksumutil.crc32c_extend(crc, buf, len)
+  len = len or #buf
+  if crc32c_lib then
+    return tonumber(crc32c_lib.crc32c_extend(crc, ffi.cast("const uint8_t *", buf), len))
+  end
+  local p = ffi.cast("const uint8_t *", buf)
+  local t = crc32c_tables
+  local c = bit.bnot(crc)
+  local i = 0
+  if SLICING then
+    local words = ffi.cast("const uint32_t *", p)
+    for w=0,math.floor(len / 8) * 2 - 1,2 do
+      local lo = bit.bxor(c, words[w])
+      local hi = words[w + 1]
+      c = bit.bxor(
+        t[1792 + bit.band(lo, 0xFF)], t[1536 + bit.band(bit.rshift(lo, 8), 0xFF)],
+        t[1280 + bit.band(bit.rshift(lo, 16), 0xFF)], t[1024 + bit.rshift(lo, 24)],
+        t[768 + bit.band(hi, 0xFF)], t[512 + bit.band(bit.rshift(hi, 8), 0xFF)],
+        t[256 + bit.band(bit.rshift(hi, 16), 0xFF)], t[bit.rshift(hi, 24)])
+    end
+    i = math.floor(len / 8) * 8
+  end
+  for j=i,len-1 do
+    c = bit.bxor(bit.rshift(c, 8), t[bit.band(bit.bxor(c, p[j]), 0xFF)])
   end
+  return bit.tobit(bit.bnot(c)) % 4294967296
+end
 
-  repeat
-    local data = fd:read(config.data.checksum_block_size)
+---@type function
+---@param name string
+---@return table
+---A digest algorithm from lua-resty-string, reported base64-encoded as in RFC 3230
+local function resty_digest(name)
+  return {
+    new = function()
+      return require(name):new()
+    end,
+    update = function(state, buf, len)
+      state:update(buf, len)
+      return state
+    end,
+    final = function(state)
+      return ngx.encode_base64(state:final())
+    end,
+  }
+end
+
+-- The digest algorithms we can compute, by RFC 3230 name (lower case)
+-- Each can make a new state, update it with a buffer (a string, or a pointer
+-- and length) and export the final value as it goes in a Digest header
+cksumutil.digest_algorithms = {
+  adler32 = {
+    new = cksumutil.adler32_initialize,
+    update = cksumutil.adler32_increment,
+    final = cksumutil.adler32_to_string,
+  },
+  crc32c = {
+    new = function()
+      return { crc = 0 }
+    end,
+    update = function(state, buf, len)
+      state.crc = cksumutil.crc32c_extend(state.crc, buf, len)
+      return state
+    end,
+    final = function(state)
+      return string.format("%08x", state.crc)
+    end,
+  },
+  md5 = resty_digest("resty.md5"),
+  ["sha-256"] = resty_digest("resty.sha256"),
+}
+local digest_aliases = {
+  sha256 = "sha-256",
+}
 
-    if data then
-      adler_state = cksumutil.adler32_increment(adler_state, data)
+---@type function
+---@param name string
+---@return string? name
+---Get the canonical name of a supported digest algorithm, nil if unsupported
+function cksumutil.digest_name(name)
+  name = string.lower(name)
+  name = digest_aliases[name] or name
+  if cksumutil.digest_algorithms[name] then
+    return name
+  end
+  return nil
+end
+
+---@type function
+---@param header string?
+---@return string[] names
+---Parse an RFC 3230 Want-Digest header, e.g. "SHA-256;q=0.5, adler32"
+---Returns the supported algorithms, most preferred first (q=0 are left out)
+function cksumutil.parse_want_digest(header)
+  local wanted = {}
+  if not header then
+    return {}
+  end
+  for item in header:gmatch("[^,]+") do
+    local name, params = item:match("^%s*([^;%s]+)%s*(.*)$")
+    local q = tonumber(params and params:match("q%s*=%s*([%d%.]+)") or "1") or 0
+    name = name and cksumutil.digest_name(name)
+    if name and q > 0 then
+      table.insert(wanted, { name = name, q = q, order = #wanted })
+    end
+  end
+  table.sort(wanted, function(a, b)
+    if a.q == b.q then
+      return a.order < b.order
+    end
+    return a.q > b.q
+  end)
+  local names = {}
+  for _, want in ipairs(wanted) do
+    table.insert(names, want.name)
+  end
+  return names
+end
+
+---@type function
+---@param wanted string[]?
+---@return string[] names
+---The digests to compute during an upload: adler32, the configured ones and wanted
+function cksumutil.upload_digests(wanted)
+  local names = { "adler32" }
+  local seen = { adler32 = true }
+  for _, list in ipairs({ config.data.digests, wanted or {} }) do
+    for _, name in ipairs(list) do
+      name = cksumutil.digest_name(name)
+      if name and not seen[name] then
+        seen[name] = true
+        table.insert(names, name)
+      end
+    end
+  end
+  return names
+end
+
+---@type function
+---@param names string[]
+---@return table states
+---Makes blank states for the named digests
+function cksumutil.digests_initialize(names)
+  local states = {}
+  for _, name in ipairs(names) do
+    states[name] = cksumutil.digest_algorithms[name].new()
+  end
+  return states
+end
+
+---@type function
+---@param states table
+---@param buf string|ffi.cdata* a string, or a char pointer with len
+---@param len integer? the length of buf, required for a pointer
+---@return table states
+---increments all digest states with the value in buf
+function cksumutil.digests_increment(states, buf, len)
+  for name, state in pairs(states) do
+    states[name] = cksumutil.digest_algorithms[name].update(state, buf, len)
+  end
+  return states
+end
+
+---@type function
+---@param states table
+---@return table<string, string> values
+---Export all digest states as strings, by name
+function cksumutil.digests_to_strings(states)
+  local values = {}
+  for name, state in pairs(states) do
+    values[name] = cksumutil.digest_algorithms[name].final(state)
+  end
+  return values
+end
+
+---@type function
+---@param values table<string, string>
+---@param names string[]
+---@return string? header
+---Format the named values as an RFC 3230 Digest header, nil if there are none
+function cksumutil.format_digest_header(values, names)
+  local out = {}
+  for _, name in ipairs(names) do
+    if values[name] then
+      table.insert(out, name .. "=" .. values[name])
     end
-  until not data
+  end
+  if #out == 0 then
+    return nil
+  end
+  return table.concat(out, ",")
+end
+
+---@type function
+---@param path string
+---@param name string
+---@param value string
+---@return string? err
+---Stores the value of a digest of a file
+function cksumutil.set_digest(path, name, value)
+  if name == "adler32" then
+    return cksumutil.set_adler32(path, value)
+  end
+  return cksumutil.setxattr(path, "user.nginx-webdav." .. name, value)
+end
+
+---@type function
+---@param path string
+---@param name string
+---@return string? err, string? val
+---Gets the stored value of a digest of a file, NOT calculating if it doesn't exist
+function cksumutil.check_digest(path, name)
+  if name == "adler32" then
+    return cksumutil.check_adler32(path)
+  end
+  return cksumutil.getxattr(path, "user.nginx-webdav." .. name)
+end
 
-  local suc, exitcode = fd:close()
-  if not suc then
-    return "Failed to close " .. path .. ": " .. exitcode, nil
+---@type function
+---@param path string
+---@return string? err, string? val, integer? size, integer? mtime
+---Given a path, compute adler32 of the file in the checksum thread pool
+---The size and mtime are those from before the file was read.
+---The file is split into segments of checksum_segment_size, up to checksum_parallelism
+---of which are checksummed at once, and the results are merged with adler32_combine.
+---At most checksum_parallelism reads of checksum_block_size are in memory at a time.
+function cksumutil.compute_adler32(path)
+  local pool = config.data.checksum_thread_pool
+  local block_size = config.data.checksum_block_size
+  local stat = sys_stat.stat(path)
+  if not stat then
+    return "Failed to open " .. path .. ": No such file or directory", nil
+  end
+  local size = stat.st_size
+  local segment_size = config.data.checksum_segment_size
+  if config.data.checksum_parallelism <= 1 or size <= segment_size then
+    local value, err = diskio.run_in(pool, "adler32", path, block_size)
+    if not value then
+      return err, nil
+    end
+    return nil, adler32_format(value), size, stat.st_mtime
   end
 
-  return nil, cksumutil.adler32_to_string(adler_state)
+  -- segments are merged in order as they complete, so only
+  -- checksum_parallelism of them are outstanding at any time
+  local inflight = {}
+  local next_offset = 0
+  local adler = nil
+  local err = nil
+  while next_offset < size or #inflight > 0 do
+    while not err and next_offset < size and #inflight < config.data.checksum_parallelism do
+      local length = math.min(segment_size, size - next_offset)
+      local thread, spawn_err = ngx.thread.spawn(diskio.run_in, pool, "adler32_range",
+        path, next_offset, length, block_size)
+      if not thread then
+        err = spawn_err
+        break
+      end
+      table.insert(inflight, { thread = thread, length = length })
+      next_offset = next_offset + length
+    end
+    if #inflight == 0 then
+      break
+    end
+    local segment = table.remove(inflight, 1)
+    local ok, value, segment_err = ngx.thread.wait(segment.thread)
+    if not ok or not value then
+      err = err or (ok and segment_err or value)
+    elseif not err then
+      if adler then
+        adler = cksumutil.adler32_combine(adler, value, segment.length)
+      else
+        adler = value
+      end
+    end
+  end
+  if err then
+    return err, nil
+  end
+  return nil, adler32_format(adler), size, stat.st_mtime
 end
 
 ---@type function
@@ -120,19 +570,40 @@ end
 ---@return string? err, string? val
 ---Gets the adler32 of a file from xattrs, NOT calculating if it doesn't exist
 function cksumutil.check_adler32(path)
-  -- xattrs to check for existing checksums
-  local adler32 = nil
+  -- xattrs to check for existing checksums, in order
   for i=1,#adler_xattr_locations do
     local err, val = cksumutil.getxattr(path, adler_xattr_locations[i])
-    if not err then
-      return nil, val
-    elseif err then
+    if err then
       return err, nil
+    elseif val then
+      return nil, val
     end
   end
   return nil, nil
 end
 
+---@type function
+---@return string[][] xattrs
+---The xattrs holding stored digests, as {digest name, xattr name} pairs in the
+---order check_digest looks at them, for diskio_thread.stat_entry/list_directory
+function cksumutil.digest_xattrs()
+  local xattrs = {}
+  for i=1,#adler_xattr_locations do
+    table.insert(xattrs, { "adler32", adler_xattr_locations[i] })
+  end
+  local names = {}
+  for name in pairs(cksumutil.digest_algorithms) do
+    if name ~= "adler32" then
+      table.insert(names, name)
+    end
+  end
+  table.sort(names)
+  for _, name in ipairs(names) do
+    table.insert(xattrs, { name, "user.nginx-webdav." .. name })
+  end
+  return xattrs
+end
+
 -- The parts that actually call the C-level get/setxattr
 -- FIXME migrate to ngx.run_worker_thread since this will block
 
@@ -153,7 +624,7 @@ int getxattr(const char *path, const char *name, char *value, size_t size);
 ---Sets an extended attribute on a file
 function cksumutil.setxattr(path, key, value)
   local ret = ffi.C.setxattr(path, key, value, string.len(value), 0)
-  if ret > 0 then
+  if ret < 0 then
     ret = ffi.errno()
     return "Error " .. ret .. " in setxattr"
   else
@@ -161,21 +632,24 @@ function cksumutil.setxattr(path, key, value)
   end
 end
 
+-- getxattr reads into this buffer, which is safe to share since the call
+-- does not yield
+local XATTR_BUFLEN = 1024
+local xattr_buffer = ffi.new("char[?]", XATTR_BUFLEN)
+
 ---@type function
 ---@param path string
 ---@param key string
 ---@return string? err, string? value
 ---Gets an extended attribute from a file
 function cksumutil.getxattr(path, key)
-  local buflen = 1024
-  local value = ffi.new("char[?]", buflen)
-  local ret = ffi.C.getxattr(path, key, value, buflen)
+  local ret = ffi.C.getxattr(path, key, xattr_buffer, XATTR_BUFLEN)
   -- FIXME: get the C errstr
   if ret < 0 then
     ret = ffi.errno()
-    -- the value doesn' exist
-    local ENODATA = 63
-    if ffi.errno() == ENODATA then
+    -- the value doesn' exist (ENODATA, also known as ENOATTR)
+    local ENODATA = 61
+    if ret == ENODATA then
       -- It's not really an error if the attribute isn't there. I think nil
       -- is disctinct from "" in Lua
       return nil, nil
@@ -183,7 +657,7 @@ function cksumutil.getxattr(path, key)
       return "Error " .. ret .. " in getxattr", nil
     end
   else
-    return nil, ffi.string(value, buflen)
+    return nil, ffi.string(xattr_buffer, ret)
   end
 end
 
@@ -10,12 +10,142 @@ local Config = {
         receive_buffer_size = 1024*1024,
         -- How often to send a performance marker (in seconds)
         performance_marker_timeout = 5,
+        -- Write uploads (PUT and TPC pull) to a hidden temporary file in the target
+        -- directory and rename it into place once complete, so that readers never
+        -- see a partial file and a failed upload leaves the previous file untouched
+        atomic_uploads = true,
+        -- Temporary files of uploads not written to for this long (seconds) are
+        -- removed, e.g. those left behind by a worker that died, and the .partial
+        -- files of uploads in ranges whose progress expired (see sweeper.lua)
+        stale_upload_age = 6*3600,
+        -- How often (seconds) local_path is searched for them, first at a random
+        -- time within one interval after startup (0 = never)
+        stale_upload_sweep_interval = 24*3600,
+        -- Reserve the disk space of uploads of known size (Content-Length, or the
+        -- TPC source's length) before writing, so concurrent uploads do not fragment
+        preallocate_uploads = true,
+        -- How long (seconds) the progress of a PUT with Content-Range is kept
+        -- after its last range, for the client to resume it
+        partial_upload_ttl = 24*3600,
+        -- How long (seconds) a range being received blocks overlapping ranges
+        -- in case its request dies without cleaning up (see client_body_timeout)
+        partial_range_timeout = 300,
 
         -- This is used in webdav_tpc_content
         tpc_redirect_limit = 5,
+        -- Number of parallel connections (stripes) a pull may use, 1 disables striping
+        -- Striping needs the source to support HTTP Range requests
+        tpc_stripes = 1,
+        -- Minimum size of one stripe, smaller sources use fewer stripes
+        tpc_stripe_min_size = 128*1024*1024,
+        -- Idle connections kept per remote (scheme, host, port), per worker
+        tpc_pool_size = 16,
+        -- How long (seconds) an idle remote connection is kept
+        tpc_pool_idle_timeout = 60,
+        -- Size of the disk reads sent to the remote in a push
+        tpc_push_block_size = 4*1024*1024,
+        -- Most transfers running at once, over all workers; others are queued
+        tpc_max_active = 64,
+        -- Most transfers running at once with the same remote host
+        tpc_max_active_per_host = 16,
+        -- Most transfers waiting for a slot, more are refused with 503
+        tpc_queue_size = 1000,
+        -- Longest time (seconds) a transfer waits for a slot before failing
+        tpc_queue_timeout = 600,
+        -- How often (seconds) a queued transfer checks whether a slot was freed
+        tpc_queue_poll_interval = 0.1,
+        -- Queue priority by SciTag header value, higher goes first (default 0)
+        -- e.g. { ["65"] = 10 }
+        tpc_scitag_priority = {},
+
+        -- This is used in webdav_propfind_content
+        -- Most directory entries sent in one PROPFIND response, the client is
+        -- given a continuation token for the rest
+        propfind_max_entries = 100000,
+        -- How many directory entries are read (in the I/O thread pool) and sent at once
+        propfind_batch_size = 1000,
+
+        -- This is used in diskio
+        -- Name of the nginx thread_pool that blocking disk I/O is handed to
+        -- (its size is set by IO_THREADS/IO_MAX_QUEUE in docker-entrypoint.sh)
+        -- Set to "" to do disk I/O inline in the request handler
+        io_thread_pool = "webdav_io",
+        -- How many writes per transfer may be in flight in the thread pool
+        -- while the next chunk is received (0 = write synchronously)
+        io_write_queue_depth = 4,
+        -- How many blocks a sequential reader (e.g. TPC push) reads ahead
+        io_read_ahead = 2,
+        -- How many receive buffers (of receive_buffer_size) each worker keeps for
+        -- uploads and third-party pulls (see bufpool.lua). Transfers wait for a
+        -- free one when all are in use.
+        io_buffer_pool_size = 128,
+        -- How much of a file a local COPY copies per thread pool job
+        io_copy_chunk_size = 64*1024*1024,
+        -- What is done to get uploads (PUT and TPC pull) onto the disk:
+        -- "none" leaves it to the kernel, which may hold many dirty pages and
+        -- then flush them all at once; "fsync" flushes each file (and its
+        -- directory) before the upload succeeds; "writeback" starts writing
+        -- back every upload_writeback_interval bytes and waits for the
+        -- interval before, so uploads go no faster than the disk (see diskio.lua)
+        upload_durability = "none",
+        upload_writeback_interval = 64*1024*1024,
+        -- Evict the uploaded data from the page cache once it is on disk, so
+        -- that uploads do not push out data being read (with "fsync" and "writeback")
+        upload_drop_cache = false,
 
         -- This is used in cksumutil
-        checksum_block_size = 64*1024*1024,
+        -- Size of the reads when computing a missing checksum
+        checksum_block_size = 4*1024*1024,
+        -- Files larger than this are split into segments of this size that are
+        -- checksummed in parallel and combined
+        checksum_segment_size = 256*1024*1024,
+        -- How many segments of one file are checksummed at once (see CKSUM_THREADS
+        -- in docker-entrypoint.sh for the number of threads shared by all files)
+        checksum_parallelism = 4,
+        -- Digests computed and stored for every upload, in addition to adler32
+        -- and those asked for in Want-Digest (crc32c, md5, sha-256)
+        digests = {},
+        -- Thread pool for background checksum computation (see docker-entrypoint.sh)
+        checksum_thread_pool = "webdav_cksum",
+        -- How long (seconds) a request waits for a missing checksum to be computed
+        checksum_wait_timeout = 10,
+        -- What HEAD does with Want-Digest if the checksum is still being computed
+        -- after checksum_wait_timeout: "accepted" replies 202, "omit" replies 200
+        -- without a Digest header
+        checksum_pending_policy = "accepted",
+
+        -- This is used in indexer
+        -- Crawl local_path in the background to store the adler32 of files that
+        -- have none or a stale one, e.g. placed there by other tools
+        checksum_indexer = false,
+        -- Average bytes per second the indexer may read (0 = no limit)
+        checksum_indexer_bandwidth = 100*1024*1024,
+        -- Seconds from the end of one crawl to the start of the next
+        checksum_indexer_interval = 24*3600,
+        -- Where the indexer keeps its progress across restarts
+        checksum_indexer_state = "/var/lib/nginx-webdav/checksum-indexer.json",
+
+        -- This is used in jwtauth
+        -- Number of verified tokens each worker keeps in memory
+        jwt_cache_worker_size = 1000,
+        -- Longest time (seconds) a verified token is trusted without re-verifying
+        jwt_cache_max_ttl = 3600,
+
+        -- This is used in dircache
+        -- Number of directories known to exist that each worker keeps in memory
+        dir_cache_worker_size = 10000,
+
+        -- This is used in timing
+        -- Time the phases of each request and send them in a Server-Timing header
+        request_timing = false,
+        -- Log every request as a JSON object, with its timings, instead of the
+        -- plain access log
+        json_access_log = false,
+
+        -- This is used in metrics
+        -- How often (seconds) each worker publishes its metric updates and
+        -- counters (see stats.lua)
+        metrics_sync_interval = 1,
 
         -- discovery = "https://cms-auth.web.cern.ch/.well-known/openid-configuration",
         -- this is the public key from the above provider
@@ -36,8 +166,18 @@ LwIDAQAB
     }
 }
 
+-- The values allowed for the settings that choose between a few behaviours
+local choices = {
+    upload_durability = { none = true, fsync = true, writeback = true },
+    checksum_pending_policy = { accepted = true, omit = true },
+}
+
+ ---@type function
+ ---@param path string
+ ---@return string? err
  function Config.load(path)
     -- Update the Config object with the values from the file at the given path
+    -- Returns an error if a value is not allowed, see choices
     local cjson = require("cjson")
 
     local f = io.open(path, "r")
@@ -52,6 +192,12 @@ LwIDAQAB
             Config.data[k] = newvalues[k]
         end
     end
+    for k, allowed in pairs(choices) do
+        if not allowed[Config.data[k]] then
+            return string.format("%s: invalid %s: %s", path, k, tostring(Config.data[k]))
+        end
+    end
+    return nil
  end
 
  return Config
\ No newline at end of file
@@ -0,0 +1,85 @@
+local ngx = require("ngx")
+local lrucache = require("resty.lrucache")
+local config = require("config")
+local stats = require("stats")
+
+-- Cache of directories known to exist, so that uploads into an existing tree
+-- skip the stat and mkdir of its parents (see fileutil.mkdir)
+-- Directories are remembered in a per-worker LRU cache and in the
+-- known_directories shared dict, which evicts the least recently used when full.
+-- Entries are tagged with a generation number. Removing or renaming a directory,
+-- or finding one missing, bumps the generation, which forgets all of them in
+-- every worker at once. This is rare compared with uploads.
+
+local dircache = {}
+
+-- Built once per worker by dircache.init
+local worker_cache = nil
+
+---@type function
+---@return nil
+---Set up the worker cache, called from init_worker
+function dircache.init()
+    local err = nil
+    worker_cache, err = lrucache.new(config.data.dir_cache_worker_size)
+    if not worker_cache then
+        ngx.log(ngx.ERR, "failed to create the directory cache: ", err)
+    end
+end
+
+---@type function
+---@return integer
+---The current generation, read on every lookup so that it is never the least
+---recently used key to be evicted
+local function generation()
+    return ngx.shared.known_directories:get("generation") or 0
+end
+
+---@type function
+---@param path string
+---@return boolean
+---Whether the directory at path is known to exist
+function dircache.known(path)
+    local current = generation()
+    if worker_cache and worker_cache:get(path) == current then
+        stats.incr("dir_cache_hits")
+        return true
+    end
+    if ngx.shared.known_directories:get("dir:" .. path) == current then
+        if worker_cache then
+            worker_cache:set(path, current)
+        end
+        stats.incr("dir_cache_hits")
+        return true
+    end
+    stats.incr("dir_cache_misses")
+    return false
+end
+
+---@type function
+---@param path string
+---@return nil
+---Remember that the directory at path exists
+function dircache.add(path)
+    local current = generation()
+    if worker_cache then
+        worker_cache:set(path, current)
+    end
+    -- set (unlike safe_set) evicts least recently used entries when full
+    local ok, err = ngx.shared.known_directories:set("dir:" .. path, current)
+    if not ok then
+        ngx.log(ngx.ERR, "failed to cache directory ", path, ": ", err)
+    end
+end
+
+---@type function
+---@return nil
+---Forget all known directories, when one is removed or renamed or found missing
+function dircache.invalidate()
+    local _, err = ngx.shared.known_directories:incr("generation", 1, 0)
+    if err then
+        ngx.log(ngx.ERR, "failed to invalidate the directory cache: ", err)
+    end
+end
+
+return dircache
@@ -0,0 +1,453 @@
+local config = require("config")
+local bufpool = require("bufpool")
+local timing = require("timing")
+local diskio_thread = require("diskio_thread")
+
+-- Hands blocking disk I/O to the nginx thread pool so that a slow disk
+-- does not stall every other connection served by the same worker.
+
+local diskio = {}
+
+local O_RDONLY = 0
+local O_WRONLY = 1
+local O_CREAT = 64
+local O_EXCL = 128
+local O_TRUNC = 512
+local O_CLOEXEC = 524288
+-- like fopen, so that the process umask decides the permissions of new files
+local FILEMODE = tonumber('666', 8)
+-- Buffer size of a copy between filesystems that copy_file_range cannot handle
+local COPY_BUFFER_SIZE = 4*1024*1024
+
+---@type function
+---@param ok boolean
+---@return any
+local function thread_result(ok, ...)
+    if not ok then
+        return nil, "worker thread failed: " .. tostring(...)
+    end
+    return ...
+end
+
+---@type function
+---@param pool string?
+---@param func string
+---@return any
+---Run the named function from diskio_thread in the given thread pool
+---If no pool is given, the function is run inline (blocking)
+function diskio.run_in(pool, func, ...)
+    if pool and pool ~= "" then
+        return thread_result(ngx.run_worker_thread(pool, "diskio_thread", func, ...))
+    end
+    return diskio_thread[func](...)
+end
+
+---@type function
+---@param func string
+---@return any
+---Run the named function from diskio_thread in the disk I/O thread pool
+function diskio.run(func, ...)
+    return diskio.run_in(config.data.io_thread_pool, func, ...)
+end
+
+---@class Writer
+---@field fd integer?
+---@field path string
+---@field offset integer
+---@field inflight table
+---@field err string?
+---@field parent Writer?
+---@field final_path string? where fileutil.commit_file moves the file once complete
+---@field writeback_start integer? where the data not yet written back starts (see Writer:writeback)
+---@field writeback_previous integer[]? offset and length of the range last written back
+local Writer = {}
+Writer.__index = Writer
+
+---@type function
+---@param path string
+---@param mode "truncate"|"exclusive"|"update"|nil
+---@return Writer? writer, string? err
+---Open a file for asynchronous writing, creating it if needed
+---mode "truncate" (the default) empties an existing file, "exclusive" fails if the
+---file exists and "update" keeps its content, to write parts of it with pwrite
+function diskio.open_writer(path, mode)
+    local flags = O_WRONLY + O_CREAT + O_CLOEXEC
+    if mode == "exclusive" then
+        flags = flags + O_EXCL
+    elseif mode ~= "update" then
+        flags = flags + O_TRUNC
+    end
+    local fd, err = diskio.run("open", path, flags, FILEMODE)
+    if not fd then
+        return nil, err
+    end
+    return setmetatable({
+        fd = fd,
+        path = path,
+        offset = 0,
+        inflight = {},
+        err = nil,
+    }, Writer)
+end
+
+---@type function
+---@param offset integer
+---@return Writer
+---Make a writer to the same file starting at offset, with its own queue of in-flight writes
+---Each light thread writing to the file needs its own fork, since a light thread
+---can only wait for writes it queued itself. Closing a fork only flushes it.
+function Writer:fork(offset)
+    return setmetatable({
+        fd = self.fd,
+        path = self.path,
+        offset = offset,
+        inflight = {},
+        err = nil,
+        parent = self,
+    }, Writer)
+end
+
+---@type function
+---@param size integer
+---@return boolean? success, string? err
+---Reserve disk space for size bytes, so that the file is laid out contiguously
+function Writer:allocate(size)
+    return diskio.run("fallocate", self.fd, size)
+end
+
+---@type function
+---@param size integer
+---@return boolean? success, string? err
+---Set the file size, dropping anything beyond it
+function Writer:truncate(size)
+    return diskio.run("ftruncate", self.fd, size)
+end
+
+---@type function
+---@param src_path string
+---@param size integer
+---@param allocate boolean reserve the disk space if the data has to be copied
+---@return boolean? success, string? err
+---Fill the file, which must be empty, with the size bytes of the file at src_path
+---A reflink is tried first, which shares the data blocks and is instant on
+---filesystems supporting it (e.g. btrfs, XFS). Otherwise the data is copied with
+---copy_file_range, io_copy_chunk_size per thread pool job so that other I/O
+---can go in between.
+function Writer:copy_from(src_path, size, allocate)
+    local src_fd, err = diskio.run("open", src_path, O_RDONLY + O_CLOEXEC, 0)
+    if not src_fd then
+        return nil, err
+    end
+    local suc, clone_err, unsupported = diskio.run("clone", src_fd, self.fd)
+    if not suc and unsupported then
+        if allocate and size > 0 then
+            suc, err = self:allocate(size)
+        else
+            suc = true
+        end
+        local offset = 0
+        while suc and offset < size do
+            local length = math.min(config.data.io_copy_chunk_size, size - offset)
+            local copied
+            copied, err = diskio.run("copy_range", src_fd, self.fd, offset, length, COPY_BUFFER_SIZE)
+            if not copied then
+                suc = nil
+            elseif copied < length then
+                suc, err = nil, src_path .. ": file shrank while copying it"
+            else
+                offset = offset + copied
+            end
+        end
+    elseif not suc then
+        err = clone_err
+    end
+    diskio.run("close", src_fd)
+    if not suc then
+        return nil, err
+    end
+    self.offset = size
+    return true
+end
+
+---@type function
+---Wait for the oldest in-flight write to finish, recording its error if any
+function Writer:wait_one()
+    local thread = table.remove(self.inflight, 1)
+    local start = timing.start()
+    local ok, written, err = ngx.thread.wait(thread)
+    timing.stop("disk", start)
+    if not ok then
+        err = written
+    end
+    if not written and not self.err then
+        self.err = err
+    end
+end
+
+---@type function
+---@param write function runs the write, returning the bytes written or nil and an error
+---@return boolean? success, string? err
+---Queue a write, or run it if writes are synchronous
+---At most config.data.io_write_queue_depth writes are in flight at once, beyond
+---that this call waits for the oldest one. Errors from earlier writes are
+---reported by the next call.
+function Writer:queue(write, ...)
+    local depth = config.data.io_write_queue_depth
+    if depth < 1 then
+        local start = timing.start()
+        local written, err = write(...)
+        timing.stop("disk", start)
+        if not written then
+            return nil, err
+        end
+        return true
+    end
+    while #self.inflight >= depth do
+        self:wait_one()
+    end
+    if self.err then
+        return nil, self.err
+    end
+    local thread, err = ngx.thread.spawn(write, ...)
+    if not thread then
+        return nil, err
+    end
+    table.insert(self.inflight, thread)
+    return true
+end
+
+---@type function
+---@param data string
+---@param offset integer
+---@return boolean? success, string? err
+---Queue data to be written at offset
+function Writer:pwrite(data, offset)
+    return self:queue(diskio.run, "pwrite", self.fd, data, offset)
+end
+
+---@type function
+---@param fd integer
+---@param buffer IOBuffer
+---@param length integer
+---@param offset integer
+---@return integer? written, string? err
+local function pwrite_buffer(fd, buffer, length, offset)
+    -- cleared by the thread once done, see bufpool.log
+    buffer.writing[0] = 1
+    local written, err = diskio.run("pwrite_address", fd, buffer.address, length, offset,
+        buffer.writing_address)
+    bufpool.release(buffer)
+    return written, err
+end
+
+---@type function
+---@param data string
+---@return boolean? success, string? err
+---Queue data to be written after the previously written data
+function Writer:write(data)
+    local offset = self.offset
+    self.offset = offset + #data
+    self.writeback_start = self.writeback_start or offset
+    local suc, err = self:pwrite(data, offset)
+    if not suc then
+        return nil, err
+    end
+    return self:writeback(false)
+end
+
+---@type function
+---@param buffer IOBuffer from bufpool.acquire
+---@param length integer
+---@return boolean? success, string? err
+---Queue the first length bytes of buffer to be written after the previously
+---written data. The buffer is released to the pool once written, even on failure.
+function Writer:write_buffer(buffer, length)
+    local offset = self.offset
+    self.offset = offset + length
+    self.writeback_start = self.writeback_start or offset
+    local started = false
+    local suc, err = self:queue(function(...)
+        started = true
+        return pwrite_buffer(...)
+    end, self.fd, buffer, length, offset)
+    if not started then
+        -- e.g. an earlier write failed
+        bufpool.release(buffer)
+    end
+    if not suc then
+        return nil, err
+    end
+    return self:writeback(false)
+end
+
+---@type function
+---@param final boolean whether the writer is being closed
+---@return boolean? success, string? err
+---Write back the data written so far if upload_durability is "writeback"
+---Every upload_writeback_interval bytes, the range written since the last time is
+---queued for writeback (see diskio_thread.writeback), which also waits for the
+---range before it to reach the disk. The writer thus cannot get far ahead of the
+---disk with gigabytes of dirty pages, which the kernel would otherwise flush all
+---at once, stalling every writer on the filesystem. When closing, the rest is
+---only queued for writeback, unless upload_drop_cache needs it to be clean.
+function Writer:writeback(final)
+    if config.data.upload_durability ~= "writeback" or not self.writeback_start then
+        return true
+    end
+    local length = self.offset - self.writeback_start
+    if length < config.data.upload_writeback_interval and not final then
+        return true
+    end
+    -- the range is written back once its writes are done
+    local suc, err = self:flush()
+    if not suc then
+        return nil, err
+    end
+    local start = self.writeback_start
+    local previous = self.writeback_previous or { start, 0 }
+    local drop_cache = config.data.upload_drop_cache
+    if final then
+        if not drop_cache then
+            return diskio.run("writeback", self.fd, start, length, 0, 0, false)
+        end
+        suc, err = diskio.run("writeback", self.fd, start, length, previous[1], previous[2], true)
+        if not suc then
+            return nil, err
+        end
+        return diskio.run("writeback", self.fd, 0, 0, start, length, true)
+    end
+    self.writeback_previous = { start, length }
+    self.writeback_start = self.offset
+    return self:queue(diskio.run, "writeback", self.fd, start, length, previous[1], previous[2], drop_cache)
+end
+
+---@type function
+---@return boolean? success, string? err
+---Wait for all in-flight writes to finish
+function Writer:flush()
+    while #self.inflight > 0 do
+        self:wait_one()
+    end
+    if self.err then
+        return nil, self.err
+    end
+    return true
+end
+
+---@type function
+---@return boolean? success, string? err
+---Wait for all in-flight writes and close the file
+---With upload_durability "fsync", the file is flushed to disk before it is closed.
+---This must be called on every path, including errors, or the fd leaks
+---Forks must be closed before their parent
+function Writer:close()
+    if not self.fd then
+        return nil, "file already closed"
+    end
+    local suc, err = self:flush()
+    if suc then
+        suc, err = self:writeback(true)
+    end
+    if self.parent then
+        self.fd = nil
+        return suc, err
+    end
+    if suc and config.data.upload_durability == "fsync" then
+        suc, err = diskio.run("fsync", self.fd, config.data.upload_drop_cache)
+    end
+    local close_suc, close_err = diskio.run("close", self.fd)
+    self.fd = nil
+    if not suc then
+        return nil, err
+    end
+    if not close_suc then
+        return nil, close_err
+    end
+    return true
+end
+
+---@class Reader
+---@field fd integer?
+---@field path string
+---@field size integer
+---@field block_size integer
+---@field offset integer
+---@field next_offset integer
+---@field inflight table
+local Reader = {}
+Reader.__index = Reader
+
+---@type function
+---@param path string
+---@param size integer
+---@param block_size integer
+---@return Reader? reader, string? err
+---Open a file of known size for sequential reading in blocks of block_size
+---Up to config.data.io_read_ahead blocks are read in the thread pool ahead of
+---the caller, so that disk reads overlap with sending the previous block.
+function diskio.open_reader(path, size, block_size)
+    local fd, err = diskio.run("open", path, O_RDONLY + O_CLOEXEC, 0)
+    if not fd then
+        return nil, err
+    end
+    return setmetatable({
+        fd = fd,
+        path = path,
+        size = size,
+        block_size = block_size,
+        offset = 0,
+        next_offset = 0,
+        inflight = {},
+    }, Reader)
+end
+
+---@type function
+---@return string? data, string? err
+---Read the next block, returns nil at the end of the file
+function Reader:read()
+    if not self.fd then
+        return nil, "file already closed"
+    end
+    local depth = math.max(config.data.io_read_ahead, 1)
+    while #self.inflight < depth and self.next_offset < self.size do
+        local thread, err = ngx.thread.spawn(diskio.run, "pread", self.fd, self.block_size, self.next_offset)
+        if not thread then
+            return nil, err
+        end
+        table.insert(self.inflight, thread)
+        self.next_offset = self.next_offset + self.block_size
+    end
+    if #self.inflight == 0 then
+        return nil
+    end
+
+    local ok, data, err = ngx.thread.wait(table.remove(self.inflight, 1))
+    if not ok then
+        return nil, data
+    elseif not data then
+        return nil, err
+    end
+    local expected = math.min(self.block_size, self.size - self.offset)
+    if #data ~= expected then
+        return nil, "short read from " .. self.path .. " at offset " .. self.offset
+    end
+    self.offset = self.offset + #data
+    return data
+end
+
+---@type function
+---@return boolean? success, string? err
+---Wait for read-ahead blocks and close the file
+function Reader:close()
+    if not self.fd then
+        return true
+    end
+    while #self.inflight > 0 do
+        ngx.thread.wait(table.remove(self.inflight, 1))
+    end
+    local suc, err = diskio.run("close", self.fd)
+    self.fd = nil
+    return suc, err
+end
+
+return diskio
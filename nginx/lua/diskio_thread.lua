@@ -0,0 +1,489 @@
+local ffi = require("ffi")
+local sys_stat = require("posix.sys.stat")
+
+-- Blocking disk I/O primitives.
+-- These functions are run inside the nginx thread pool by diskio.run (through
+-- ngx.run_worker_thread), so they must not use any ngx.* API and may only take
+-- and return plain Lua values (nil, booleans, numbers, strings, tables).
+-- They are also called inline by diskio.run when no thread pool is configured.
+
+local diskio_thread = {}
+
+-- FIXME: Not platform-independent (assumes 64-bit off_t, i.e. Linux x86_64/aarch64)
+ffi.cdef[[
+int open(const char *pathname, int flags, int mode);
+int close(int fd);
+ssize_t read(int fd, void *buf, size_t count);
+ssize_t pread(int fd, void *buf, size_t count, int64_t offset);
+ssize_t pwrite(int fd, const void *buf, size_t count, int64_t offset);
+int fallocate(int fd, int mode, int64_t offset, int64_t len);
+int ftruncate(int fd, int64_t length);
+int fsync(int fd);
+int sync_file_range(int fd, int64_t offset, int64_t nbytes, unsigned int flags);
+int posix_fadvise(int fd, int64_t offset, int64_t len, int advice);
+int ioctl(int fd, unsigned long request, ...);
+ssize_t copy_file_range(int fd_in, int64_t *off_in, int fd_out, int64_t *off_out, size_t len, unsigned int flags);
+int rename(const char *oldpath, const char *newpath);
+int unlink(const char *pathname);
+char *strerror(int errnum);
+unsigned long adler32(unsigned long adler, const char *buf, unsigned int len);
+typedef struct __dirstream DIR;
+struct dirent {
+    uint64_t d_ino;
+    int64_t d_off;
+    unsigned short d_reclen;
+    unsigned char d_type;
+    char d_name[256];
+};
+DIR *opendir(const char *name);
+struct dirent *readdir(DIR *dirp);
+int closedir(DIR *dirp);
+long telldir(DIR *dirp);
+void seekdir(DIR *dirp, long loc);
+long long strtoll(const char *nptr, char **endptr, int base);
+]]
+-- also declared by cksumutil when this runs inline in the request's VM
+pcall(ffi.cdef, "int getxattr(const char *path, const char *name, char *value, size_t size);")
+
+local C = ffi.C
+local EINTR = 4
+local O_RDONLY = 0
+local O_CLOEXEC = 524288
+local EOPNOTSUPP = 95
+local EXDEV = 18
+local EINVAL = 22
+local ENOTTY = 25
+local ENOSYS = 38
+local FALLOC_FL_KEEP_SIZE = 1
+local O_DIRECTORY = 65536
+local SYNC_FILE_RANGE_WAIT_BEFORE = 1
+local SYNC_FILE_RANGE_WRITE = 2
+local SYNC_FILE_RANGE_WAIT_AFTER = 4
+local POSIX_FADV_DONTNEED = 4
+local FICLONE = 0x40049409
+local XATTR_BUFLEN = 256
+
+-- The runtime image only ships the versioned zlib soname
+local ok, zlib = pcall(ffi.load, "libz.so.1")
+if not ok then
+    zlib = ffi.load("z")
+end
+
+---@type function
+---@param errno integer
+---@return string
+local function strerror(errno)
+    return ffi.string(C.strerror(errno))
+end
+
+---@type function
+---@param path string
+---@param flags integer
+---@param mode integer
+---@return integer? fd, string? err
+---Open a file, returning the raw file descriptor
+---The error message is formatted like the one from io.open
+function diskio_thread.open(path, flags, mode)
+    local fd = C.open(path, flags, mode)
+    if fd < 0 then
+        return nil, path .. ": " .. strerror(ffi.errno())
+    end
+    return fd
+end
+
+---@type function
+---@param fd integer
+---@return boolean? success, string? err
+function diskio_thread.close(fd)
+    if C.close(fd) < 0 then
+        return nil, strerror(ffi.errno())
+    end
+    return true
+end
+
+---@type function
+---@param fd integer
+---@param size integer
+---@return boolean? success, string? err
+---Reserve disk space for size bytes without changing the file size
+---Filesystems without fallocate support are not an error, the space is just not reserved
+function diskio_thread.fallocate(fd, size)
+    if C.fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) < 0 then
+        local errno = ffi.errno()
+        if errno ~= EOPNOTSUPP then
+            return nil, strerror(errno)
+        end
+    end
+    return true
+end
+
+---@type function
+---@param fd integer
+---@param size integer
+---@return boolean? success, string? err
+---Cut or extend (with zeros) the file to size bytes
+function diskio_thread.ftruncate(fd, size)
+    if C.ftruncate(fd, size) < 0 then
+        return nil, strerror(ffi.errno())
+    end
+    return true
+end
+
+---@type function
+---@param fd integer
+---@param drop_cache boolean
+---@return boolean? success, string? err
+---Flush the data and metadata of fd to disk
+---With drop_cache, the now clean pages of the file are then evicted from the page cache.
+function diskio_thread.fsync(fd, drop_cache)
+    if C.fsync(fd) < 0 then
+        return nil, strerror(ffi.errno())
+    end
+    if drop_cache then
+        C.posix_fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+    end
+    return true
+end
+
+---@type function
+---@param path string
+---@return boolean? success, string? err
+---Flush a directory to disk, so that a file created or renamed in it survives a crash
+function diskio_thread.fsync_directory(path)
+    local fd = C.open(path, O_RDONLY + O_DIRECTORY + O_CLOEXEC, 0)
+    if fd < 0 then
+        return nil, path .. ": " .. strerror(ffi.errno())
+    end
+    local suc, err = diskio_thread.fsync(fd, false)
+    C.close(fd)
+    return suc, err
+end
+
+---@type function
+---@param fd integer
+---@param offset integer
+---@param length integer
+---@param previous_offset integer
+---@param previous_length integer
+---@param drop_cache boolean
+---@return boolean? success, string? err
+---Start writing back the range at offset, then wait for the previous range to be on disk
+---Called every upload_writeback_interval bytes of an upload, this bounds its dirty
+---pages to about two intervals. With drop_cache, the previous range, whose pages
+---are clean by then, is evicted from the page cache.
+function diskio_thread.writeback(fd, offset, length, previous_offset, previous_length, drop_cache)
+    if length > 0 and C.sync_file_range(fd, offset, length, SYNC_FILE_RANGE_WRITE) < 0 then
+        return nil, strerror(ffi.errno())
+    end
+    if previous_length > 0 then
+        local flags = SYNC_FILE_RANGE_WAIT_BEFORE + SYNC_FILE_RANGE_WRITE + SYNC_FILE_RANGE_WAIT_AFTER
+        if C.sync_file_range(fd, previous_offset, previous_length, flags) < 0 then
+            return nil, strerror(ffi.errno())
+        end
+        if drop_cache then
+            -- only advice, its failure does not matter
+            C.posix_fadvise(fd, previous_offset, previous_length, POSIX_FADV_DONTNEED)
+        end
+    end
+    return true
+end
+
+---@type function
+---@param old_path string
+---@param new_path string
+---@return boolean? success, string? err
+function diskio_thread.rename(old_path, new_path)
+    if C.rename(old_path, new_path) < 0 then
+        return nil, strerror(ffi.errno())
+    end
+    return true
+end
+
+---@type function
+---@param path string
+---@return boolean? success, string? err
+function diskio_thread.unlink(path)
+    if C.unlink(path) < 0 then
+        return nil, path .. ": " .. strerror(ffi.errno())
+    end
+    return true
+end
+
+---@type function
+---@param src_fd integer
+---@param dst_fd integer
+---@return boolean? success, string? err, boolean? unsupported
+---Make the file dst_fd a reflink of src_fd, sharing its data blocks (FICLONE)
+---unsupported is set if the filesystem cannot do it, e.g. it is not btrfs or XFS
+function diskio_thread.clone(src_fd, dst_fd)
+    if C.ioctl(dst_fd, FICLONE, ffi.cast("int", src_fd)) < 0 then
+        local errno = ffi.errno()
+        local unsupported = errno == EOPNOTSUPP or errno == EXDEV or errno == EINVAL or errno == ENOTTY
+        return nil, strerror(errno), unsupported
+    end
+    return true
+end
+
+---@type function
+---@param src_fd integer
+---@param dst_fd integer
+---@param offset integer
+---@param length integer
+---@param buffer_size integer
+---@return integer? copied, string? err
+---Copy length bytes at offset from src_fd to the same offset of dst_fd (less only at
+---the end of the file) with copy_file_range, which lets the kernel or the filesystem
+---do it without going through user space. Falls back to pread and pwrite of
+---buffer_size if copy_file_range is not supported between the two files.
+function diskio_thread.copy_range(src_fd, dst_fd, offset, length, buffer_size)
+    local offsets = ffi.new("int64_t[2]", offset, offset)
+    local copied = 0
+    while copied < length do
+        local ret = tonumber(C.copy_file_range(src_fd, offsets, dst_fd, offsets + 1, length - copied, 0))
+        if ret < 0 then
+            local errno = ffi.errno()
+            if errno == ENOSYS or errno == EXDEV or errno == EINVAL or errno == EOPNOTSUPP then
+                break
+            elseif errno ~= EINTR then
+                return nil, strerror(errno)
+            end
+        elseif ret == 0 then
+            return copied
+        else
+            copied = copied + ret
+        end
+    end
+
+    while copied < length do
+        local data, err = diskio_thread.pread(src_fd, math.min(buffer_size, length - copied), offset + copied)
+        if not data then
+            return nil, err
+        end
+        if #data == 0 then
+            break
+        end
+        local written
+        written, err = diskio_thread.pwrite(dst_fd, data, offset + copied)
+        if not written then
+            return nil, err
+        end
+        copied = copied + written
+    end
+    return copied
+end
+
+---@type function
+---@param fd integer
+---@param buf ffi.cdata*
+---@param len integer
+---@param offset integer
+---@return integer? written, string? err
+local function pwrite_all(fd, buf, len, offset)
+    local written = 0
+    while written < len do
+        local ret = tonumber(C.pwrite(fd, buf + written, len - written, offset + written))
+        if ret < 0 then
+            local errno = ffi.errno()
+            if errno ~= EINTR then
+                return nil, strerror(errno)
+            end
+        else
+            written = written + ret
+        end
+    end
+    return written
+end
+
+---@type function
+---@param fd integer
+---@param data string
+---@param offset integer
+---@return integer? written, string? err
+---Write all of data to fd at the given offset
+function diskio_thread.pwrite(fd, data, offset)
+    return pwrite_all(fd, ffi.cast("const char *", data), #data, offset)
+end
+
+---@type function
+---@param fd integer
+---@param address number the address of a buffer in the worker (see bufpool.lua)
+---@param length integer
+---@param offset integer
+---@param writing_address number? the address of an int to clear when done
+---@return integer? written, string? err
+---Write length bytes from the buffer at address to fd at the given offset
+---Only plain values can be passed to the thread pool, so the worker passes the
+---buffer's address. The worker keeps the buffer alive until this returns, or,
+---if the request ended meanwhile, until the int at writing_address is cleared.
+function diskio_thread.pwrite_address(fd, address, length, offset, writing_address)
+    local written, err = pwrite_all(fd, ffi.cast("const char *", address), length, offset)
+    if writing_address then
+        ffi.cast("int *", writing_address)[0] = 0
+    end
+    return written, err
+end
+
+---@type function
+---@param fd integer
+---@param size integer
+---@param offset integer
+---@return string? data, string? err
+---Read up to size bytes from fd at the given offset (less only at the end of the file)
+function diskio_thread.pread(fd, size, offset)
+    local buf = ffi.new("char[?]", size)
+    local got = 0
+    while got < size do
+        local ret = tonumber(C.pread(fd, buf + got, size - got, offset + got))
+        if ret < 0 then
+            local errno = ffi.errno()
+            if errno ~= EINTR then
+                return nil, strerror(errno)
+            end
+        elseif ret == 0 then
+            break
+        else
+            got = got + ret
+        end
+    end
+    return ffi.string(buf, got)
+end
+
+---@type function
+---@param path string
+---@param offset integer
+---@param length integer?
+---@param block_size integer
+---@return integer? adler32, string? err
+---Compute the adler32 of length bytes of a file from offset (to the end if length is nil)
+---reading it in blocks of at most block_size
+function diskio_thread.adler32_range(path, offset, length, block_size)
+    local fd, err = diskio_thread.open(path, O_RDONLY + O_CLOEXEC, 0)
+    if not fd then
+        return nil, err
+    end
+    local buf = ffi.new("char[?]", block_size)
+    local adler = zlib.adler32(0, nil, 0)
+    local remaining = length or math.huge
+    while remaining > 0 do
+        local ret = tonumber(C.pread(fd, buf, math.min(block_size, remaining), offset))
+        if ret < 0 then
+            local errno = ffi.errno()
+            if errno ~= EINTR then
+                C.close(fd)
+                return nil, path .. ": " .. strerror(errno)
+            end
+        elseif ret == 0 then
+            break
+        else
+            adler = zlib.adler32(adler, buf, ret)
+            offset = offset + ret
+            remaining = remaining - ret
+        end
+    end
+    C.close(fd)
+    if length and remaining > 0 then
+        return nil, path .. ": file shrank while computing its adler32"
+    end
+    return tonumber(adler)
+end
+
+---@type function
+---@param path string
+---@param block_size integer
+---@return integer? adler32, string? err
+---Compute the adler32 of a whole file, reading it in block_size chunks
+function diskio_thread.adler32(path, block_size)
+    return diskio_thread.adler32_range(path, 0, nil, block_size)
+end
+
+---@class DirectoryEntry
+---@field name string
+---@field is_directory boolean
+---@field size integer
+---@field mtime integer
+---@field digests table<string, string> stored digests by name
+
+---@type function
+---@param path string
+---@param name string
+---@param xattrs string[][] {digest name, xattr name} pairs, the first found for a digest wins
+---@return DirectoryEntry?
+local function describe(path, name, xattrs)
+    local stat = sys_stat.stat(path)
+    if not stat then
+        return nil
+    end
+    local digests = {}
+    local buf = ffi.new("char[?]", XATTR_BUFLEN)
+    for _, xattr in ipairs(xattrs) do
+        if not digests[xattr[1]] then
+            local ret = C.getxattr(path, xattr[2], buf, XATTR_BUFLEN)
+            if ret > 0 then
+                digests[xattr[1]] = ffi.string(buf, ret)
+            end
+        end
+    end
+    return {
+        name = name,
+        is_directory = sys_stat.S_ISDIR(stat.st_mode) ~= 0,
+        size = stat.st_size,
+        mtime = stat.st_mtime,
+        digests = digests,
+    }
+end
+
+---@type function
+---@param path string
+---@param xattrs string[][]
+---@return DirectoryEntry? entry
+---Stat a file and read its stored digests, nil if it does not exist
+function diskio_thread.stat_entry(path, xattrs)
+    return describe(path, path:match("([^/]*)/?$"), xattrs)
+end
+
+---@type function
+---@param path string
+---@param cookie string? where to continue, as returned by a previous call
+---@param count integer
+---@param xattrs string[][]
+---@param hidden boolean? also list hidden entries
+---@return DirectoryEntry[]? entries, string? cookie, string? err
+---List up to count entries of a directory, skipping hidden ones, with their stat and stored digests
+---The returned cookie continues the listing where it stopped, and is nil at the end.
+---It is a telldir position (as a string, it may not fit a double), which Linux
+---filesystems keep valid across opendir calls
+function diskio_thread.list_directory(path, cookie, count, xattrs, hidden)
+    local dir = C.opendir(path)
+    if dir == nil then
+        return nil, nil, path .. ": " .. strerror(ffi.errno())
+    end
+    if cookie then
+        C.seekdir(dir, C.strtoll(cookie, nil, 10))
+    end
+    local entries = {}
+    local base = path:sub(-1) == "/" and path or path .. "/"
+    while true do
+        local position = C.telldir(dir)
+        local dirent = C.readdir(dir)
+        if dirent == nil then
+            C.closedir(dir)
+            return entries, nil
+        end
+        local name = ffi.string(dirent.d_name)
+        -- like autoindex, which also hides in-progress uploads
+        if name:sub(1, 1) ~= "." or (hidden and name ~= "." and name ~= "..") then
+            if #entries == count then
+                -- there is more: continue from this entry
+                C.closedir(dir)
+                return entries, tostring(position):match("^%-?%d+")
+            end
+            local entry = describe(base .. name, name, xattrs)
+            -- (unless it was removed since)
+            if entry then
+                table.insert(entries, entry)
+            end
+        end
+    end
+end
+
+return diskio_thread
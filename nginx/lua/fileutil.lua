@@ -1,6 +1,13 @@
+local bit = require("bit")
+local ffi = require("ffi")
 local sys_stat = require("posix.sys.stat")
 local config = require("config")
+local bufpool = require("bufpool")
 local cksumutil = require("cksumutil")
+local diskio = require("diskio")
+local dircache = require("dircache")
+local metacache = require("metacache")
+local timing = require("timing")
 
 local fileutil = {}
 
@@ -12,10 +19,42 @@ function fileutil.get_request_local_path()
     return config.data.local_path .. uri:sub(#config.data.uriprefix + 1)
 end
 
+---@type function
+---@param destination string a Destination header
+---@return string? uri, string? local_path_or_err
+---Find the local path of a COPY or MOVE destination on this server
+---The destination is on this server if it is an absolute path, or a URL with the
+---same host and port as the request, under uriprefix. For others nil is returned,
+---and for destinations that leave uriprefix an error as second value.
+function fileutil.local_destination(destination)
+    local uri = destination
+    local authority, path = destination:match("^[hH][tT][tT][pP][sS]?://([^/]+)(.*)$")
+    if authority then
+        if authority:lower() ~= (ngx.var.http_host or ""):lower() then
+            return nil
+        end
+        uri = path
+    elseif uri:sub(1, 1) ~= "/" then
+        return nil
+    end
+    uri = uri:match("^[^?#]*")
+    local prefix = config.data.uriprefix
+    if uri:sub(1, #prefix + 1) ~= prefix .. "/" then
+        return nil, "destination outside of " .. prefix
+    end
+    -- the path is mapped like the request's, which nginx normalized
+    if ("/" .. uri .. "/"):find("/%.%.?/") then
+        return nil, "invalid destination path"
+    end
+    return uri, config.data.local_path .. uri:sub(#prefix + 1)
+end
+
 ---@type function
 ---@param file_path string
 ---@param want_adler32 boolean
----@return {exists:boolean, is_directory:boolean, size:integer, adler32:string}
+---@return {exists:boolean, is_directory:boolean, size:integer, adler32:string, adler32_pending:boolean}
+---If want_adler32 and the checksum is still being computed in the background,
+---adler32 is empty and adler32_pending is set
 function fileutil.get_metadata(file_path, want_adler32)
     local stat = sys_stat.stat(file_path)
 
@@ -26,6 +65,7 @@ function fileutil.get_metadata(file_path, want_adler32)
             is_directory = file_path:sub(#file_path) == "/",
             size = 0,
             adler32 = "",
+            adler32_pending = false,
         }
     end
 
@@ -33,10 +73,18 @@ function fileutil.get_metadata(file_path, want_adler32)
 
     local err = nil
     local adler32 = nil
+    local adler32_pending = false
     if want_adler32 then
+        adler32 = metacache.get_adler32(file_path, stat)
+    end
+    if want_adler32 and not adler32 then
         err, adler32 = cksumutil.get_adler32(file_path)
-        if not adler32 then
+        if err == cksumutil.PENDING then
+            adler32_pending = true
+        elseif not adler32 then
             ngx.log(ngx.ERR, "Failed to get adler32 for " .. file_path .. " err: " .. err)
+        else
+            metacache.set_adler32(file_path, stat, adler32)
         end
     end
 
@@ -45,34 +93,88 @@ function fileutil.get_metadata(file_path, want_adler32)
         is_directory = sys_stat.S_ISDIR(stat.st_mode) ~= 0,
         size = stat.st_size,
         adler32 = adler32 or "",
+        adler32_pending = adler32_pending,
     }
 end
 
+---@class Stripe
+---@field index integer
+---@field start_time number
+---@field last_transferred number
+---@field bytes integer
+---@field offset integer
+---@field length integer?
+---@field cancelled boolean
+
 ---@type function
----@param bytes_written integer
----@param start_time number
----@param last_transferred number
+---@param index integer
+---@param offset integer?
+---@param length integer?
+---@return Stripe
+---Make a progress record for one stripe (connection) of a transfer
+function fileutil.new_stripe(index, offset, length)
+    local now = ngx.now()
+    return {
+        index = index,
+        start_time = now,
+        last_transferred = now,
+        bytes = 0,
+        offset = offset or 0,
+        length = length,
+        cancelled = false,
+    }
+end
+
+-- The perf marker lines for each transfer state
+local perfmarker_states = {
+    Running = { description = "transfer has started", status = "RUNNING" },
+    Queued = { description = "transfer is waiting for a slot", status = "QUEUED" },
+}
+
+---@type function
+---@param stripes Stripe[]
 ---@param now number
----@return nil
----Write a perf-marker-stream message to the client
-local function write_perfmarker(bytes_written, start_time, last_transferred, now)
-    ngx.say("Perf Marker")
-    ngx.say("    Timestamp: ", math.floor(now))
-    ngx.say("    State: Running")
-    ngx.say("    State description: transfer has started")
-    ngx.say("    Stripe Index: 0")
-    ngx.say("    Stripe Start Time: ", math.floor(start_time))
-    ngx.say("    Stripe Last Transferred: ", math.floor(last_transferred))
-    ngx.say("    Stripe Transfer Time: ", math.floor(now - start_time))
-    ngx.say("    Stripe Bytes Transferred: ", bytes_written)
-    ngx.say("    Stripe Status: RUNNING")
-    ngx.say("    Total Stripe Count: 1")
-    ngx.say("End")
+---@param state "Running"|"Queued"|nil default Running
+---@return boolean ok false if the markers could not be sent, e.g. the client went away
+---Write a perf-marker-stream message to the client, one marker per stripe
+function fileutil.write_perfmarker(stripes, now, state)
+    state = state or "Running"
+    local lines = perfmarker_states[state]
+    for _, stripe in ipairs(stripes) do
+        ngx.say("Perf Marker")
+        ngx.say("    Timestamp: ", math.floor(now))
+        ngx.say("    State: ", state)
+        ngx.say("    State description: ", lines.description)
+        ngx.say("    Stripe Index: ", stripe.index)
+        ngx.say("    Stripe Start Time: ", math.floor(stripe.start_time))
+        ngx.say("    Stripe Last Transferred: ", math.floor(stripe.last_transferred))
+        ngx.say("    Stripe Transfer Time: ", math.floor(now - stripe.start_time))
+        ngx.say("    Stripe Bytes Transferred: ", stripe.bytes)
+        ngx.say("    Stripe Status: ", lines.status)
+        ngx.say("    Total Stripe Count: ", #stripes)
+        ngx.say("End")
+    end
     -- TODO: RemoteConnections information
     local ok, err = ngx.flush(true)
     if not ok then
         ngx.log(ngx.ERR, "Failed to flush perf-marker-stream:", err)
+        return false
     end
+    return true
+end
+
+---@type function
+---@param stripes Stripe[]
+---@return table thread
+---Start a light thread sending perf markers for stripes every performance_marker_timeout
+---The caller must ngx.thread.kill it once the transfer is over
+function fileutil.start_perfmarkers(stripes)
+    return ngx.thread.spawn(function()
+        while true do
+            ngx.sleep(config.data.performance_marker_timeout)
+            fileutil.write_perfmarker(stripes, ngx.now())
+        end
+    end)
 end
 
 local EEXIST = 17
@@ -84,84 +186,365 @@ local DIRMODE = tonumber('755', 8)
 ---@return boolean? success, string? err
 ---Create a directory at the given path.
 ---If recursive is true, create parent directories as needed.
+---Directories known to exist (see dircache.lua) are not touched.
 function fileutil.mkdir(path, recursive)
+    if dircache.known(path) then
+        return true
+    end
     if recursive then
         local parent = path:match("(.*)/")
-        local stat = sys_stat.stat(parent)
-        if not stat then
-            local suc, err = fileutil.mkdir(parent, true)
-            if not suc then
-                return nil, err
+        if parent and parent ~= "" and not dircache.known(parent) then
+            if sys_stat.stat(parent) then
+                dircache.add(parent)
+            else
+                local suc, err = fileutil.mkdir(parent, true)
+                if not suc then
+                    return nil, err
+                end
             end
         end
     end
     local suc, err, errno = sys_stat.mkdir(path, DIRMODE)
-    if suc == 0 then
-        return true
-    elseif errno == EEXIST then
+    if suc == 0 or errno == EEXIST then
+        dircache.add(path)
         return true
     end
     return nil, err
 end
 
+local ENOENT_MESSAGE = "No such file or directory"
+
 ---@type function
----@param file_path string
----@param reader fun(max_chunk_size:integer): string?, string
----@param perfmarkers boolean?
----@return string? err, string? adler32
----
----Reads from the reader function and writes to the file_path.
----Returns nil if successful, otherwise an error message
----Also returns the adler32 checksum of the written data
----Set perfmarkers to send text/perf-marker-stream messages to the client.
----  (if set, this function will call ngx.say to send messages and flush them)
-function fileutil.sink_to_file(file_path, reader, perfmarkers)
-    local directory = file_path:match("(.*)/")
+---@param path string
+---@param mode "truncate"|"exclusive"|"update"
+---@return Writer? writer, string? err
+---Create the parent directories of path and open it with diskio.open_writer
+---If the parent was removed since it was cached as known, it is created again.
+function fileutil.open_writer(path, mode)
+    local directory = path:match("(.*)/")
     if directory then
+        local start = timing.start()
         fileutil.mkdir(directory, true)
+        timing.stop("mkdir", start)
     end
-    local file, err = io.open(file_path, "w+b")
-    if not file then
-        return "failed to open file: " .. err
+    local writer, err = diskio.open_writer(path, mode)
+    if not writer and directory and err:sub(-#ENOENT_MESSAGE) == ENOENT_MESSAGE then
+        dircache.invalidate()
+        fileutil.mkdir(directory, true)
+        writer, err = diskio.open_writer(path, mode)
+    end
+    return writer, err
+end
+
+local upload_counter = 0
+
+---@type function
+---@param file_path string
+---@return string
+---A hidden, unique name in the same directory as file_path to upload it to
+local function upload_temp_path(file_path)
+    local directory, name = file_path:match("^(.*)/([^/]*)$")
+    upload_counter = upload_counter + 1
+    return string.format("%s/.%s.%d.%d.%d.upload", directory, name,
+        ngx.worker.pid(), math.floor(ngx.now() * 1000), upload_counter)
+end
+
+---@type function
+---@param file_path string
+---@param size integer?
+---@return Writer? writer, string? err
+---Create the parent directories of file_path and open it for writing
+---With config.data.atomic_uploads, the data is written to a hidden file next to
+---file_path that commit_file renames into place, and abort_file removes.
+---If the final size is known, the disk space for it is reserved up front.
+function fileutil.open_file_writer(file_path, size)
+    local path = file_path
+    local mode = "truncate"
+    if config.data.atomic_uploads then
+        path = upload_temp_path(file_path)
+        mode = "exclusive"
+    end
+    local writer, err = fileutil.open_writer(path, mode)
+    if not writer then
+        -- report errors against the requested path, not the temporary one
+        if err:sub(1, #path) == path then
+            err = file_path .. err:sub(#path + 1)
+        end
+        return nil, "failed to open file: " .. err
+    end
+    writer.final_path = file_path
+
+    if size and size > 0 and config.data.preallocate_uploads then
+        local suc, alloc_err = writer:allocate(size)
+        if not suc then
+            fileutil.abort_file(writer)
+            return nil, "failed to allocate " .. size .. " bytes for " .. file_path .. ": " .. alloc_err
+        end
+    end
+    return writer
+end
+
+---@type function
+---@param writer Writer
+---@return nil
+---Close a writer from open_file_writer after a failed transfer
+---An upload to a temporary file is removed, leaving any previous file in place
+function fileutil.abort_file(writer)
+    writer:close()
+    if writer.path ~= writer.final_path then
+        local suc, err = diskio.run("unlink", writer.path)
+        if not suc then
+            ngx.log(ngx.ERR, "Failed to remove incomplete upload: ", err)
+        end
     end
+end
 
+---@type function
+---@param writer Writer
+---@param digests table<string, string>
+---@param bytes_written integer
+---@return string? err
+---Close a writer from open_file_writer once all data is written and store its digests
+---The file only appears at its final path once the digests are stored
+function fileutil.commit_file(writer, digests, bytes_written)
+    local file_path = writer.final_path
+    metacache.invalidate(file_path)
+    local start = timing.start()
+    local suc, err = writer:close()
+    timing.stop("commit", start)
+    if not suc then
+        fileutil.abort_file(writer)
+        return "failed to close " .. file_path .. ": " .. err
+    end
+
+    start = timing.start()
+    for name, value in pairs(digests) do
+        local set_err = cksumutil.set_digest(writer.path, name, value)
+        if set_err then
+            ngx.log(ngx.ERR, "Failed to set ", name, " for ", file_path, " err: ", set_err)
+        end
+    end
+    timing.stop("xattr", start)
+
+    if writer.path ~= file_path then
+        start = timing.start()
+        suc, err = diskio.run("rename", writer.path, file_path)
+        timing.stop("commit", start)
+        if not suc then
+            fileutil.abort_file(writer)
+            return "failed to rename upload to " .. file_path .. ": " .. err
+        end
+        metacache.invalidate(file_path)
+    end
+    if config.data.upload_durability == "fsync" then
+        -- the file is only durable once its directory entry is
+        start = timing.start()
+        suc, err = diskio.run("fsync_directory", file_path:match("(.*)/"))
+        timing.stop("commit", start)
+        if not suc then
+            return "failed to sync the directory of " .. file_path .. ": " .. err
+        end
+    end
+
+    ngx.log(ngx.NOTICE, bytes_written, " total bytes written to ", file_path, " with adler32 ", digests.adler32)
+    return nil
+end
+
+---@type function
+---@param writer Writer
+---@param reader fun(max_chunk_size:integer): string?, string
+---@param stripe Stripe
+---@param limit integer?
+---@param digests string[]?
+---@return string? err, table? digest_states
+---
+---Reads from the reader function and writes to the writer, updating stripe progress.
+---Stops at the end of the reader, or after limit bytes if given.
+---All the named digests (default: adler32) are computed in the same pass.
+---Each chunk is copied into a pooled buffer (see bufpool.lua), which is
+---checksummed and written from, so the chunk itself is garbage right away.
+---Returns nil and the digest states of the data if successful, otherwise an error message
+function fileutil.sink_to_writer(writer, reader, stripe, limit, digests)
+    local digest_states = cksumutil.digests_initialize(digests or { "adler32" })
+    local remaining = limit
     local buffer = nil
-    local bytes_written = 0
-    local start_time = ngx.now()
-    local last_perfmarker = start_time
-    local last_transferred = start_time
-    local adler_state = cksumutil.adler32_initialize()
+    local err = nil
     repeat
-        buffer, err = reader(config.data.receive_buffer_size)
+        if stripe.cancelled then
+            return "transfer cancelled"
+        end
+        local size = config.data.receive_buffer_size
+        if remaining then
+            if remaining <= 0 then
+                break
+            end
+            size = math.min(size, remaining)
+        end
+        local start = timing.start()
+        buffer, err = reader(size)
+        timing.stop("recv", start)
         if err then
             return "failed to read from the request socket: " .. err
         end
-        local now = ngx.now()
         if buffer then
-            file, err = file:write(buffer)
-            bytes_written = bytes_written + #buffer
-            last_transferred = now
-            cksumutil.adler32_increment(adler_state, buffer)
-            if not file then
-                return "failed to write to the file: " .. err
+            -- readers may return more than asked for, e.g. a chunk of a chunked body
+            local data = ffi.cast("const char *", buffer)
+            local copied = 0
+            while copied < #buffer do
+                local pooled
+                pooled, err = bufpool.acquire()
+                if not pooled then
+                    return err
+                end
+                local length = math.min(pooled.size, #buffer - copied)
+                ffi.copy(pooled.data, data + copied, length)
+                start = timing.start()
+                cksumutil.digests_increment(digest_states, pooled.data, length)
+                timing.stop("cksum", start)
+                -- the write proceeds in the thread pool while we receive the next chunk
+                local suc, write_err = writer:write_buffer(pooled, length)
+                if not suc then
+                    return "failed to write to the file: " .. write_err
+                end
+                copied = copied + length
+            end
+            stripe.bytes = stripe.bytes + #buffer
+            stripe.last_transferred = ngx.now()
+            if remaining then
+                remaining = remaining - #buffer
             end
-        end
-        if perfmarkers and last_perfmarker + config.data.performance_marker_timeout <= now then
-            write_perfmarker(bytes_written, start_time, last_transferred, now)
-            last_perfmarker = now
         end
     until not buffer
 
-    local adler32 = cksumutil.adler32_to_string(adler_state)
-    cksumutil.set_adler32(file_path, adler32)
+    if remaining and remaining > 0 then
+        return "connection closed after " .. stripe.bytes .. " of " .. limit .. " bytes"
+    end
+    return nil, digest_states
+end
 
-    local suc, exitcode = file:close()
-    if not suc then
-      return "failed to close " .. file_path .. ": " .. exitcode
+---@type function
+---@param file_path string
+---@param reader fun(max_chunk_size:integer): string?, string
+---@param perfmarkers boolean?
+---@param digests string[]?
+---@param size integer?
+---@return string? err, string? adler32, table<string, string>? digest_values
+---
+---Reads from the reader function and writes to the file_path.
+---size is the expected length of the data, if known, and is used to preallocate the file
+---Returns nil if successful, otherwise an error message
+---Also returns the adler32 checksum of the written data
+---and the values of all computed digests (see cksumutil.upload_digests)
+---Set perfmarkers to send text/perf-marker-stream messages to the client.
+---  (if set, this function will call ngx.say to send messages and flush them)
+function fileutil.sink_to_file(file_path, reader, perfmarkers, digests, size)
+    local writer, err = fileutil.open_file_writer(file_path, size)
+    if not writer then
+        return err
+    end
+
+    local stripe = fileutil.new_stripe(0)
+    local reporter = nil
+    if perfmarkers then
+        reporter = fileutil.start_perfmarkers({stripe})
+    end
+    local digest_states = nil
+    err, digest_states = fileutil.sink_to_writer(writer, reader, stripe, nil,
+        digests or cksumutil.upload_digests())
+    if reporter then
+        ngx.thread.kill(reporter)
+    end
+    if err then
+        fileutil.abort_file(writer)
+        return err
+    end
+
+    local digest_values = cksumutil.digests_to_strings(digest_states)
+    err = fileutil.commit_file(writer, digest_values, stripe.bytes)
+    if err then
+        return err
     end
+    return nil, digest_values.adler32, digest_values
+end
 
-    ngx.log(ngx.NOTICE, bytes_written, " total bytes written to ", file_path, " with adler32 ", adler32)
-    return nil, adler32
+-- The permissions of new files, as diskio.open_writer creates them
+local new_file_mode = nil
+
+---@type function
+---@return integer
+---0666 without the bits of the process umask, which is read from /proc instead
+---of with umask(2), since setting it back would race with the thread pools
+local function get_new_file_mode()
+    if not new_file_mode then
+        local umask = tonumber('022', 8)
+        local f = io.open("/proc/self/status", "r")
+        if f then
+            for line in f:lines() do
+                local value = line:match("^Umask:%s*(%d+)")
+                if value then
+                    umask = tonumber(value, 8)
+                end
+            end
+            f:close()
+        end
+        new_file_mode = bit.band(tonumber('666', 8), bit.bnot(umask))
+    end
+    return new_file_mode
+end
+
+---@type function
+---@param file_path string
+---@param body_file string the file nginx received the whole request body into
+---@param reader fun(max_chunk_size:integer): string?, string reads the same body
+---@param digests string[]?
+---@return string? err, string? adler32, table<string, string>? digest_values
+---Like sink_to_file, for a request body that nginx already wrote to a file
+---client_body_temp_path is on the same filesystem as the data, so the file is
+---renamed into place, and only read to compute the digests, instead of being
+---written again. Otherwise it is copied with sink_to_file.
+function fileutil.sink_body_file(file_path, body_file, reader, digests)
+    local directory = file_path:match("(.*)/")
+    local start = timing.start()
+    fileutil.mkdir(directory, true)
+    timing.stop("mkdir", start)
+    local body_stat = sys_stat.stat(body_file)
+    local directory_stat = sys_stat.stat(directory)
+    if not body_stat or not directory_stat or body_stat.st_dev ~= directory_stat.st_dev then
+        return fileutil.sink_to_file(file_path, reader, false, digests, body_stat and body_stat.st_size)
+    end
+
+    local digest_states = cksumutil.digests_initialize(digests or cksumutil.upload_digests())
+    local bytes = 0
+    repeat
+        local chunk, err = reader(config.data.receive_buffer_size)
+        if err then
+            return "failed to read the request body: " .. err
+        end
+        if chunk then
+            start = timing.start()
+            cksumutil.digests_increment(digest_states, ffi.cast("const char *", chunk), #chunk)
+            timing.stop("cksum", start)
+            bytes = bytes + #chunk
+        end
+    until not chunk
+
+    -- nginx makes it readable by its own user only
+    local _, chmod_err = sys_stat.chmod(body_file, get_new_file_mode())
+    if chmod_err then
+        return "failed to set the permissions of " .. body_file .. ": " .. chmod_err
+    end
+    -- opened for commit_file, which flushes it to disk as upload_durability says
+    local writer, err = diskio.open_writer(body_file, "update")
+    if not writer then
+        return "failed to open file: " .. err
+    end
+    writer.final_path = file_path
+    local digest_values = cksumutil.digests_to_strings(digest_states)
+    err = fileutil.commit_file(writer, digest_values, bytes)
+    if err then
+        return err
+    end
+    return nil, digest_values.adler32, digest_values
 end
 
 return fileutil
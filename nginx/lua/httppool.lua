@@ -0,0 +1,81 @@
+local http = require("resty.http")
+local config = require("config")
+local stats = require("stats")
+
+-- Outbound HTTP connections for third-party copy
+-- Idle connections are kept in a per-(scheme, host, port) cosocket pool and TLS
+-- sessions are resumed, so repeated transfers with the same peer skip the handshake.
+
+local httppool = {}
+
+-- TLS sessions by pool name, per worker (the session objects cannot be shared)
+local ssl_sessions = {}
+
+-- Response bodies up to this size are read and discarded to keep the connection
+local DISCARD_LIMIT = 64*1024
+
+---@type function
+---@param scheme string
+---@param host string
+---@param port integer
+---@return table? httpc, string? err
+---Get a connection to the given peer, from the pool if one is idle there
+function httppool.connect(scheme, host, port)
+    local httpc = http.new()
+    local pool = scheme .. "://" .. host .. ":" .. port
+    local ok, err, ssl_session = httpc:connect({
+        scheme = scheme,
+        host = host,
+        port = port,
+        pool = pool,
+        pool_size = config.data.tpc_pool_size,
+        ssl_verify = true,
+        ssl_reused_session = ssl_sessions[pool],
+    })
+    if not ok then
+        ssl_sessions[pool] = nil
+        return nil, err
+    end
+    if ssl_session then
+        ssl_sessions[pool] = ssl_session
+    end
+
+    local reused = httpc.sock:getreusedtimes()
+    if reused and reused > 0 then
+        stats.incr("tpc_pool_hits")
+    else
+        stats.incr("tpc_pool_misses")
+    end
+    return httpc
+end
+
+---@type function
+---@param httpc table
+---@return nil
+---Return a connection whose response has been fully read to the pool
+function httppool.release(httpc)
+    local ok, err = httpc:set_keepalive(config.data.tpc_pool_idle_timeout * 1000, config.data.tpc_pool_size)
+    if not ok then
+        ngx.log(ngx.INFO, "not keeping remote connection alive: ", err)
+        httpc:close()
+    end
+end
+
+---@type function
+---@param httpc table
+---@param res table
+---@return nil
+---Discard an unwanted response (e.g. a redirect or error) and release the connection
+---Large or unknown-length bodies are not worth reading, so that connection is closed
+function httppool.discard(httpc, res)
+    local length = tonumber(res.headers["Content-Length"])
+    if length and length <= DISCARD_LIMIT and res.body_reader then
+        local _, err = res:read_body()
+        if not err then
+            return httppool.release(httpc)
+        end
+    end
+    httpc:close()
+end
+
+return httppool
@@ -0,0 +1,261 @@
+local ngx = require("ngx")
+local cjson = require("cjson.safe")
+local config = require("config")
+local cksumutil = require("cksumutil")
+local diskio = require("diskio")
+local metrics = require("metrics")
+
+-- Background checksum indexer for data placed under local_path by other tools
+-- One worker crawls the tree depth-first and computes the adler32 of files that
+-- have none, or whose adler32-stamp (see cksumutil.STAMP_XATTR) no longer
+-- matches their size and mtime, so that HEAD with Want-Digest finds it stored.
+-- The computations go through cksumutil.wait_adler32 like those of requests,
+-- at most checksum_indexer_bandwidth bytes per second on average.
+-- Paths that were recently requested (see indexer.prioritize) are queued in the
+-- checksum_indexer shared dict and indexed before the crawl goes on. It is not
+-- checksum_jobs, where the queue would evict the entries of running computations.
+-- The directories left to crawl are saved to checksum_indexer_state between
+-- batches, so a restarted server continues about where it stopped. Once the crawl is
+-- done, the next one starts checksum_indexer_interval seconds later.
+
+local indexer = {}
+
+-- How many directory entries are listed per thread pool job
+local BATCH_SIZE = 100
+-- Most paths waiting in the priority lane, others are left to the crawl
+local PRIORITY_QUEUE_SIZE = 1000
+-- How long (seconds) a requested path is not queued again
+local PRIORITY_TTL = 60
+-- How long (seconds) the indexer waits for one file to be checksummed, unless
+-- the worker exits meanwhile
+local COMPUTE_TIMEOUT = 3600
+-- How often (seconds) an idle indexer looks at the priority lane
+local IDLE_INTERVAL = 1
+-- How often (seconds) the crawl state is saved
+local SAVE_INTERVAL = 10
+
+local PRIORITY_KEY = "priority"
+
+---@class IndexerState
+---@field stack {path: string, cookie: string?}[] directories being crawled, innermost last
+---@field finished number when the last crawl was completed
+
+-- The stored digests the indexer looks at
+local xattrs = nil
+
+---@type function
+---@return string[][]
+local function indexer_xattrs()
+    if not xattrs then
+        xattrs = {}
+        for _, xattr in ipairs(cksumutil.digest_xattrs()) do
+            if xattr[1] == "adler32" then
+                table.insert(xattrs, xattr)
+            end
+        end
+        table.insert(xattrs, { "stamp", cksumutil.STAMP_XATTR })
+    end
+    return xattrs
+end
+
+---@type function
+---@return IndexerState
+local function load_state()
+    local state = nil
+    local f = io.open(config.data.checksum_indexer_state, "r")
+    if f then
+        state = cjson.decode(f:read("*a"))
+        f:close()
+    end
+    if type(state) ~= "table" or type(state.stack) ~= "table" then
+        state = { stack = {}, finished = 0 }
+    end
+    return state
+end
+
+---@type function
+---@param state IndexerState
+---@return nil
+---Save the state, replacing the previous one at once so a crash cannot truncate it
+local function save_state(state)
+    local path = config.data.checksum_indexer_state
+    local f, err = io.open(path .. ".tmp", "w")
+    if not f then
+        ngx.log(ngx.ERR, "failed to save the checksum indexer state: ", err)
+        return
+    end
+    f:write(cjson.encode(state))
+    f:close()
+    local suc, rename_err = os.rename(path .. ".tmp", path)
+    if not suc then
+        ngx.log(ngx.ERR, "failed to save the checksum indexer state: ", rename_err)
+    end
+end
+
+---@type function
+---@param path string
+---@param entry DirectoryEntry
+---@return nil
+---Compute the adler32 of a file unless a current one is stored, keeping within the bandwidth budget
+local function index_file(path, entry)
+    local stored = entry.digests.adler32
+    local stamp = entry.digests.stamp
+    if stored and (not stamp or stamp == cksumutil.adler32_stamp(entry.size, entry.mtime)) then
+        return
+    end
+    ngx.update_time()
+    local start = ngx.now()
+    local err = cksumutil.wait_adler32(path, COMPUTE_TIMEOUT, ngx.worker.exiting)
+    if err == cksumutil.PENDING and ngx.worker.exiting() then
+        -- the computation still stores its result, the crawl goes on after a restart
+        return
+    end
+    metrics.incr("webdav_indexer_files_total", err and 'result="failure"' or 'result="success"')
+    if err then
+        ngx.log(ngx.WARN, "checksum indexer could not checksum ", path, ": ", err)
+    end
+    local bandwidth = config.data.checksum_indexer_bandwidth
+    if bandwidth > 0 then
+        ngx.update_time()
+        local resume = start + entry.size / bandwidth
+        while ngx.now() < resume and not ngx.worker.exiting() do
+            ngx.sleep(math.min(resume - ngx.now(), IDLE_INTERVAL))
+            ngx.update_time()
+        end
+    end
+end
+
+---@type function
+---@return nil
+---Index the requested paths waiting in the priority lane
+---A directory has its files indexed, but not its subdirectories.
+local function drain_priority()
+    local queue = ngx.shared.checksum_indexer
+    while not ngx.worker.exiting() do
+        local path = queue:rpop(PRIORITY_KEY)
+        if not path then
+            return
+        end
+        local entry = diskio.run("stat_entry", path, indexer_xattrs())
+        if entry and entry.is_directory then
+            local base = path:gsub("/$", "") .. "/"
+            local cookie = nil
+            repeat
+                local entries
+                entries, cookie = diskio.run("list_directory", path, cookie, BATCH_SIZE, indexer_xattrs())
+                for _, child in ipairs(entries or {}) do
+                    if not child.is_directory then
+                        index_file(base .. child.name, child)
+                    end
+                end
+            until not cookie or ngx.worker.exiting()
+        elseif entry then
+            index_file(path, entry)
+        end
+    end
+end
+
+---@type function
+---@param state IndexerState
+---@return nil
+---Crawl one batch of the innermost directory on the stack
+local function crawl_step(state)
+    local top = state.stack[#state.stack]
+    local entries, cookie, err = diskio.run("list_directory", top.path, top.cookie, BATCH_SIZE, indexer_xattrs())
+    if not entries then
+        -- e.g. removed since it was found
+        ngx.log(ngx.WARN, "checksum indexer could not list ", top.path, ": ", err)
+        table.remove(state.stack)
+        return
+    end
+    local base = top.path:gsub("/$", "") .. "/"
+    local subdirectories = {}
+    for _, entry in ipairs(entries) do
+        if entry.is_directory then
+            table.insert(subdirectories, { path = base .. entry.name })
+        else
+            drain_priority()
+            index_file(base .. entry.name, entry)
+        end
+        if ngx.worker.exiting() then
+            -- the batch is done again after a restart
+            return
+        end
+    end
+    if cookie then
+        top.cookie = cookie
+    else
+        table.remove(state.stack)
+    end
+    for _, subdirectory in ipairs(subdirectories) do
+        table.insert(state.stack, subdirectory)
+    end
+end
+
+---@type function
+---@param premature boolean
+local function run(premature)
+    if premature then
+        return
+    end
+    local state = load_state()
+    local next_save = 0
+    while not ngx.worker.exiting() do
+        drain_priority()
+        ngx.update_time()
+        if #state.stack > 0 then
+            crawl_step(state)
+            ngx.update_time()
+            if #state.stack == 0 then
+                state.finished = ngx.now()
+                ngx.log(ngx.NOTICE, "checksum indexer finished crawling ", config.data.local_path)
+                next_save = 0
+            end
+            if ngx.now() >= next_save then
+                save_state(state)
+                next_save = ngx.now() + SAVE_INTERVAL
+            end
+        elseif ngx.now() >= state.finished + config.data.checksum_indexer_interval then
+            state.stack = { { path = config.data.local_path } }
+        else
+            ngx.sleep(IDLE_INTERVAL)
+        end
+    end
+    save_state(state)
+end
+
+---@type function
+---@return nil
+---Start the indexer if enabled, called from init_worker
+---It runs in the first worker only, which is started again with the same id if it dies.
+function indexer.init()
+    if not config.data.checksum_indexer or ngx.worker.id() ~= 0 then
+        return
+    end
+    local ok, err = ngx.timer.at(0, run)
+    if not ok then
+        ngx.log(ngx.ERR, "failed to start the checksum indexer: ", err)
+    end
+end
+
+---@type function
+---@param path string a local path that was requested
+---@return nil
+---Queue a file, or the files of a directory, to be indexed before the crawl goes on
+function indexer.prioritize(path)
+    if not config.data.checksum_indexer then
+        return
+    end
+    local queue = ngx.shared.checksum_indexer
+    if not queue:add("queued:" .. path, true, PRIORITY_TTL) then
+        return
+    end
+    if (queue:llen(PRIORITY_KEY) or 0) < PRIORITY_QUEUE_SIZE then
+        local _, err = queue:lpush(PRIORITY_KEY, path)
+        if err then
+            ngx.log(ngx.ERR, "failed to queue ", path, " for the checksum indexer: ", err)
+        end
+    end
+end
+
+return indexer
@@ -0,0 +1,113 @@
+local ngx = require("ngx")
+local cjson = require("cjson.safe")
+local lrucache = require("resty.lrucache")
+local openidc = require("resty.openidc")
+local resty_sha256 = require("resty.sha256")
+local config = require("config")
+local stats = require("stats")
+
+-- Bearer token verification with a cache of verified claims
+-- Claims are cached by token hash until the token expires (at most
+-- jwt_cache_max_ttl), first in a per-worker LRU cache and then in the
+-- jwt_verification shared dict, so the RS256 signature of a token is
+-- normally verified once per server rather than once per request.
+
+local jwtauth = {}
+
+-- Built once per worker by jwtauth.init
+local verify_opts = nil
+local worker_cache = nil
+
+---@type function
+---@return nil
+---Set up the verification options and cache, called from init_worker
+function jwtauth.init()
+    verify_opts = {
+        public_key = config.data.openidc_pubkey,
+        token_signing_alg_values_expected = { "RS256" }
+    }
+    local err = nil
+    worker_cache, err = lrucache.new(config.data.jwt_cache_worker_size)
+    if not worker_cache then
+        ngx.log(ngx.ERR, "failed to create the token cache: ", err)
+    end
+end
+
+---@type function
+---@param token string
+---@return string
+local function token_key(token)
+    local sha256 = resty_sha256:new()
+    sha256:update(token)
+    return ngx.encode_base64(sha256:final())
+end
+
+---@type function
+---@param key string
+---@return table? entry
+---Look a verified token up in the worker cache, then in the shared dict
+local function cache_get(key)
+    local entry = worker_cache and worker_cache:get(key)
+    if entry then
+        return entry
+    end
+    local value, ttl = ngx.shared.jwt_verification:get(key), ngx.shared.jwt_verification:ttl(key)
+    if value and ttl and ttl > 0 then
+        local claims = cjson.decode(value)
+        if claims then
+            entry = { claims = claims }
+            if worker_cache then
+                worker_cache:set(key, entry, ttl)
+            end
+            return entry
+        end
+    end
+    return nil
+end
+
+---@type function
+---@return table? entry, string? err
+---Verify the bearer token of the current request
+---Returns a cache entry whose claims field holds the verified claims. The entry
+---is shared by all requests with the same token, so other per-token data
+---derived from the claims may be stored in it.
+function jwtauth.verify()
+    if not verify_opts then
+        jwtauth.init()
+    end
+    local token = (ngx.var.http_authorization or ""):match("^[Bb]earer%s+(%S+)%s*$")
+    if not token then
+        return nil, "no access token provided"
+    end
+
+    local key = token_key(token)
+    local entry = cache_get(key)
+    if entry then
+        stats.incr("jwt_cache_hits")
+        return entry
+    end
+    stats.incr("jwt_cache_misses")
+
+    local claims, err = openidc.bearer_jwt_verify(verify_opts)
+    if err or not claims then
+        return nil, err or "no access token provided"
+    end
+
+    local ttl = config.data.jwt_cache_max_ttl
+    if claims.exp then
+        ttl = math.min(ttl, claims.exp - ngx.time())
+    end
+    entry = { claims = claims }
+    if ttl > 0 then
+        if worker_cache then
+            worker_cache:set(key, entry, ttl)
+        end
+        local ok, set_err = ngx.shared.jwt_verification:set(key, cjson.encode(claims), ttl)
+        if not ok then
+            ngx.log(ngx.ERR, "failed to cache token claims: ", set_err)
+        end
+    end
+    return entry
+end
+
+return jwtauth
@@ -0,0 +1,160 @@
+local ngx = require("ngx")
+local sys_stat = require("posix.sys.stat")
+local config = require("config")
+local cksumutil = require("cksumutil")
+local diskio = require("diskio")
+local dircache = require("dircache")
+local fileutil = require("fileutil")
+local metacache = require("metacache")
+
+-- COPY and MOVE with a Destination on this server (RFC 4918 sections 9.8 and 9.9)
+-- MOVE is a rename. COPY reflinks or copies the file in the thread pool (see
+-- Writer:copy_from) and carries over its stored checksums if they are current,
+-- so the copy is never read again. Like uploads, a copy appears at its destination only
+-- once complete. Directories can be moved but not copied.
+
+local localcopy = {}
+
+---@type function
+---@param source string
+---@param destination string
+---@return integer? status, string? message, boolean? existed
+---Check that the source can be copied or moved to destination
+---Returns the status and message of a failure, or whether the destination exists
+local function check_destination(source, destination)
+    if source:gsub("/$", "") == destination:gsub("/$", "") then
+        return ngx.HTTP_FORBIDDEN, "source and destination are the same"
+    end
+    local metadata = fileutil.get_metadata(destination, false)
+    if metadata.exists then
+        if ngx.var.http_overwrite == "F" then
+            -- Precondition Failed
+            return 412, "destination exists"
+        end
+        if metadata.is_directory then
+            return ngx.HTTP_CONFLICT, "destination is a directory"
+        end
+    end
+    return nil, nil, metadata.exists
+end
+
+---@type function
+---@param source string
+---@return table<string, string?> digests
+---The stored digests of source, by name, if its adler32-stamp matches its size and mtime
+---Otherwise the file changed since they were stored, or they predate the stamps,
+---and none are returned so that the copy gets them recomputed instead of
+---stamping stale values as current (see indexer.lua).
+local function current_digests(source)
+    local stat = sys_stat.stat(source)
+    local _, stamp = cksumutil.getxattr(source, cksumutil.STAMP_XATTR)
+    if not stat or stamp ~= cksumutil.adler32_stamp(stat.st_size, stat.st_mtime) then
+        return {}
+    end
+    local digests = {}
+    for _, xattr in ipairs(cksumutil.digest_xattrs()) do
+        local name = xattr[1]
+        if not digests[name] then
+            local _, value = cksumutil.check_digest(source, name)
+            digests[name] = value
+        end
+    end
+    return digests
+end
+
+---@type function
+---@param source string
+---@param destination string
+---@return integer status, string message
+---Copy the file at source to destination
+function localcopy.copy(source, destination)
+    local metadata = fileutil.get_metadata(source, false)
+    if not metadata.exists then
+        return ngx.HTTP_NOT_FOUND, "source file not found"
+    end
+    if metadata.is_directory then
+        return ngx.HTTP_FORBIDDEN, "copying directories is not supported"
+    end
+    local status, message, existed = check_destination(source, destination)
+    if status then
+        return status, message
+    end
+
+    local digests = current_digests(source)
+
+    local writer, err = fileutil.open_file_writer(destination, nil)
+    if not writer then
+        return ngx.HTTP_INTERNAL_SERVER_ERROR, err
+    end
+    local suc
+    suc, err = writer:copy_from(source, metadata.size, config.data.preallocate_uploads)
+    if not suc then
+        fileutil.abort_file(writer)
+        return ngx.HTTP_INTERNAL_SERVER_ERROR, "failed to copy the file: " .. err
+    end
+    err = fileutil.commit_file(writer, digests, metadata.size)
+    if err then
+        return ngx.HTTP_INTERNAL_SERVER_ERROR, err
+    end
+    if existed then
+        return ngx.HTTP_NO_CONTENT, ""
+    end
+    return ngx.HTTP_CREATED, "Created"
+end
+
+---@type function
+---@param source string
+---@param destination string
+---@return integer status, string message
+---Move the file or directory at source to destination
+function localcopy.move(source, destination)
+    local metadata = fileutil.get_metadata(source, false)
+    if not metadata.exists then
+        return ngx.HTTP_NOT_FOUND, "source file not found"
+    end
+    local status, message, existed = check_destination(source, destination)
+    if status then
+        return status, message
+    end
+
+    local directory = destination:gsub("/$", ""):match("(.*)/")
+    if directory then
+        fileutil.mkdir(directory, true)
+    end
+    local suc, err = diskio.run("rename", source, destination)
+    metacache.invalidate(source)
+    metacache.invalidate(destination)
+    if metadata.is_directory then
+        dircache.invalidate()
+    end
+    if not suc then
+        if err == "Invalid cross-device link" and not metadata.is_directory then
+            -- e.g. a separate mount under local_path
+            status, message = localcopy.copy(source, destination)
+            if status == ngx.HTTP_CREATED or status == ngx.HTTP_NO_CONTENT then
+                diskio.run("unlink", source)
+            end
+            return status, message
+        end
+        return ngx.HTTP_INTERNAL_SERVER_ERROR, "failed to move the file: " .. err
+    end
+    if existed then
+        return ngx.HTTP_NO_CONTENT, ""
+    end
+    return ngx.HTTP_CREATED, "Created"
+end
+
+---@type function
+---@param status integer
+---@param message string
+---@return nil
+---Send the outcome of localcopy.copy or localcopy.move to the client
+function localcopy.respond(status, message)
+    ngx.status = status
+    if status ~= ngx.HTTP_NO_CONTENT then
+        ngx.say(message)
+    end
+    return ngx.exit(ngx.OK)
+end
+
+return localcopy
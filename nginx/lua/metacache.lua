@@ -0,0 +1,58 @@
+local ngx = require("ngx")
+local stats = require("stats")
+
+-- Cache of file checksums in the metadata_cache shared dict, keyed by path
+-- Entries record the size, mtime, ctime and inode of the file they were made for
+-- and only count as a hit while the file's stat still matches. When the dict is
+-- full, the least recently used entries are evicted.
+
+local metacache = {}
+
+---@type function
+---@param stat table
+---@return string
+local function stat_key(stat)
+    return string.format("%d:%d:%d:%d", stat.st_size, stat.st_mtime, stat.st_ctime, stat.st_ino)
+end
+
+---@type function
+---@param path string
+---@param stat table
+---@return string? adler32
+---Get the cached adler32 for path, if it was cached for a file with the same stat
+function metacache.get_adler32(path, stat)
+    local entry = ngx.shared.metadata_cache:get(path)
+    if entry then
+        local key, adler32 = entry:match("^([^/]*)/(.*)$")
+        if key == stat_key(stat) then
+            stats.incr("metadata_cache_hits")
+            return adler32
+        end
+    end
+    stats.incr("metadata_cache_misses")
+    return nil
+end
+
+---@type function
+---@param path string
+---@param stat table
+---@param adler32 string
+---@return nil
+---Cache the adler32 of path, as of the given stat
+function metacache.set_adler32(path, stat, adler32)
+    -- set (unlike safe_set) evicts least recently used entries when full
+    local ok, err = ngx.shared.metadata_cache:set(path, stat_key(stat) .. "/" .. adler32)
+    if not ok then
+        ngx.log(ngx.ERR, "failed to cache metadata for ", path, ": ", err)
+    end
+end
+
+---@type function
+---@param path string
+---@return nil
+---Forget the cached metadata of path, when it is written or deleted
+function metacache.invalidate(path)
+    ngx.shared.metadata_cache:delete(path)
+end
+
+return metacache
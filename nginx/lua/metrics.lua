@@ -0,0 +1,302 @@
+local ngx = require("ngx")
+local config = require("config")
+local stats = require("stats")
+local timing = require("timing")
+
+-- Prometheus metrics
+-- Updates only touch a table local to the worker, so the request path never
+-- waits for the shared memory lock. A timer in each worker adds the pending
+-- deltas to the metrics shared dict every metrics_sync_interval seconds, and
+-- the metrics endpoint formats what is in the dict.
+
+local metrics = {}
+
+local REQUEST_BUCKETS = { 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800 }
+local TPC_DURATION_BUCKETS = { 1, 5, 10, 30, 60, 300, 600, 1800, 3600, 7200 }
+local TPC_THROUGHPUT_BUCKETS = { 1e6, 1e7, 5e7, 1e8, 2.5e8, 5e8, 1e9, 2.5e9, 5e9, 1e10 }
+local TPC_QUEUE_WAIT_BUCKETS = { 0.01, 0.1, 1, 5, 10, 30, 60, 120, 300, 600 }
+
+-- Every metric that may be updated, by name
+local definitions = {
+    webdav_requests_total = {
+        type = "counter", help = "WebDAV requests by method and status",
+    },
+    webdav_request_duration_seconds = {
+        type = "histogram", help = "Time to serve WebDAV requests", buckets = REQUEST_BUCKETS,
+    },
+    webdav_request_bytes_total = {
+        type = "counter", help = "Bytes received in WebDAV requests, including uploaded data",
+    },
+    webdav_response_bytes_total = {
+        type = "counter", help = "Bytes sent in WebDAV responses, including downloaded data",
+    },
+    webdav_active_uploads = {
+        type = "gauge", help = "PUT requests in progress",
+    },
+    webdav_checksums_total = {
+        type = "counter", help = "Checksums computed from files on disk, by result",
+    },
+    webdav_checksum_seconds_total = {
+        type = "counter", help = "Time spent computing checksums from files on disk",
+    },
+    webdav_checksum_bytes_total = {
+        type = "counter", help = "Bytes read to compute checksums from files on disk",
+    },
+    webdav_tpc_active = {
+        type = "gauge", help = "Third-party copies in progress, by direction",
+    },
+    webdav_tpc_duration_seconds = {
+        type = "histogram", help = "Duration of third-party copies", buckets = TPC_DURATION_BUCKETS,
+    },
+    webdav_tpc_throughput_bytes_per_second = {
+        type = "histogram", help = "Average throughput of successful third-party copies",
+        buckets = TPC_THROUGHPUT_BUCKETS,
+    },
+    webdav_tpc_bytes_total = {
+        type = "counter", help = "Bytes moved by successful third-party copies",
+    },
+    webdav_tpc_failures_total = {
+        type = "counter", help = "Failed third-party copies, by reason",
+    },
+    webdav_tpc_queued = {
+        type = "gauge", help = "Third-party copies waiting for a slot (see tpcsched.lua)",
+    },
+    webdav_tpc_queue_wait_seconds = {
+        type = "histogram", help = "Time third-party copies waited for a slot", buckets = TPC_QUEUE_WAIT_BUCKETS,
+    },
+    webdav_indexer_files_total = {
+        type = "counter", help = "Files checksummed by the background indexer, by result (see indexer.lua)",
+    },
+    webdav_io_buffers_allocated = {
+        type = "gauge", help = "Receive buffers allocated in the worker pools (see bufpool.lua)",
+    },
+    webdav_io_buffers_in_use = {
+        type = "gauge", help = "Receive buffers holding data being checksummed or written",
+    },
+    webdav_io_buffer_waits_total = {
+        type = "counter", help = "Times a transfer waited for a free receive buffer",
+    },
+    webdav_lua_memory_bytes = {
+        type = "gauge", help = "Memory in use by the Lua VM, by worker",
+    },
+}
+
+-- The methods that get their own label value, others are counted as "other"
+local known_methods = {
+    GET = true, HEAD = true, PUT = true, DELETE = true, COPY = true, MOVE = true,
+    MKCOL = true, PROPFIND = true, OPTIONS = true,
+}
+
+-- Deltas not yet added to the shared dict, by dict key
+-- Counters and gauges are keyed "name{labels}", histograms
+-- "name{labels}\tbucket" with bucket an index into the buckets, "sum" or "count"
+local pending = {}
+
+---@type function
+---@param key string
+---@param value number
+local function add(key, value)
+    pending[key] = (pending[key] or 0) + value
+end
+
+---@type function
+---@param name string
+---@param labels string e.g. 'method="GET",status="200"'
+---@param value number?
+---@return nil
+---Add value (default 1) to a counter or gauge
+function metrics.incr(name, labels, value)
+    add(name .. "{" .. labels .. "}", value or 1)
+end
+
+---@type function
+---@param name string
+---@param labels string
+---@param value number
+---@return nil
+---Record an observation in a histogram
+function metrics.observe(name, labels, value)
+    local prefix = name .. "{" .. labels .. "}\t"
+    local buckets = definitions[name].buckets
+    local bucket = #buckets + 1
+    for i, bound in ipairs(buckets) do
+        if value <= bound then
+            bucket = i
+            break
+        end
+    end
+    add(prefix .. bucket, 1)
+    add(prefix .. "sum", value)
+    add(prefix .. "count", 1)
+end
+
+---@type function
+---@return nil
+---Add the pending deltas of this worker to the shared dict
+function metrics.sync()
+    local dict = ngx.shared.metrics
+    -- LuaJIT keeps no GC timings, so the heap size shows the garbage instead.
+    -- A restarted worker replaces the value of the one it took over from.
+    dict:set('webdav_lua_memory_bytes{worker="' .. ngx.worker.id() .. '"}', collectgarbage("count") * 1024)
+    local deltas = pending
+    pending = {}
+    for key, value in pairs(deltas) do
+        local ok, err = dict:incr(key, value, 0)
+        if not ok then
+            ngx.log(ngx.ERR, "failed to update metric ", key, ": ", err)
+        end
+    end
+end
+
+---@type function
+---@param premature boolean
+local function sync_timer(premature)
+    if not premature then
+        metrics.sync()
+    end
+end
+
+---@type function
+---@return nil
+---Start syncing the metrics of this worker, called from init_worker_by_lua
+function metrics.init()
+    local ok, err = ngx.timer.every(config.data.metrics_sync_interval, sync_timer)
+    if not ok then
+        ngx.log(ngx.ERR, "failed to start metrics timer: ", err)
+    end
+end
+
+---@type function
+---@return nil
+---Record the metrics of the current request, called from log_by_lua
+function metrics.log()
+    local ctx = ngx.ctx
+    if ctx.active_upload then
+        metrics.incr("webdav_active_uploads", "", -1)
+    end
+    local tpc = ctx.tpc
+    if tpc then
+        local direction = 'direction="' .. tpc.direction .. '"'
+        metrics.incr("webdav_tpc_active", direction, -1)
+        local duration = ngx.now() - tpc.start
+        local result = tpc.result or "failure"
+        metrics.observe("webdav_tpc_duration_seconds", direction .. ',result="' .. result .. '"', duration)
+        if result == "success" then
+            local bytes = tpc.bytes or 0
+            metrics.incr("webdav_tpc_bytes_total", direction, bytes)
+            if bytes > 0 and duration > 0 then
+                metrics.observe("webdav_tpc_throughput_bytes_per_second", direction, bytes / duration)
+            end
+        else
+            -- e.g. the client went away before the transfer finished
+            local reason = tpc.reason or "aborted"
+            metrics.incr("webdav_tpc_failures_total", direction .. ',reason="' .. reason .. '"')
+        end
+    end
+
+    local uri = ngx.var.request_uri
+    if uri:sub(1, #config.data.uriprefix) ~= config.data.uriprefix then
+        return
+    end
+    local method = ngx.req.get_method()
+    if not known_methods[method] then
+        method = "other"
+    end
+    local labels = 'method="' .. method .. '",status="' .. timing.status() .. '"'
+    metrics.incr("webdav_requests_total", labels)
+    metrics.observe("webdav_request_duration_seconds", labels, tonumber(ngx.var.request_time) or 0)
+    method = 'method="' .. method .. '"'
+    metrics.incr("webdav_request_bytes_total", method, tonumber(ngx.var.request_length) or 0)
+    metrics.incr("webdav_response_bytes_total", method, tonumber(ngx.var.bytes_sent) or 0)
+end
+
+---@type function
+---@param value number
+---@return string
+local function format_value(value)
+    if value == math.floor(value) and math.abs(value) < 2^53 then
+        return string.format("%d", value)
+    end
+    return string.format("%.6g", value)
+end
+
+---@type function
+---@param name string
+---@param labels string
+---@return string
+local function series_name(name, labels)
+    if labels == "" then
+        return name
+    end
+    return name .. "{" .. labels .. "}"
+end
+
+---@type function
+---@return string[] lines
+---Format all metrics in the Prometheus text exposition format
+function metrics.collect()
+    metrics.sync()
+    local dict = ngx.shared.metrics
+    local by_name = {}
+    for _, key in ipairs(dict:get_keys(0)) do
+        local value = dict:get(key)
+        local name, labels, bucket = key:match("^([^{]*){([^}]*)}\t?(.*)$")
+        if value and name and definitions[name] then
+            by_name[name] = by_name[name] or {}
+            local series = by_name[name][labels]
+            if not series then
+                series = {}
+                by_name[name][labels] = series
+            end
+            series[tonumber(bucket) or bucket] = value
+        end
+    end
+
+    local names = {}
+    for name in pairs(definitions) do
+        table.insert(names, name)
+    end
+    table.sort(names)
+
+    local lines = {}
+    for _, name in ipairs(names) do
+        local definition = definitions[name]
+        table.insert(lines, "# HELP " .. name .. " " .. definition.help)
+        table.insert(lines, "# TYPE " .. name .. " " .. definition.type)
+        local all_series = by_name[name] or {}
+        local label_sets = {}
+        for labels in pairs(all_series) do
+            table.insert(label_sets, labels)
+        end
+        table.sort(label_sets)
+        for _, labels in ipairs(label_sets) do
+            local series = all_series[labels]
+            if definition.type == "histogram" then
+                local sep = labels == "" and "" or ","
+                local cumulative = 0
+                for i, bound in ipairs(definition.buckets) do
+                    cumulative = cumulative + (series[i] or 0)
+                    table.insert(lines, string.format('%s_bucket{%s%sle="%s"} %s',
+                        name, labels, sep, format_value(bound), format_value(cumulative)))
+                end
+                cumulative = cumulative + (series[#definition.buckets + 1] or 0)
+                table.insert(lines, string.format('%s_bucket{%s%sle="+Inf"} %s',
+                    name, labels, sep, format_value(cumulative)))
+                table.insert(lines, series_name(name .. "_sum", labels) .. " " .. format_value(series.sum or 0))
+                table.insert(lines, series_name(name .. "_count", labels) .. " " .. format_value(series.count or 0))
+            else
+                table.insert(lines, series_name(name, labels) .. " " .. format_value(series[""] or 0))
+            end
+        end
+    end
+
+    -- the counters of stats.lua, e.g. cache hits
+    for _, counter in ipairs(stats.get_all()) do
+        local name = "webdav_" .. counter.name .. "_total"
+        table.insert(lines, "# TYPE " .. name .. " counter")
+        table.insert(lines, name .. " " .. format_value(counter.value))
+    end
+    return lines
+end
+
+return metrics
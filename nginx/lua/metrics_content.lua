@@ -0,0 +1,8 @@
+local metrics = require("metrics")
+
+-- Prometheus metrics, see metrics.lua
+ngx.status = ngx.HTTP_OK
+ngx.header["Content-Type"] = "text/plain; version=0.0.4"
+ngx.say(table.concat(metrics.collect(), "\n"))
+
+return ngx.exit(ngx.HTTP_OK)
@@ -0,0 +1,311 @@
+local ngx = require("ngx")
+local cjson = require("cjson")
+local resty_lock = require("resty.lock")
+local config = require("config")
+local cksumutil = require("cksumutil")
+local diskio = require("diskio")
+local fileutil = require("fileutil")
+local metacache = require("metacache")
+
+-- PUT with Content-Range: a file is uploaded as disjoint ranges, possibly over
+-- many connections at once, into a hidden .partial file next to it.
+-- The ranges received so far are kept in the partial_uploads shared dict, each
+-- with its adler32. Adjacent ranges are merged by combining their adler32, so
+-- once the whole file has arrived a single range is left whose adler32 is the
+-- file's, and the file is renamed into place without re-reading it.
+-- A client whose upload was interrupted only re-sends the missing ranges, which
+-- it can find out with an empty PUT with Content-Range: bytes */<total>
+
+local partialput = {}
+
+---@class PartialUpload
+---@field total integer
+---@field ranges integer[][] received {first, last, adler32}, sorted and merged
+---@field inflight table<string, number> ranges being received "first-last" -> expiry time
+
+---@type function
+---@param header string
+---@return integer? first, integer? last, integer? total, string? err
+---Parse a Content-Range request header, e.g. "bytes 0-1023/4096"
+---For a status query ("bytes */4096") first and last are nil
+function partialput.parse_content_range(header)
+    local total = header:match("^bytes %*/(%d+)$")
+    if total then
+        return nil, nil, tonumber(total)
+    end
+    local first, last
+    first, last, total = header:match("^bytes (%d+)-(%d+)/(%d+)$")
+    if not first then
+        return nil, nil, nil, "invalid Content-Range: " .. header
+    end
+    first, last, total = tonumber(first), tonumber(last), tonumber(total)
+    if first > last or last >= total then
+        return nil, nil, nil, "unsatisfiable Content-Range: " .. header
+    end
+    return first, last, total
+end
+
+---@type function
+---@param file_path string
+---@return string
+local function partial_path(file_path)
+    local directory, name = file_path:match("^(.*)/([^/]*)$")
+    return directory .. "/." .. name .. ".partial"
+end
+
+---@type function
+---@param file_path string
+---@return PartialUpload?
+local function load(file_path)
+    local value = ngx.shared.partial_uploads:get("upload:" .. file_path)
+    if value then
+        return cjson.decode(value)
+    end
+    return nil
+end
+
+---@type function
+---@param file_path string
+---@param upload PartialUpload?
+---@return string? err
+local function save(file_path, upload)
+    local key = "upload:" .. file_path
+    if not upload then
+        ngx.shared.partial_uploads:delete(key)
+        return nil
+    end
+    local ok, err = ngx.shared.partial_uploads:set(key, cjson.encode(upload), config.data.partial_upload_ttl)
+    if not ok then
+        return "failed to record upload progress: " .. err
+    end
+    return nil
+end
+
+---@type function
+---@param file_path string
+---@param func function
+---@return any
+---Run func with the upload state of file_path locked against other requests
+local function with_lock(file_path, func, ...)
+    local lock, err = resty_lock:new("partial_uploads", { exptime = 30, timeout = 10 })
+    if not lock then
+        return "failed to create lock: " .. err
+    end
+    local _, lock_err = lock:lock("lock:" .. file_path)
+    if lock_err then
+        return "failed to lock upload of " .. file_path .. ": " .. lock_err
+    end
+    local results = { pcall(func, ...) }
+    lock:unlock()
+    if not results[1] then
+        return "upload bookkeeping failed: " .. tostring(results[2])
+    end
+    return unpack(results, 2, table.maxn(results))
+end
+
+---@type function
+---@param upload PartialUpload
+---@param first integer
+---@param last integer
+---@return boolean
+local function overlaps(upload, first, last)
+    for _, range in ipairs(upload.ranges) do
+        if first <= range[2] and range[1] <= last then
+            return true
+        end
+    end
+    local now = ngx.now()
+    for key, expiry in pairs(upload.inflight) do
+        local other_first, other_last = key:match("^(%d+)-(%d+)$")
+        if expiry > now and first <= tonumber(other_last) and tonumber(other_first) <= last then
+            return true
+        end
+    end
+    return false
+end
+
+---@type function
+---@param ranges integer[][]
+---@return integer[][]
+---Sort ranges and merge adjacent ones, combining their adler32
+local function merge(ranges)
+    table.sort(ranges, function(a, b) return a[1] < b[1] end)
+    local merged = {}
+    for _, range in ipairs(ranges) do
+        local previous = merged[#merged]
+        if previous and previous[2] + 1 == range[1] then
+            previous[3] = cksumutil.adler32_combine(previous[3], range[3], range[2] - range[1] + 1)
+            previous[2] = range[2]
+        else
+            table.insert(merged, { range[1], range[2], range[3] })
+        end
+    end
+    return merged
+end
+
+---@type function
+---@param upload PartialUpload?
+---@return string? ranges
+---Format the received ranges like a Range header, e.g. "bytes=0-99,200-299"
+function partialput.format_ranges(upload)
+    if not upload or #upload.ranges == 0 then
+        return nil
+    end
+    local out = {}
+    for _, range in ipairs(upload.ranges) do
+        table.insert(out, range[1] .. "-" .. range[2])
+    end
+    return "bytes=" .. table.concat(out, ",")
+end
+
+---@type function
+---@param file_path string
+---@return boolean
+---Whether an upload in ranges to file_path is in progress, i.e. its state is kept
+function partialput.in_progress(file_path)
+    return load(file_path) ~= nil
+end
+
+---@type function
+---@param file_path string
+---@param total integer
+---@return string? err, string? ranges
+---The ranges of an upload of total bytes to file_path received so far
+function partialput.status(file_path, total)
+    local upload = load(file_path)
+    if upload and upload.total ~= total then
+        return "an upload of " .. upload.total .. " bytes is in progress"
+    end
+    return nil, partialput.format_ranges(upload)
+end
+
+---@type function
+---@param file_path string
+---@param key string
+---@param first integer
+---@param last integer
+---@param total integer
+---@return string? err, boolean? created, boolean? conflict
+local function begin_range(file_path, key, first, last, total)
+    local upload = load(file_path)
+    local created = false
+    if not upload then
+        upload = { total = total, ranges = {}, inflight = {} }
+        created = true
+    elseif upload.total ~= total then
+        return "an upload of " .. upload.total .. " bytes is in progress", nil, true
+    end
+    if overlaps(upload, first, last) then
+        return "range overlaps data already uploaded", nil, true
+    end
+    upload.inflight[key] = ngx.now() + config.data.partial_range_timeout
+    return save(file_path, upload), created
+end
+
+---@type function
+---@param file_path string
+---@param key string
+---@param range integer[]?
+---@return string? err, PartialUpload? upload
+local function end_range(file_path, key, range)
+    local upload = load(file_path)
+    if not upload then
+        return "upload state expired"
+    end
+    upload.inflight[key] = nil
+    if range then
+        table.insert(upload.ranges, range)
+        upload.ranges = merge(upload.ranges)
+    end
+    local complete = #upload.ranges == 1 and upload.ranges[1][1] == 0
+        and upload.ranges[1][2] == upload.total - 1
+    if complete then
+        -- the last range commits the file while still holding the lock
+        local path = partial_path(file_path)
+        local adler32 = cksumutil.adler32_format(upload.ranges[1][3])
+        local set_err = cksumutil.set_digest(path, "adler32", adler32)
+        if set_err then
+            ngx.log(ngx.ERR, "Failed to set adler32 for ", file_path, " err: ", set_err)
+        end
+        local suc, err = diskio.run("rename", path, file_path)
+        if not suc then
+            return "failed to rename upload to " .. file_path .. ": " .. err
+        end
+        metacache.invalidate(file_path)
+        if config.data.upload_durability == "fsync" then
+            -- the file is only durable once its directory entry is
+            suc, err = diskio.run("fsync_directory", file_path:match("(.*)/"))
+            if not suc then
+                save(file_path, nil)
+                return "failed to sync the directory of " .. file_path .. ": " .. err
+            end
+        end
+        ngx.log(ngx.NOTICE, upload.total, " total bytes written to ", file_path, " with adler32 ", adler32,
+            " from ranges")
+        upload.adler32 = adler32
+        save(file_path, nil)
+        return nil, upload
+    end
+    return save(file_path, upload), upload
+end
+
+---@type function
+---@param file_path string
+---@param reader fun(max_chunk_size:integer): string?, string
+---@param first integer
+---@param last integer
+---@param total integer
+---@return string? err, boolean? conflict, string? ranges, string? adler32
+---Receive one range of a file from the reader and write it in place
+---Returns the ranges received so far, or the adler32 of the file once it is complete
+function partialput.sink_range(file_path, reader, first, last, total)
+    local key = first .. "-" .. last
+    local err, created, conflict = with_lock(file_path, begin_range, file_path, key, first, last, total)
+    if err then
+        return err, conflict
+    end
+
+    local path = partial_path(file_path)
+    local writer
+    writer, err = fileutil.open_writer(path, "update")
+    if writer and created then
+        -- a .partial file left from an upload whose state is gone may be longer.
+        -- Other ranges of this upload only write below total, so they may have begun.
+        local suc, trunc_err = writer:truncate(total)
+        if not suc then
+            writer:close()
+            writer, err = nil, "failed to truncate " .. path .. ": " .. trunc_err
+        end
+    end
+    if writer and created and config.data.preallocate_uploads then
+        local suc, alloc_err = writer:allocate(total)
+        if not suc then
+            writer:close()
+            writer, err = nil, "failed to allocate " .. total .. " bytes: " .. alloc_err
+        end
+    end
+
+    local digest_states = nil
+    if writer then
+        writer.offset = first
+        local stripe = fileutil.new_stripe(0, first, last - first + 1)
+        err, digest_states = fileutil.sink_to_writer(writer, reader, stripe, last - first + 1, { "adler32" })
+        local suc, close_err = writer:close()
+        if not err and not suc then
+            err = "failed to close " .. path .. ": " .. close_err
+        end
+    end
+
+    local range = nil
+    if not err then
+        range = { first, last, cksumutil.adler32_value(digest_states.adler32) }
+    end
+    local end_err, upload = with_lock(file_path, end_range, file_path, key, range)
+    err = err or end_err
+    if err then
+        return err
+    end
+    return nil, false, partialput.format_ranges(upload), upload.adler32
+end
+
+return partialput
@@ -0,0 +1,154 @@
+local ngx = require("ngx")
+local config = require("config")
+
+-- WLCG capability-based authorization
+-- https://github.com/WLCG-AuthZ-WG/common-jwt-profile/blob/master/profile.md#capability-based-authorization-scope
+-- A token's scope claim (e.g. "storage.read:/ storage.create:/store/user/x") is compiled
+-- once into one path trie per capability, so authorizing a request is a walk down
+-- the components of its path.
+
+local scopes = {}
+
+-- A capability also grants the capabilities listed here
+--   storage.modify is a strict superset of storage.create
+--   storage.stage is a superset of storage.read
+local implied_by = {
+    ["storage.read"] = { "storage.read", "storage.stage" },
+    ["storage.stage"] = { "storage.stage" },
+    ["storage.create"] = { "storage.create", "storage.modify" },
+    ["storage.modify"] = { "storage.modify" },
+}
+
+---@type function
+---@param path string
+---@return string[]? components
+---Split a path into its components, resolving "." and ".."
+---Returns nil if the path goes above the root
+function scopes.normalize(path)
+    local components = {}
+    for part in path:gmatch("[^/]+") do
+        if part == ".." then
+            if #components == 0 then
+                return nil
+            end
+            table.remove(components)
+        elseif part ~= "." then
+            table.insert(components, part)
+        end
+    end
+    return components
+end
+
+---@type function
+---@param scope string?
+---@return table compiled
+---Compile a scope claim into a trie per capability
+---Each trie node is {terminal = boolean, children = {component = node}}
+function scopes.compile(scope)
+    local compiled = {}
+    for item in (scope or ""):gmatch("%S+") do
+        local capability, path = item:match("^(storage%.%a+):(/.*)$")
+        local components = path and scopes.normalize(path)
+        if capability and components then
+            local node = compiled[capability]
+            if not node then
+                node = { terminal = false, children = {} }
+                compiled[capability] = node
+            end
+            for _, part in ipairs(components) do
+                local child = node.children[part]
+                if not child then
+                    child = { terminal = false, children = {} }
+                    node.children[part] = child
+                end
+                node = child
+            end
+            node.terminal = true
+        end
+    end
+    return compiled
+end
+
+---@type function
+---@param node table?
+---@param components string[]
+---@return boolean
+local function trie_allows(node, components)
+    if not node then
+        return false
+    end
+    if node.terminal then
+        return true
+    end
+    for _, part in ipairs(components) do
+        node = node.children[part]
+        if not node then
+            return false
+        end
+        if node.terminal then
+            return true
+        end
+    end
+    return false
+end
+
+---@type function
+---@param compiled table
+---@param capability string
+---@param components string[]
+---@return boolean
+---Whether the compiled scopes grant capability on the (normalized) path
+function scopes.allows(compiled, capability, components)
+    for _, granting in ipairs(implied_by[capability] or { capability }) do
+        if trie_allows(compiled[granting], components) then
+            return true
+        end
+    end
+    return false
+end
+
+---@type function
+---@param uri string
+---@return string[][]? paths
+---The normalized paths, relative to the WebDAV root, a request URI may refer to
+---Both the literal path (as used by the Lua handlers) and the percent-decoded path
+---(as used by nginx to serve files) are returned, and both must be authorized.
+---Returns nil if the URI is not under the WebDAV root or goes above it.
+function scopes.uri_paths(uri)
+    uri = uri:match("^[^?]*")
+    local prefix = config.data.uriprefix
+    if uri:sub(1, #prefix) ~= prefix then
+        return nil
+    end
+    local path = uri:sub(#prefix + 1)
+    if path ~= "" and path:sub(1, 1) ~= "/" then
+        return nil
+    end
+    local literal = scopes.normalize(path)
+    local decoded = scopes.normalize(ngx.unescape_uri(path))
+    if not literal or not decoded then
+        return nil
+    end
+    return { literal, decoded }
+end
+
+---@type function
+---@param compiled table
+---@param capability string
+---@param uri string
+---@return boolean
+---Whether the compiled scopes grant capability on the resource at uri
+function scopes.allows_uri(compiled, capability, uri)
+    local paths = scopes.uri_paths(uri)
+    if not paths then
+        return false
+    end
+    for _, components in ipairs(paths) do
+        if not scopes.allows(compiled, capability, components) then
+            return false
+        end
+    end
+    return true
+end
+
+return scopes
@@ -0,0 +1,74 @@
+local ngx = require("ngx")
+local config = require("config")
+
+-- Counters shared between all workers, kept in the stats shared dict
+-- Like metrics.lua, increments only touch a table local to the worker, since
+-- some are counted on every request (e.g. cache hits), and a timer adds them
+-- to the shared dict every metrics_sync_interval seconds. Reading the counters
+-- adds those of the reading worker first.
+
+local stats = {}
+
+-- Increments not yet added to the shared dict, by name
+local pending = {}
+
+---@type function
+---@param name string
+---@param value number?
+---@return nil
+---Add value (default 1) to the named counter
+function stats.incr(name, value)
+    pending[name] = (pending[name] or 0) + (value or 1)
+end
+
+---@type function
+---@return nil
+---Add the pending increments of this worker to the shared dict
+function stats.sync()
+    local deltas = pending
+    pending = {}
+    for name, value in pairs(deltas) do
+        local newval, err = ngx.shared.stats:incr(name, value, 0)
+        if not newval then
+            ngx.log(ngx.ERR, "failed to increment counter ", name, ": ", err)
+        end
+    end
+end
+
+---@type function
+---@param premature boolean
+local function sync_timer(premature)
+    if not premature then
+        stats.sync()
+    end
+end
+
+---@type function
+---@return nil
+---Start syncing the counters of this worker, called from init_worker_by_lua
+function stats.init()
+    local ok, err = ngx.timer.every(config.data.metrics_sync_interval, sync_timer)
+    if not ok then
+        ngx.log(ngx.ERR, "failed to start stats timer: ", err)
+    end
+end
+
+---@type function
+---@return {name:string, value:number}[]
+---Get all counters, sorted by name
+function stats.get_all()
+    stats.sync()
+    local dict = ngx.shared.stats
+    local keys = dict:get_keys(0)
+    table.sort(keys)
+    local out = {}
+    for _, name in ipairs(keys) do
+        local value = dict:get(name)
+        if value then
+            table.insert(out, { name = name, value = value })
+        end
+    end
+    return out
+end
+
+return stats
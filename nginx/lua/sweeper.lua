@@ -0,0 +1,111 @@
+local ngx = require("ngx")
+local config = require("config")
+local diskio = require("diskio")
+local partialput = require("partialput")
+
+-- Removal of the hidden files of uploads that will never complete
+-- A request removes the temporary file of its upload when it fails (see
+-- fileutil.abort_file), but not when its worker dies, and a restart loses track
+-- of them. Likewise the .partial file of an upload in ranges (see partialput.lua)
+-- stays when its state expires. One worker crawls local_path every
+-- stale_upload_sweep_interval seconds, and removes those that were not
+-- written to for stale_upload_age seconds, .partial files only without state.
+-- The first crawl is at a random point of the first interval, so that starts
+-- and reloads do not each scan the whole tree.
+
+local sweeper = {}
+
+-- How many directory entries are listed per thread pool job
+local BATCH_SIZE = 100
+
+---@type function
+---@param name string
+---@return boolean
+---Whether name is that of a temporary upload (see fileutil.open_file_writer)
+local function is_upload(name)
+    return name:match("^%..+%.%d+%.%d+%.%d+%.upload$") ~= nil
+end
+
+---@type function
+---@param directory string with a trailing slash
+---@param name string
+---@return boolean
+---Whether name is the .partial file of an upload in ranges that has no state
+local function is_abandoned_partial(directory, name)
+    local target = name:match("^%.(.+)%.partial$")
+    return target ~= nil and not partialput.in_progress(directory .. target)
+end
+
+---@type function
+---@return integer removed
+---Crawl local_path depth-first and remove the stale uploads found
+local function sweep()
+    local stack = { { path = config.data.local_path } }
+    local removed = 0
+    while #stack > 0 and not ngx.worker.exiting() do
+        local top = stack[#stack]
+        local entries, cookie, err = diskio.run("list_directory", top.path, top.cookie, BATCH_SIZE, {}, true)
+        if cookie then
+            top.cookie = cookie
+        else
+            table.remove(stack)
+        end
+        if not entries then
+            -- e.g. removed since it was found
+            ngx.log(ngx.WARN, "stale upload sweep could not list ", top.path, ": ", err)
+            entries = {}
+        end
+        local base = top.path:gsub("/$", "") .. "/"
+        ngx.update_time()
+        local cutoff = ngx.now() - config.data.stale_upload_age
+        for _, entry in ipairs(entries) do
+            local path = base .. entry.name
+            if entry.is_directory then
+                table.insert(stack, { path = path })
+            elseif entry.mtime < cutoff and (is_upload(entry.name) or is_abandoned_partial(base, entry.name)) then
+                local suc, unlink_err = diskio.run("unlink", path)
+                if suc then
+                    removed = removed + 1
+                    ngx.log(ngx.NOTICE, "removed stale upload ", path)
+                else
+                    ngx.log(ngx.WARN, "failed to remove stale upload ", path, ": ", unlink_err)
+                end
+            end
+        end
+    end
+    return removed
+end
+
+---@type function
+---@param premature boolean
+local function run(premature)
+    if premature then
+        return
+    end
+    local removed = sweep()
+    if removed > 0 then
+        ngx.log(ngx.NOTICE, "removed ", removed, " stale uploads from ", config.data.local_path)
+    end
+    -- a pending timer, unlike a sleeping one, does not delay a worker's exit
+    local ok, err = ngx.timer.at(config.data.stale_upload_sweep_interval, run)
+    if not ok and not ngx.worker.exiting() then
+        ngx.log(ngx.ERR, "failed to schedule the stale upload sweep: ", err)
+    end
+end
+
+---@type function
+---@return nil
+---Start sweeping if enabled, called from init_worker
+---It runs in the first worker only, which is started again with the same id if it dies.
+function sweeper.init()
+    if config.data.stale_upload_sweep_interval <= 0 or ngx.worker.id() ~= 0 then
+        return
+    end
+    math.randomseed(ngx.now() * 1000 + ngx.worker.pid())
+    local ok, err = ngx.timer.at(math.random() * config.data.stale_upload_sweep_interval, run)
+    if not ok then
+        ngx.log(ngx.ERR, "failed to start the stale upload sweep: ", err)
+    end
+end
+
+return sweeper
@@ -1,4 +1,5 @@
 local config = require("config")
+local stats = require("stats")
 
 -- A health check
 ngx.status = ngx.HTTP_OK
@@ -8,4 +9,11 @@ else
   ngx.say("OK")
 end
 
+-- Append the counters with ?stats
+if ngx.var.arg_stats then
+  for _, counter in ipairs(stats.get_all()) do
+    ngx.say(counter.name, " ", counter.value)
+  end
+end
+
 return ngx.exit(ngx.HTTP_OK)
@@ -0,0 +1,144 @@
+local ngx = require("ngx")
+local ffi = require("ffi")
+local cjson = require("cjson.safe")
+local config = require("config")
+
+-- Per-request phase timings
+-- With request_timing set, handlers time their phases with timing.start and
+-- timing.stop. A phase that happens several times, e.g. receiving the chunks of
+-- an upload, adds up. The totals are sent in a Server-Timing header when the
+-- response headers go out (see timing.header_filter), so phases after that,
+-- like the transfer of a third-party copy, are only in the log. With
+-- json_access_log set, every request is logged as one JSON object with its
+-- timings (see timing.log and default.conf).
+-- When request_timing is off, timing.start returns nil and nothing is recorded.
+
+local timing = {}
+
+ffi.cdef[[
+typedef struct { long tv_sec; long tv_nsec; } webdav_timespec;
+int clock_gettime(int clk_id, webdav_timespec *tp);
+]]
+local CLOCK_MONOTONIC = 1
+local timespec = ffi.new("webdav_timespec")
+
+---@type function
+---@return number seconds
+local function monotonic()
+    ffi.C.clock_gettime(CLOCK_MONOTONIC, timespec)
+    return tonumber(timespec.tv_sec) + tonumber(timespec.tv_nsec) * 1e-9
+end
+
+-- Phases in the order they are reported, with their Server-Timing descriptions
+local PHASES = {
+    { "auth", "token verification" },
+    { "queue", "waiting for a transfer slot" },
+    { "mkdir", "creating directories" },
+    { "connect", "connecting to the remote" },
+    { "remote", "remote response" },
+    { "recv", "receiving data" },
+    { "cksum", "computing checksums" },
+    { "disk", "waiting for disk writes" },
+    { "xattr", "storing checksums" },
+    { "commit", "closing and renaming the file" },
+}
+
+---@type function
+---@return number? start
+---Start timing a phase, nil if request_timing is off
+function timing.start()
+    if not config.data.request_timing then
+        return nil
+    end
+    return monotonic()
+end
+
+---@type function
+---@param phase string one of PHASES
+---@param start number? from timing.start
+---@return nil
+---Add the time since start to phase
+function timing.stop(phase, start)
+    if not start then
+        return
+    end
+    local phases = ngx.ctx.timing
+    if not phases then
+        phases = {}
+        ngx.ctx.timing = phases
+    end
+    phases[phase] = (phases[phase] or 0) + monotonic() - start
+end
+
+---@type function
+---@return nil
+---Set the Server-Timing header, called from header_filter_by_lua
+function timing.header_filter()
+    local phases = ngx.ctx.timing
+    if not phases then
+        return
+    end
+    local metrics = {}
+    for _, phase in ipairs(PHASES) do
+        local seconds = phases[phase[1]]
+        if seconds then
+            table.insert(metrics, string.format('%s;dur=%.3f;desc="%s"', phase[1], seconds * 1000, phase[2]))
+        end
+    end
+    if #metrics > 0 then
+        ngx.header["Server-Timing"] = table.concat(metrics, ", ")
+    end
+end
+
+---@type function
+---@return integer status
+---The status of the response as sent, for the logs
+---Handlers that end with ngx.exit(ngx.HTTP_CLOSE) record it in ngx.ctx.status,
+---since nginx may then put 444 in ngx.status although another status was sent.
+function timing.status()
+    return ngx.ctx.status or ngx.status
+end
+
+---@type function
+---@return nil
+---Format the JSON access log line of the request, called from log_by_lua
+---It is logged through the $webdav_access_json variable, see default.conf.
+function timing.log()
+    if not config.data.json_access_log then
+        return
+    end
+    local var = ngx.var
+    local entry = {
+        timestamp = var.time_iso8601,
+        remote_addr = var.remote_addr,
+        request_method = var.request_method,
+        request_uri = var.request_uri,
+        response_status = timing.status(),
+        request_length = tonumber(var.request_length),
+        body_bytes_sent = tonumber(var.body_bytes_sent),
+        request_time = tonumber(var.request_time),
+        host = var.host,
+        http_user_agent = var.http_user_agent,
+        http_version = var.server_protocol,
+    }
+    local phases = ngx.ctx.timing
+    if phases then
+        local timings = {}
+        for phase, seconds in pairs(phases) do
+            timings[phase] = math.floor(seconds * 1e6 + 0.5) / 1e6
+        end
+        entry.timing = timings
+    end
+    local tpc = ngx.ctx.tpc
+    if tpc then
+        entry.tpc = {
+            direction = tpc.direction,
+            result = tpc.result or "failure",
+            reason = tpc.reason,
+            bytes = tpc.bytes,
+        }
+    end
+    var.webdav_access_json = cjson.encode(entry)
+end
+
+return timing
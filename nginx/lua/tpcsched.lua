@@ -0,0 +1,288 @@
+local ngx = require("ngx")
+local http = require("resty.http")
+local cjson = require("cjson")
+local resty_lock = require("resty.lock")
+local config = require("config")
+local metrics = require("metrics")
+
+-- Admission control for third-party copies, shared by all workers through the
+-- tpc_scheduler shared dict.
+-- At most tpc_max_active transfers run at once, and at most
+-- tpc_max_active_per_host with the same remote host. Others wait in a queue of
+-- at most tpc_queue_size, ordered by priority (see tpc_scitag_priority) and
+-- then arrival. A waiter is only passed over while its own host is at its limit.
+-- The queue is a cjson list under a resty.lock, like partialput. Waiters poll it
+-- when the generation counter says a slot was freed or the queue changed, and
+-- a running transfer frees its slot in the log phase (see tpcsched.log), so it
+-- is returned however the request ends.
+
+local tpcsched = {}
+
+-- Waiters also look at the queue this often (seconds) without a change, to
+-- notice waiters ahead of them that expired
+local IDLE_POLL_INTERVAL = 5
+
+---@class TransferSlot
+---@field ticket integer
+---@field host string
+---@field priority number
+---@field granted boolean
+---@field enqueued number
+
+---@class Waiter
+---@field ticket integer
+---@field host string
+---@field priority number
+---@field expires number
+
+---@type function
+---@param key string
+---@param value number
+---@return nil
+local function incr(key, value)
+    local _, err = ngx.shared.tpc_scheduler:incr(key, value, 0)
+    if err then
+        ngx.log(ngx.ERR, "failed to update ", key, " in tpc_scheduler: ", err)
+    end
+end
+
+---@type function
+---@param host string? nil for all hosts
+---@return integer
+local function active(host)
+    return ngx.shared.tpc_scheduler:get(host and "active:" .. host or "active") or 0
+end
+
+---@type function
+---@return Waiter[] queue, boolean changed
+local function load_queue()
+    local value = ngx.shared.tpc_scheduler:get("queue")
+    local queue = value and cjson.decode(value) or {}
+    -- drop waiters whose request went away without leaving the queue
+    local now = ngx.now()
+    local live = {}
+    for _, waiter in ipairs(queue) do
+        if waiter.expires > now then
+            table.insert(live, waiter)
+        else
+            metrics.incr("webdav_tpc_queued", "", -1)
+        end
+    end
+    return live, #live < #queue
+end
+
+---@type function
+---@param queue Waiter[]
+---@return string? err
+---Save the queue and tell the waiters it changed
+local function save_queue(queue)
+    local ok, err = ngx.shared.tpc_scheduler:set("queue", cjson.encode(queue))
+    if not ok then
+        return "failed to save the transfer queue: " .. err
+    end
+    incr("generation", 1)
+    return nil
+end
+
+---@type function
+---@param func function
+---@return any
+---Run func with the queue locked against other requests
+local function with_lock(func, ...)
+    local lock, err = resty_lock:new("tpc_scheduler", { exptime = 10, timeout = 10 })
+    if not lock then
+        return "failed to create lock: " .. err
+    end
+    local _, lock_err = lock:lock("lock")
+    if lock_err then
+        return "failed to lock the transfer queue: " .. lock_err
+    end
+    local results = { pcall(func, ...) }
+    lock:unlock()
+    if not results[1] then
+        return "transfer scheduling failed: " .. tostring(results[2])
+    end
+    return unpack(results, 2, table.maxn(results))
+end
+
+---@type function
+---@param queue Waiter[]
+---@param ticket integer? the waiter to look for, nil for a new transfer
+---@param host string? the host of a new transfer
+---@return boolean
+---Whether the transfer may start now: there is a free slot for it after
+---the free slots have gone to the waiters ahead of it that can use them
+local function may_start(queue, ticket, host)
+    local total = active()
+    local per_host = {}
+    local function host_active(name)
+        per_host[name] = per_host[name] or active(name)
+        return per_host[name]
+    end
+
+    local waiting = {}
+    for _, waiter in ipairs(queue) do
+        table.insert(waiting, waiter)
+    end
+    table.sort(waiting, function(a, b)
+        if a.priority == b.priority then
+            return a.ticket < b.ticket
+        end
+        return a.priority > b.priority
+    end)
+    for _, waiter in ipairs(waiting) do
+        if total >= config.data.tpc_max_active then
+            return false
+        end
+        if host_active(waiter.host) < config.data.tpc_max_active_per_host then
+            if waiter.ticket == ticket then
+                return true
+            end
+            -- this one goes first
+            total = total + 1
+            per_host[waiter.host] = per_host[waiter.host] + 1
+        end
+    end
+    -- a new transfer comes after all waiters
+    return not ticket and total < config.data.tpc_max_active
+        and host_active(host) < config.data.tpc_max_active_per_host
+end
+
+---@type function
+---@param slot TransferSlot
+---@return nil
+local function take(slot)
+    slot.granted = true
+    incr("active", 1)
+    incr("active:" .. slot.host, 1)
+    ngx.ctx.tpc_slot = slot
+    metrics.observe("webdav_tpc_queue_wait_seconds", "", ngx.now() - slot.enqueued)
+end
+
+---@type function
+---@param slot TransferSlot
+---@return string? err
+local function enter(slot)
+    local queue, changed = load_queue()
+    if may_start(queue, nil, slot.host) then
+        take(slot)
+        return changed and save_queue(queue) or nil
+    end
+    if #queue >= config.data.tpc_queue_size then
+        return (changed and save_queue(queue)) or "too many transfers queued"
+    end
+    table.insert(queue, {
+        ticket = slot.ticket,
+        host = slot.host,
+        priority = slot.priority,
+        expires = ngx.now() + config.data.tpc_queue_timeout + 60,
+    })
+    metrics.incr("webdav_tpc_queued", "")
+    return save_queue(queue)
+end
+
+---@type function
+---@param slot TransferSlot
+---@param leave boolean leave the queue even if there is no slot
+---@return string? err
+local function poll(slot, leave)
+    local queue, changed = load_queue()
+    local start = not leave and may_start(queue, slot.ticket)
+    if start or leave then
+        for i, waiter in ipairs(queue) do
+            if waiter.ticket == slot.ticket then
+                table.remove(queue, i)
+                metrics.incr("webdav_tpc_queued", "", -1)
+                changed = true
+                break
+            end
+        end
+        if start then
+            take(slot)
+        end
+    end
+    -- only a change wakes up the other waiters
+    return changed and save_queue(queue) or nil
+end
+
+---@type function
+---@param remote_uri string the source of a pull or destination of a push
+---@param scitag string? the SciTag header
+---@return TransferSlot? slot, string? err
+---Ask for a slot to run a transfer with remote_uri
+---If one is free the slot is granted, otherwise it is queued and the caller must
+---call tpcsched.wait. Fails if the queue is full.
+function tpcsched.enter(remote_uri, scitag)
+    local parsed_uri = http:parse_uri(remote_uri)
+    local slot = {
+        ticket = ngx.shared.tpc_scheduler:incr("ticket", 1, 0),
+        host = parsed_uri and parsed_uri[2] or "",
+        priority = tonumber(config.data.tpc_scitag_priority[scitag or ""]) or 0,
+        granted = false,
+        enqueued = ngx.now(),
+    }
+    local err = with_lock(enter, slot)
+    if err then
+        return nil, err
+    end
+    return slot
+end
+
+---@type function
+---@param slot TransferSlot
+---@param on_poll fun(now: number): boolean called while waiting, e.g. to send perf markers,
+---returning false if the client went away
+---@return string? err
+---Wait in the queue until the slot is granted, at most tpc_queue_timeout seconds
+---A waiter whose client went away leaves the queue right away, so that it
+---does not hold up the ones behind it until it expires.
+function tpcsched.wait(slot, on_poll)
+    local deadline = slot.enqueued + config.data.tpc_queue_timeout
+    local generation = nil
+    local next_poll = 0
+    while not slot.granted do
+        local now = ngx.now()
+        if now >= deadline then
+            local err = with_lock(poll, slot, true)
+            if err then
+                ngx.log(ngx.ERR, err)
+            end
+            return string.format("no transfer slot after %d seconds in the queue", config.data.tpc_queue_timeout)
+        end
+        local current = ngx.shared.tpc_scheduler:get("generation")
+        if current ~= generation or now >= next_poll then
+            generation = current
+            next_poll = now + IDLE_POLL_INTERVAL
+            local err = with_lock(poll, slot, false)
+            if err then
+                return err
+            end
+        end
+        if not slot.granted then
+            if not on_poll(now) then
+                local err = with_lock(poll, slot, true)
+                if err then
+                    ngx.log(ngx.ERR, err)
+                end
+                return "the client went away while queued"
+            end
+            ngx.sleep(config.data.tpc_queue_poll_interval)
+        end
+    end
+    return nil
+end
+
+---@type function
+---@return nil
+---Free the slot of the current request, called from log_by_lua
+function tpcsched.log()
+    local slot = ngx.ctx.tpc_slot
+    if slot then
+        ngx.ctx.tpc_slot = nil
+        incr("active", -1)
+        incr("active:" .. slot.host, -1)
+        incr("generation", 1)
+    end
+end
+
+return tpcsched
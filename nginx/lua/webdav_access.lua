@@ -1,6 +1,9 @@
 local ngx = require("ngx")
-local openidc = require("resty.openidc")
-local config = require("config")
+local fileutil = require("fileutil")
+local indexer = require("indexer")
+local jwtauth = require("jwtauth")
+local scopes = require("scopes")
+local timing = require("timing")
 
 if not ngx.var.http_authorization then
     ngx.status = ngx.HTTP_UNAUTHORIZED
@@ -9,46 +12,79 @@ if not ngx.var.http_authorization then
     return ngx.exit(ngx.OK)
 end
 
-local opts = {
-    public_key = config.data.openidc_pubkey,
-    token_signing_alg_values_expected = { "RS256" }
-}
--- call bearer_jwt_verify for OAuth 2.0 JWT validation
-local res, err = openidc.bearer_jwt_verify(opts)
+-- OAuth 2.0 JWT validation, cached per token
+local auth_start = timing.start()
+local token, err = jwtauth.verify()
+timing.stop("auth", auth_start)
 
-if err or not res then
+if err or not token then
     ngx.status = ngx.HTTP_UNAUTHORIZED
     ngx.say(err and err or "no access token provided")
     return ngx.exit(ngx.OK)
 end
+local res = token.claims
 
 -- From https://github.com/WLCG-AuthZ-WG/common-jwt-profile/blob/master/profile.md#capability-based-authorization-scope
+-- The scope claim is compiled once per token and kept with the cached claims
+if not token.scopes then
+    token.scopes = scopes.compile(res.scope)
+end
+
+local method = ngx.var.request_method
+local uri = ngx.var.request_uri
+local capability = nil
+local action = nil
 
 -- storage.read: Read data. Only applies to “online” resources such as disk (as opposed to “nearline” such as tape where the stage authorization should be used in addition).
-local is_read = ngx.var.request_method == "GET" or ngx.var.request_method == "HEAD"
-if string.find(res.scope, "storage.read:/") == nil and is_read then
-    ngx.status = ngx.HTTP_FORBIDDEN
-    ngx.say("no permission to read this resource")
-    return ngx.exit(ngx.OK)
-end
+-- storage.stage: Read the data, potentially causing data to be staged from a nearline resource to an online resource. This is a superset of storage.read.
+-- (a third-party push COPY reads the local resource, PROPFIND reads the metadata)
+if method == "GET" or method == "HEAD" or method == "PROPFIND"
+    or (method == "COPY" and ngx.var.http_destination) then
+    capability = "storage.read"
+    action = "read"
 
 -- storage.create: Upload data. This includes renaming files if the destination file does not already exist. This capability includes the creation of directories and subdirectories at the specified path, and the creation of any non-existent directories required to create the path itself. This authorization does not permit overwriting or deletion of stored data. The driving use case for a separate storage.create scope is to enable the stage-out of data from jobs on a worker node.
-local is_create = ngx.var.request_method == "PUT" or ngx.var.request_method == "COPY" or ngx.var.request_method == "MKCOL"
--- FIXME: using read permission for testing
-if string.find(res.scope, "storage.read:/") == nil and is_create then
-    ngx.status = ngx.HTTP_FORBIDDEN
-    ngx.say("no permission to create this resource")
-    return ngx.exit(ngx.OK)
+-- storage.modify: Change data. This includes renaming files, creating new files, and writing data. This permission includes overwriting or replacing stored data in addition to deleting or truncating data. This is a strict superset of storage.create.
+elseif method == "PUT" or method == "COPY" or method == "MKCOL" then
+    if fileutil.get_metadata(fileutil.get_request_local_path(), false).exists then
+        capability = "storage.modify"
+        action = "modify"
+    else
+        capability = "storage.create"
+        action = "create"
+    end
+else
+    capability = "storage.modify"
+    action = "modify"
 end
 
--- storage.modify: Change data. This includes renaming files, creating new files, and writing data. This permission includes overwriting or replacing stored data in addition to deleting or truncating data. This is a strict superset of storage.create.
-local is_modify = ngx.var.request_method == "DELETE" or ngx.var.request_method == "MOVE"
--- FIXME: using read permission for testing
-if string.find(res.scope, "storage.read:/") == nil and is_modify then
+if not scopes.allows_uri(token.scopes, capability, uri) then
     ngx.status = ngx.HTTP_FORBIDDEN
-    ngx.say("no permission to modify this resource")
+    ngx.say("no permission to " .. action .. " this resource")
     return ngx.exit(ngx.OK)
 end
 
--- storage.stage: Read the data, potentially causing data to be staged from a nearline resource to an online resource. This is a superset of storage.read.
--- TODO: implement this
+-- A COPY or MOVE within this server also writes the destination, which needs
+-- storage.create, or storage.modify to replace an existing file
+if (method == "COPY" or method == "MOVE") and ngx.var.http_destination then
+    local destination_uri, destination_localpath = fileutil.local_destination(ngx.var.http_destination)
+    if destination_uri then
+        if fileutil.get_metadata(destination_localpath, false).exists then
+            capability = "storage.modify"
+            action = "modify"
+        else
+            capability = "storage.create"
+            action = "create"
+        end
+        if not scopes.allows_uri(token.scopes, capability, destination_uri) then
+            ngx.status = ngx.HTTP_FORBIDDEN
+            ngx.say("no permission to " .. action .. " the destination")
+            return ngx.exit(ngx.OK)
+        end
+    end
+end
+
+-- files that are read may soon be asked for their checksum
+if method == "GET" or method == "HEAD" or method == "PROPFIND" then
+    indexer.prioritize(fileutil.get_request_local_path())
+end
@@ -1,9 +1,15 @@
 local ngx = require("ngx")
+local config = require("config")
+local cksumutil = require("cksumutil")
 local fileutil = require("fileutil")
 
 
 local path = fileutil.get_request_local_path()
-local want_adler32 = ngx.var.http_want_digest == "adler32"
+local want_digests = cksumutil.parse_want_digest(ngx.var.http_want_digest)
+local want_adler32 = false
+for _, name in ipairs(want_digests) do
+  want_adler32 = want_adler32 or name == "adler32"
+end
 local stat = fileutil.get_metadata(path, want_adler32)
 if not stat.exists then
   ngx.status = ngx.HTTP_NOT_FOUND
@@ -12,6 +18,23 @@ end
 
 ngx.header["Content-Length"] = string.format("%d", stat.size)
 
-if want_adler32 then
-  ngx.header["Digest"] = "adler32=" .. stat.adler32
-end
\ No newline at end of file
+if want_adler32 and stat.adler32_pending then
+  -- the checksum is still being computed in the background
+  if config.data.checksum_pending_policy == "accepted" then
+    ngx.status = ngx.HTTP_ACCEPTED
+    ngx.header["Retry-After"] = "1"
+  end
+end
+
+-- adler32 is computed if missing, other digests are only reported if stored
+local values = {}
+if want_adler32 and stat.adler32 ~= "" then
+  values.adler32 = stat.adler32
+end
+for _, name in ipairs(want_digests) do
+  if name ~= "adler32" then
+    local _, value = cksumutil.check_digest(path, name)
+    values[name] = value
+  end
+end
+ngx.header["Digest"] = cksumutil.format_digest_header(values, want_digests)
@@ -0,0 +1,20 @@
+local ngx = require("ngx")
+local fileutil = require("fileutil")
+local localcopy = require("localcopy")
+
+-- MOVE within this server, see localcopy.lua
+
+if not ngx.var.http_destination then
+    return localcopy.respond(ngx.HTTP_BAD_REQUEST, "no destination provided")
+end
+
+local uri, destination_localpath = fileutil.local_destination(ngx.var.http_destination)
+if not uri then
+    if destination_localpath then
+        return localcopy.respond(ngx.HTTP_BAD_REQUEST, destination_localpath)
+    end
+    -- moving to another server is not supported
+    return localcopy.respond(ngx.HTTP_BAD_GATEWAY, "destination is not on this server")
+end
+
+return localcopy.respond(localcopy.move(fileutil.get_request_local_path(), destination_localpath))
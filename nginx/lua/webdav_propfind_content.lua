@@ -0,0 +1,176 @@
+local ngx = require("ngx")
+local config = require("config")
+local cksumutil = require("cksumutil")
+local diskio = require("diskio")
+local fileutil = require("fileutil")
+
+-- PROPFIND with Depth 0 or 1 (RFC 4918 section 9.1)
+-- The request body is ignored and the same properties are always returned:
+-- resourcetype, getcontentlength, getlastmodified and the stored checksums,
+-- which are never computed here. A directory is listed in batches in the I/O
+-- thread pool and each batch is sent as soon as it is formatted, so the
+-- listing is never held in memory.
+-- At most propfind_max_entries entries are sent per request. If there are more,
+-- the multistatus ends with a 507 response for the directory (as in RFC 5323
+-- section 5.2) holding an nw:continuation token, which the client sends back
+-- in a Continuation header to get the next entries.
+
+local MULTISTATUS_START = '<?xml version="1.0" encoding="utf-8"?>\n'
+    .. '<d:multistatus xmlns:d="DAV:" xmlns:ns1="http://www.dcache.org/2013/webdav" xmlns:nw="urn:nginx-webdav">\n'
+local MULTISTATUS_END = '</d:multistatus>\n'
+
+---@type function
+---@param value string
+---@return string
+local function xml_escape(value)
+    return (value:gsub('[&<>"]', { ["&"] = "&amp;", ["<"] = "&lt;", [">"] = "&gt;", ['"'] = "&quot;" }))
+end
+
+---@type function
+---@param status integer
+---@param message string
+---@param condition string? precondition element, e.g. "propfind-finite-depth"
+local function exit(status, message, condition)
+    ngx.status = status
+    if condition then
+        ngx.header["Content-Type"] = 'application/xml; charset="utf-8"'
+        ngx.say('<?xml version="1.0" encoding="utf-8"?>')
+        ngx.say('<d:error xmlns:d="DAV:"><d:', condition, '/></d:error>')
+    else
+        ngx.say(message)
+    end
+    return ngx.exit(ngx.OK)
+end
+
+---@type function
+---@param href string
+---@param status string
+---@param description string
+---@param continuation string?
+---@return string
+local function status_response(href, status, description, continuation)
+    local out = {
+        "<d:response><d:href>", href, "</d:href>",
+        "<d:status>HTTP/1.1 ", status, "</d:status>",
+    }
+    if continuation then
+        table.insert(out, "<nw:continuation>" .. continuation .. "</nw:continuation>")
+    end
+    table.insert(out, "<d:responsedescription>" .. xml_escape(description) .. "</d:responsedescription>")
+    table.insert(out, "</d:response>\n")
+    return table.concat(out)
+end
+
+---@type function
+---@param out string[]
+---@param href string
+---@param entry DirectoryEntry
+---@param digest_names string[]
+---Append the response element for one file or directory to out
+local function append_response(out, href, entry, digest_names)
+    table.insert(out, "<d:response><d:href>")
+    table.insert(out, href)
+    table.insert(out, "</d:href><d:propstat><d:prop><d:displayname>")
+    table.insert(out, xml_escape(entry.name))
+    table.insert(out, "</d:displayname>")
+    if entry.is_directory then
+        table.insert(out, "<d:resourcetype><d:collection/></d:resourcetype>")
+    else
+        table.insert(out, "<d:resourcetype/><d:getcontentlength>")
+        table.insert(out, string.format("%d", entry.size))
+        table.insert(out, "</d:getcontentlength>")
+    end
+    table.insert(out, "<d:getlastmodified>")
+    table.insert(out, ngx.http_time(entry.mtime))
+    table.insert(out, "</d:getlastmodified>")
+    local checksums = cksumutil.format_digest_header(entry.digests, digest_names)
+    if checksums then
+        table.insert(out, "<ns1:Checksums>")
+        table.insert(out, xml_escape(checksums))
+        table.insert(out, "</ns1:Checksums>")
+    end
+    table.insert(out, "</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>\n")
+end
+
+ngx.req.discard_body()
+
+-- a missing Depth means infinity, which we do not support
+local depth = ngx.var.http_depth or "infinity"
+if depth ~= "0" and depth ~= "1" then
+    return exit(ngx.HTTP_FORBIDDEN, "PROPFIND with Depth infinity is not supported", "propfind-finite-depth")
+end
+
+local cookie = ngx.var.http_continuation
+if cookie and not cookie:match("^%-?%d+$") then
+    return exit(ngx.HTTP_BAD_REQUEST, "invalid Continuation header")
+end
+
+local path = fileutil.get_request_local_path()
+local href = xml_escape(ngx.var.request_uri:match("^[^?]*"))
+local xattrs = cksumutil.digest_xattrs()
+local digest_names = {}
+for _, xattr in ipairs(xattrs) do
+    if digest_names[#digest_names] ~= xattr[1] then
+        table.insert(digest_names, xattr[1])
+    end
+end
+
+local entry, err = diskio.run("stat_entry", path, xattrs)
+if err then
+    ngx.log(ngx.ERR, "PROPFIND of ", path, " failed: ", err)
+    return exit(ngx.HTTP_INTERNAL_SERVER_ERROR, err)
+end
+if not entry then
+    return exit(ngx.HTTP_NOT_FOUND, "not found")
+end
+
+ngx.status = 207
+ngx.header["Content-Type"] = 'application/xml; charset="utf-8"'
+
+local out = { MULTISTATUS_START }
+-- the directory itself is only in the first part of a listing
+if not cookie then
+    append_response(out, href, entry, digest_names)
+end
+
+if depth == "1" and entry.is_directory then
+    if href:sub(-1) ~= "/" then
+        href = href .. "/"
+    end
+    local sent = 0
+    local max_entries = config.data.propfind_max_entries
+    repeat
+        local entries
+        local count = math.min(config.data.propfind_batch_size, max_entries - sent)
+        entries, cookie, err = diskio.run("list_directory", path, cookie, count, xattrs)
+        if not entries then
+            -- the status line is gone, so report it in the multistatus
+            ngx.log(ngx.ERR, "PROPFIND of ", path, " failed: ", err)
+            table.insert(out, status_response(href, "500 Internal Server Error", err or "listing failed"))
+            break
+        end
+        for _, child in ipairs(entries) do
+            -- request paths are mapped to files without decoding (see
+            -- fileutil.get_request_local_path), so the href is the name as stored
+            local child_href = href .. xml_escape(child.name)
+            if child.is_directory then
+                child_href = child_href .. "/"
+            end
+            append_response(out, child_href, child, digest_names)
+        end
+        sent = sent + #entries
+
+        if cookie and sent >= max_entries then
+            table.insert(out, status_response(href, "507 Insufficient Storage",
+                "listing truncated after " .. sent .. " entries", cookie))
+            break
+        end
+        ngx.print(out)
+        ngx.flush(true)
+        out = {}
+    until not cookie
+end
+
+table.insert(out, MULTISTATUS_END)
+ngx.print(out)
+return ngx.exit(ngx.OK)
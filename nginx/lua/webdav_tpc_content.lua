@@ -1,15 +1,293 @@
 local http = require("resty.http")
 local config = require("config")
+local cksumutil = require("cksumutil")
+local diskio = require("diskio")
 local fileutil = require("fileutil")
+local httppool = require("httppool")
+local localcopy = require("localcopy")
+local metrics = require("metrics")
+local timing = require("timing")
+local tpcsched = require("tpcsched")
+
+local redirect_status = {
+    [301] = true,
+    [302] = true,
+    [303] = true,
+    [307] = true,
+    [308] = true,
+}
+
+---@type function
+---@param direction "pull"|"push"
+---@return nil
+---Count the transfer as active, until the request is logged (see metrics.log)
+local function start_transfer(direction)
+    metrics.incr("webdav_tpc_active", 'direction="' .. direction .. '"')
+    ngx.ctx.tpc = { direction = direction, start = ngx.now() }
+end
+
+---@type function
+---@param reason string? nil for a successful transfer
+---@param bytes integer?
+---@return nil
+---Record the outcome of the transfer for the metrics
+local function end_transfer(reason, bytes)
+    local tpc = ngx.ctx.tpc
+    tpc.result = reason and "failure" or "success"
+    tpc.reason = reason
+    tpc.bytes = bytes
+end
+
+---@type function
+---@param remote_uri string
+---@return TransferSlot? slot
+---Get a slot to transfer with remote_uri from the scheduler (see tpcsched.lua)
+---A full queue is refused with 503 before the transfer is accepted
+local function enter_scheduler(remote_uri)
+    local slot, err = tpcsched.enter(remote_uri, ngx.var.http_scitag)
+    if not slot then
+        ngx.status = ngx.HTTP_SERVICE_UNAVAILABLE
+        ngx.header["Retry-After"] = "60"
+        ngx.say(err)
+        return ngx.exit(ngx.OK)
+    end
+    return slot
+end
+
+---@type function
+---@param slot TransferSlot
+---@return boolean ok
+---Wait for the slot if it was queued, sending Queued perf markers meanwhile
+---On failure, reports it to the client
+local function wait_for_slot(slot)
+    if slot.granted then
+        return true
+    end
+    local stripes = { fileutil.new_stripe(0) }
+    local next_marker = 0
+    local start = timing.start()
+    local err = tpcsched.wait(slot, function(now)
+        if now >= next_marker then
+            next_marker = now + config.data.performance_marker_timeout
+            return fileutil.write_perfmarker(stripes, now, "Queued")
+        end
+        return true
+    end)
+    timing.stop("queue", start)
+    if err then
+        end_transfer("queue")
+        ngx.say("failure: ", err)
+        return false
+    end
+    return true
+end
 
 ---@type function
 ---@param source_uri string
----@param destination_localpath string
+---@param method string
+---@param headers table
+---@param make_body (fun(): function)?
 ---@param redirects integer?
+---@return table? httpc, table? res, string? uri_or_err
+---Connect to source_uri and send a request, following redirects
+---make_body is called for every attempt to get a fresh body iterator
+---Returns the connection, the response and the final URI, or nil and an error message
+local function request_remote(source_uri, method, headers, make_body, redirects)
+    local parsed_uri, err = http:parse_uri(source_uri)
+    if not parsed_uri then
+        return nil, nil, "failed to parse URI: " .. err
+    end
+    local scheme, host, port, path, query = table.unpack(parsed_uri)
+    if query and query ~= "" then
+        path = path .. "?" .. query
+    end
+    local httpc = nil
+    local start = timing.start()
+    httpc, err = httppool.connect(scheme, host, port)
+    timing.stop("connect", start)
+    if not httpc then
+        return nil, nil, "connection to " .. host .. ":" .. port .. " failed: " .. err
+    end
+
+    headers["Host"] = host
+    local res = nil
+    start = timing.start()
+    res, err = httpc:request({
+        method = method,
+        path = path,
+        headers = headers,
+        body = make_body and make_body(),
+    })
+    timing.stop("remote", start)
+    if not res then
+        httpc:close()
+        return nil, nil, "request to path " .. path .. " failed: " .. err
+    end
+
+    redirects = redirects or 0
+    if redirect_status[res.status] and redirects < config.data.tpc_redirect_limit then
+        httppool.discard(httpc, res)
+        return request_remote(res.headers["Location"], method, headers, make_body, redirects + 1)
+    end
+    return httpc, res, source_uri
+end
+
+---@type function
+---@param source_uri string
+---@param headers table
+---@return table? httpc, table? res, string? uri_or_err
+---Send a GET to source_uri, see request_remote
+local function open_source(source_uri, headers)
+    return request_remote(source_uri, "GET", headers)
+end
+
+---@type function
+---@param stripe Stripe
+---@param writer Writer
+---@param httpc table?
+---@param res table?
+---@param uri string
+---@param headers table
+---@return string? err
+---Receive one stripe of a striped pull into the file at the stripe's offset
+---If httpc and res are not given, a ranged GET for the stripe is sent to uri
+---On success, the adler32 of the stripe is stored in stripe.adler32
+local function pull_stripe(stripe, writer, httpc, res, uri, headers)
+    local err = nil
+    if not httpc then
+        local range_headers = {}
+        for k, v in pairs(headers) do
+            range_headers[k] = v
+        end
+        range_headers["Range"] = string.format("bytes=%d-%d", stripe.offset, stripe.offset + stripe.length - 1)
+        httpc, res, err = open_source(uri, range_headers)
+        if not httpc then
+            return err
+        end
+        if res.status ~= 206 then
+            httppool.discard(httpc, res)
+            return "rejected ranged GET: " .. res.status .. " " .. (res.reason or "")
+        end
+    end
+
+    local fork = writer:fork(stripe.offset)
+    local digest_states = nil
+    err, digest_states = fileutil.sink_to_writer(fork, res.body_reader, stripe, stripe.length)
+    local suc, close_err = fork:close()
+    if err or not suc then
+        httpc:close()
+        return err or ("failed to write to the file: " .. close_err)
+    end
+
+    if stripe.index == 0 then
+        -- the first stripe asked for the whole file, we stop reading part way
+        httpc:close()
+    else
+        httppool.release(httpc)
+    end
+    stripe.adler32 = cksumutil.adler32_value(digest_states.adler32)
+    return nil
+end
+
+---@type function
+---@param httpc table
+---@param res table
+---@param uri string
+---@param headers table
+---@param destination_localpath string
+---@param total integer
+---@param nstripes integer
+---@return string? err, string? adler32
+---Pull a source over nstripes parallel connections, each writing its range of the file
+---httpc and res are an open response for the whole file, used for the first stripe
+local function striped_pull(httpc, res, uri, headers, destination_localpath, total, nstripes)
+    local writer, err = fileutil.open_file_writer(destination_localpath, total)
+    if not writer then
+        httpc:close()
+        return err
+    end
+
+    local stripe_size = math.ceil(total / nstripes)
+    local stripes = {}
+    for i = 1, nstripes do
+        local offset = (i - 1) * stripe_size
+        stripes[i] = fileutil.new_stripe(i - 1, offset, math.min(stripe_size, total - offset))
+    end
+
+    local reporter = fileutil.start_perfmarkers(stripes)
+    local threads = {}
+    for i = 1, nstripes do
+        if i == 1 then
+            threads[i] = ngx.thread.spawn(pull_stripe, stripes[i], writer, httpc, res, uri, headers)
+        else
+            threads[i] = ngx.thread.spawn(pull_stripe, stripes[i], writer, nil, nil, uri, headers)
+        end
+    end
+
+    -- Wait for every stripe, even after a failure, since they share the file
+    for i = 1, nstripes do
+        local ok, stripe_err = ngx.thread.wait(threads[i])
+        if not ok or stripe_err then
+            if not err then
+                err = "stripe " .. (i - 1) .. ": " .. tostring(stripe_err)
+            end
+            for j = 1, nstripes do
+                stripes[j].cancelled = true
+            end
+        end
+    end
+    ngx.thread.kill(reporter)
+    if err then
+        fileutil.abort_file(writer)
+        return err
+    end
+
+    local adler = stripes[1].adler32
+    for i = 2, nstripes do
+        adler = cksumutil.adler32_combine(adler, stripes[i].adler32, stripes[i].length)
+    end
+    local adler32 = cksumutil.adler32_format(adler)
+    -- only adler32 can be combined from the stripes
+    err = fileutil.commit_file(writer, { adler32 = adler32 }, total)
+    if err then
+        return err
+    end
+    return nil, adler32
+end
+
+---@type function
+---@param err string?
+---@param adler32 string?
+---@param res table
+---@param verify_checksum boolean
+---@param destination_localpath string
 ---@return nil
-local function third_party_pull(source_uri, destination_localpath, redirects)
-    local httpc = http.new()
+---Report the outcome of a pull to the client, verifying the checksum against the source
+local function finish_pull(err, adler32, res, verify_checksum, destination_localpath)
+    if not adler32 then
+        end_transfer("transfer")
+        ngx.say("failure: error while receiving data: ", err)
+        return ngx.exit(ngx.OK)
+    end
+
+    if verify_checksum then
+        local source_adler32 = (res.headers["Digest"] or "adler32=(missing)"):sub(9)
+        if source_adler32 ~= adler32 then
+            end_transfer("checksum")
+            ngx.say("failure: adler32 checksum mismatch: source ", source_adler32, " desination ", adler32)
+            return ngx.exit(ngx.OK)
+        end
+    end
 
+    end_transfer(nil, fileutil.get_metadata(destination_localpath, false).size)
+    ngx.say("success: Created")
+end
+
+---@type function
+---@param source_uri string
+---@param destination_localpath string
+---@return nil
+local function third_party_pull(source_uri, destination_localpath)
     -- RequireChecksumVerification is by default true
     -- when false we don't error when the remote server fails to provide
     -- an RFC 3230 compliant checksum in the response headers
@@ -21,35 +299,19 @@ local function third_party_pull(source_uri, destination_localpath, redirects)
     -- SciTag is an optional header that can be used to label the traffic
     -- for monitoring purposes, either via a UDP "firefly" packet or a IPv6 flow label
     -- TODO: implement these
-    if ngx.var.http_scitag then
-        local scitag = tonumber(ngx.var.http_scitag)
-    end
+    -- For now it only sets the priority in the transfer queue (see tpc_scitag_priority)
+    local slot = enter_scheduler(source_uri)
 
     -- At this point we have accepted the request and will report
     -- errors according to the text/perf-marker-stream format
     ngx.status = ngx.HTTP_ACCEPTED
     ngx.header["Content-Type"] = "text/perf-marker-stream"
-
-    -- First establish a connection
-    local parsed_uri, err = httpc:parse_uri(source_uri)
-    if not parsed_uri then
-        ngx.say("failure: failed to parse URI: " .. err)
-        return ngx.exit(ngx.OK)
-    end
-    local scheme, host, port, path = table.unpack(parsed_uri)
-    local ok, err, ssl_session = httpc:connect({
-        scheme = scheme,
-        host = host,
-        port = port,
-        ssl_verify = true,
-    })
-    if not ok then
-        ngx.say("failure: connection to " .. host .. ":" .. port .. " failed: " .. err)
+    start_transfer("pull")
+    if not wait_for_slot(slot) then
         return ngx.exit(ngx.OK)
     end
 
     local headers = {
-        ["Host"] = host,
         ["User-Agent"] = "nginx-webdav-prototype/0.0.1", -- TODO: version from config
     }
     if verify_checksum then
@@ -58,69 +320,189 @@ local function third_party_pull(source_uri, destination_localpath, redirects)
     if ngx.var.http_transferheaderauthorization then
         headers["Authorization"] = ngx.var.http_transferheaderauthorization
     end
-    local res = nil
-    res, err = httpc:request({
-        path = path,
-        headers = headers,
-    })
-    if not res then
-        ngx.say("failure: request to path " .. path .. " failed: " .. err)
-        return ngx.exit(ngx.OK)
-    end
 
-    local is_redirect = res.status == 301 or res.status == 302 or res.status == 303 or res.status == 307 or res.status == 308
-    redirects = redirects or 0
-    if is_redirect and redirects < config.data.tpc_redirect_limit then
-        return third_party_pull(res.headers["Location"], destination_localpath, redirects + 1)
+    -- To decide whether to stripe, we ask for the whole file as a range: a server
+    -- supporting ranges tells us the total size in Content-Range, others reply 200
+    local striping = config.data.tpc_stripes > 1
+    if striping then
+        headers["Range"] = "bytes=0-"
+    end
+    local httpc, res, uri = open_source(source_uri, headers)
+    if httpc and res.status == 416 then
+        -- e.g. an empty file, try again without the range
+        httppool.discard(httpc, res)
+        headers["Range"] = nil
+        httpc, res, uri = open_source(source_uri, headers)
+    end
+    headers["Range"] = nil
+    if not httpc then
+        end_transfer("connection")
+        ngx.say("failure: " .. uri)
+        return ngx.exit(ngx.OK)
     end
 
-    if res.status ~= 200 then
+    if res.status ~= 200 and res.status ~= 206 then
+        end_transfer("rejected")
+        httppool.discard(httpc, res)
         ngx.status = res.status
         ngx.say("failure: rejected GET: ", res.reason)
         return ngx.exit(res.status)
     end
 
-    local adler32 = nil
-    err, adler32 = fileutil.sink_to_file(destination_localpath, res.body_reader, true)
+    local nstripes = 1
+    if res.status == 206 then
+        local total = tonumber((res.headers["Content-Range"] or ""):match("^bytes 0%-%d+/(%d+)$"))
+        if not total then
+            end_transfer("protocol")
+            httpc:close()
+            ngx.say("failure: unexpected Content-Range: ", res.headers["Content-Range"])
+            return ngx.exit(ngx.OK)
+        end
+        nstripes = math.min(config.data.tpc_stripes, math.floor(total / config.data.tpc_stripe_min_size))
+        if nstripes > 1 then
+            local err, adler32 = striped_pull(httpc, res, uri, headers, destination_localpath, total, nstripes)
+            return finish_pull(err, adler32, res, verify_checksum, destination_localpath)
+        end
+    end
 
-    if not adler32 then
-        ngx.say("failure: error while receiving data: ", err)
+    local size = tonumber(res.headers["Content-Length"])
+    local err, adler32 = fileutil.sink_to_file(destination_localpath, res.body_reader, true, nil, size)
+    if adler32 then
+        -- this allows the connection to be reused by other requests
+        httppool.release(httpc)
+    else
+        httpc:close()
+    end
+    return finish_pull(err, adler32, res, verify_checksum, destination_localpath)
+end
+
+---@type function
+---@param destination_uri string
+---@param source_localpath string
+---@return nil
+local function third_party_push(destination_uri, source_localpath)
+    local verify_checksum = true
+    if ngx.var.http_requirechecksumverification == "false" then
+        verify_checksum = false
+    end
+
+    local metadata = fileutil.get_metadata(source_localpath, false)
+    if not metadata.exists or metadata.is_directory then
+        ngx.status = ngx.HTTP_NOT_FOUND
+        ngx.say("source file not found")
+        return ngx.exit(ngx.OK)
+    end
+
+    local slot = enter_scheduler(destination_uri)
+
+    -- At this point we have accepted the request and will report
+    -- errors according to the text/perf-marker-stream format
+    ngx.status = ngx.HTTP_ACCEPTED
+    ngx.header["Content-Type"] = "text/perf-marker-stream"
+    start_transfer("push")
+    if not wait_for_slot(slot) then
         return ngx.exit(ngx.OK)
     end
 
+    local headers = {
+        ["User-Agent"] = "nginx-webdav-prototype/0.0.1", -- TODO: version from config
+        ["Content-Length"] = string.format("%d", metadata.size),
+    }
     if verify_checksum then
-        local source_adler32 = (res.headers["Digest"] or "adler32=(missing)"):sub(9)
-        if source_adler32 ~= adler32 then
-            ngx.say("failure: adler32 checksum mismatch: source ", source_adler32, " desination ", adler32)
-            return ngx.exit(ngx.OK)
-        end
+        headers["Want-Digest"] = "adler32"
+    end
+    if ngx.var.http_transferheaderauthorization then
+        headers["Authorization"] = ngx.var.http_transferheaderauthorization
     end
 
-    ngx.say("success: Created")
+    -- The body is streamed from disk, reading ahead in the thread pool
+    -- while the previous block is being sent. A redirect restarts it.
+    local stripes = {}
+    local reader = nil
+    local read_err = nil
+    local adler_state = nil
+    local function make_body()
+        if reader then
+            reader:close()
+        end
+        local stripe = fileutil.new_stripe(0)
+        stripes[1] = stripe
+        adler_state = cksumutil.adler32_initialize()
+        reader, read_err = diskio.open_reader(source_localpath, metadata.size, config.data.tpc_push_block_size)
+        return function()
+            if not reader then
+                -- abort the request rather than sending a short body
+                error(read_err)
+            end
+            local data, err = reader:read()
+            if err then
+                read_err = err
+                error(err)
+            end
+            if data then
+                stripe.bytes = stripe.bytes + #data
+                stripe.last_transferred = ngx.now()
+                cksumutil.adler32_increment(adler_state, data)
+            end
+            return data
+        end
+    end
 
-    -- this allows the connection to be reused by other requests
-    ok, err = httpc:set_keepalive()
-    if not ok then
-        ngx.log(ngx.ERR, "failed to set keepalive on remote connection: ", err)
+    local reporter = fileutil.start_perfmarkers(stripes)
+    local ok, httpc, res, uri = pcall(request_remote, destination_uri, "PUT", headers, make_body)
+    ngx.thread.kill(reporter)
+    if reader then
+        reader:close()
+    end
+    if not ok or not httpc then
+        end_transfer(read_err and "read" or "connection")
+        ngx.say("failure: ", read_err or (ok and uri) or httpc)
         return ngx.exit(ngx.OK)
     end
+    -- any response body is read and discarded so the connection can be reused
+    httppool.discard(httpc, res)
+    if res.status ~= 200 and res.status ~= 201 and res.status ~= 204 then
+        end_transfer("rejected")
+        ngx.say("failure: rejected PUT: ", res.status, " ", res.reason)
+        return ngx.exit(ngx.OK)
+    end
+
+    if verify_checksum then
+        -- compare with the stored checksum, or what we computed while sending
+        local _, adler32 = cksumutil.check_adler32(source_localpath)
+        adler32 = adler32 or cksumutil.adler32_to_string(adler_state)
+        local remote_adler32 = (res.headers["Digest"] or "adler32=(missing)"):sub(9)
+        if remote_adler32 ~= adler32 then
+            end_transfer("checksum")
+            ngx.say("failure: adler32 checksum mismatch: source ", adler32, " destination ", remote_adler32)
+            return ngx.exit(ngx.OK)
+        end
+    end
+
+    end_transfer(nil, metadata.size)
+    ngx.say("success: Created")
 end
 
 
 if ngx.var.request_method == "COPY" then
     -- The COPY method is supported by ngx_http_dav_module but only for files on the same server.
-    -- We intercept the method here to support third-party push copy.
+    -- We intercept the method here to support third-party copy.
+    if ngx.var.http_destination then
+        -- a destination on this server is copied locally
+        local uri, destination_localpath = fileutil.local_destination(ngx.var.http_destination)
+        if uri then
+            return localcopy.respond(localcopy.copy(fileutil.get_request_local_path(), destination_localpath))
+        elseif destination_localpath then
+            return localcopy.respond(ngx.HTTP_BAD_REQUEST, destination_localpath)
+        end
+        return third_party_push(ngx.var.http_destination, fileutil.get_request_local_path())
+    end
+
     if not ngx.var.http_source then
         ngx.status = ngx.HTTP_BAD_REQUEST
         ngx.say("no source provided")
         return ngx.exit(ngx.OK)
     end
 
-    if ngx.var.http_destination then
-        ngx.status = ngx.HTTP_NOT_ALLOWED
-        ngx.say("third-party push copy not implemented")
-        return ngx.exit(ngx.OK)
-    end
-
     third_party_pull(ngx.var.http_source, fileutil.get_request_local_path())
-end
\ No newline at end of file
+end
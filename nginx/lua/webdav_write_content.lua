@@ -1,7 +1,14 @@
 local ngx = require("ngx")
 local config = require("config")
 local http = require("resty.http")
+local cksumutil = require("cksumutil")
+local diskio = require("diskio")
+local dircache = require("dircache")
 local fileutil = require("fileutil")
+local metacache = require("metacache")
+local metrics = require("metrics")
+local partialput = require("partialput")
+local timing = require("timing")
 
 local file_path = fileutil.get_request_local_path()
 local metadata = fileutil.get_metadata(file_path, false)
@@ -12,7 +19,11 @@ if ngx.var.request_method == "DELETE" then
         ngx.say("file not found")
         return ngx.exit(ngx.OK)
     end
+    metacache.invalidate(file_path)
     local suc, err = os.remove(file_path)
+    if metadata.is_directory then
+        dircache.invalidate()
+    end
     if not suc then
         ngx.status = ngx.HTTP_INTERNAL_SERVER_ERROR
         ngx.say("failed to delete file: ", err)
@@ -21,7 +32,7 @@ if ngx.var.request_method == "DELETE" then
     ngx.status = ngx.HTTP_NO_CONTENT
     ngx.say("file deleted")
     return ngx.exit(ngx.OK)
--- TODO: implement MOVE, MKCOL?
+-- MOVE goes to webdav_move_content.lua. TODO: implement MKCOL? PUT makes parent directories
 elseif ngx.var.request_method ~= "PUT" then
     ngx.status = ngx.HTTP_NOT_ALLOWED
     ngx.say("only PUT and DELETE method is allowed to this endpoint")
@@ -34,77 +45,160 @@ if metadata.is_directory then
     return ngx.exit(ngx.OK)
 end
 
--- After acquiring the raw socket, we cannot update the status
--- So set it to OK
-ngx.status = 200
-
-local sock, err = ngx.req.socket(true)
-if not sock then
-    ngx.status = ngx.HTTP_INTERNAL_SERVER_ERROR
-    ngx.say("failed to get the request socket: " .. err)
-    return ngx.exit(ngx.OK)
-end
-
--- From this point on, we are in charge of sending the http response to the client
--- this is the price we pay for raw socket since the wrapped socket does not support
--- chunked body encoding
-
--- This allows clients to be sure the body will be accepted before committing to sending it
-if ngx.var.http_expect == "100-continue" then
-    sock:send("HTTP/1.1 100 Continue\r\n\r\n")
-end
-
 ---@type function
 ---@param status integer
 ---@param message string?
 ---@param digest string?
-local function exit(status, message, digest)
-    local status_strings = {
-        [200] = "OK",
-        [201] = "Created",
-        [204] = "No Content",
-        [400] = "Bad Request",
-        [500] = "Internal Server Error",
-    }
-    local response = {
-        string.format("HTTP/1.1 %d %s\r\n", status, status_strings[status]),
-        "Connection: close\r\n",
-    }
-    if status == 204 then
+---@param ranges string?
+---Send the response, keeping the connection alive for the next request
+---Error responses close the connection instead, since the rest of the request
+---body may still be on its way and could not be told apart from a next request.
+local function exit(status, message, digest, ranges)
+    ngx.status = status
+    -- closing may leave 444 in ngx.status, see timing.status
+    ngx.ctx.status = status
+    if digest then
+        ngx.header["Digest"] = digest
+    end
+    if ranges then
+        ngx.header["Range"] = ranges
+    end
+    if status == ngx.HTTP_NO_CONTENT then
         -- No Content should not have a body
         message = nil
     end
-    if digest then
-        table.insert(response, string.format("Digest: %s\r\n", digest))
-    end
     if message then
         message = message .. "\n"
-        table.insert(response, string.format("Content-Length: %d\r\n", #message))
-        table.insert(response, "Content-Type: text/plain\r\n")
-        table.insert(response, "\r\n")
-        table.insert(response, message)
-    else
-        table.insert(response, "\r\n")
+        ngx.header["Content-Type"] = "text/plain"
+        ngx.header["Content-Length"] = #message
+        ngx.print(message)
     end
-    sock:send(response)
+    if status >= ngx.HTTP_BAD_REQUEST then
+        ngx.flush(true)
+        return ngx.exit(ngx.HTTP_CLOSE)
+    end
+    return ngx.exit(ngx.OK)
 end
 
-local reader = http.get_client_body_reader(nil, nil, sock)
+---@type function
+---@return (fun(max_chunk_size:integer): string?, string?)? reader, string? err, string? body_file
+---A reader for a chunked request body received whole by nginx
+---The request socket only streams Content-Length bodies, and the raw one would
+---cost the keep-alive, so nginx receives the body, into memory or, if larger than
+---client_body_buffer_size, into a file in client_body_temp_path, which is on the
+---same disk as the data and is returned too (see fileutil.sink_body_file).
+local function spooled_body_reader()
+    local start = timing.start()
+    ngx.req.read_body()
+    timing.stop("recv", start)
+    local data = ngx.req.get_body_data()
+    if data then
+        local offset = 1
+        return function(max_chunk_size)
+            if offset > #data then
+                return nil
+            end
+            local chunk = data:sub(offset, offset + max_chunk_size - 1)
+            offset = offset + #chunk
+            return chunk
+        end
+    end
+    local body_file = ngx.req.get_body_file()
+    if not body_file then
+        -- empty body
+        return function() return nil end
+    end
+    local file, err = diskio.open_reader(body_file, fileutil.get_metadata(body_file, false).size,
+        config.data.receive_buffer_size)
+    if not file then
+        return nil, err
+    end
+    local pending = ""
+    return function(max_chunk_size)
+        if #pending == 0 then
+            local chunk, read_err = file:read()
+            if not chunk then
+                file:close()
+                return nil, read_err
+            end
+            pending = chunk
+        end
+        local chunk = pending:sub(1, max_chunk_size)
+        pending = pending:sub(max_chunk_size + 1)
+        return chunk
+    end, nil, body_file
+end
+
+-- decremented when the request is logged, see metrics.log
+metrics.incr("webdav_active_uploads", "")
+ngx.ctx.active_upload = true
+
+local reader, err, body_file = nil, nil, nil
+local transfer_encoding = ngx.var.http_transfer_encoding
+if transfer_encoding and transfer_encoding:lower():find("chunked", 1, true) then
+    reader, err, body_file = spooled_body_reader()
+elseif (tonumber(ngx.var.http_content_length) or 0) == 0 then
+    reader = function() return nil end
+else
+    -- Content-Length bodies are streamed from the (non-raw) request socket,
+    -- so nginx still handles Expect: 100-continue and keep-alive
+    reader, err = http.get_client_body_reader(nil, config.data.receive_buffer_size)
+end
 if not reader then
-    return exit(ngx.HTTP_INTERNAL_SERVER_ERROR, "failed to get the request body reader")
+    return exit(ngx.HTTP_INTERNAL_SERVER_ERROR, "failed to get the request body reader: " .. tostring(err))
 end
 
-local adler32 = nil
-err, adler32 = fileutil.sink_to_file(file_path, reader)
+local want_digests = cksumutil.parse_want_digest(ngx.var.http_want_digest)
+
+-- A PUT with Content-Range uploads one part of the file, see partialput.lua
+-- Until the file is complete, the reply is 202 with the ranges received so far
+if ngx.var.http_content_range then
+    local first, last, total
+    first, last, total, err = partialput.parse_content_range(ngx.var.http_content_range)
+    if err then
+        return exit(ngx.HTTP_BAD_REQUEST, err)
+    end
+    local conflict, ranges, adler32 = nil, nil, nil
+    if first then
+        local content_length = tonumber(ngx.var.http_content_length)
+        if content_length and content_length ~= last - first + 1 then
+            return exit(ngx.HTTP_BAD_REQUEST, "Content-Length does not match Content-Range")
+        end
+        err, conflict, ranges, adler32 = partialput.sink_range(file_path, reader, first, last, total)
+    else
+        err, ranges = partialput.status(file_path, total)
+        conflict = err ~= nil
+    end
+    if conflict then
+        return exit(ngx.HTTP_CONFLICT, err)
+    elseif err then
+        return exit(ngx.HTTP_INTERNAL_SERVER_ERROR, err)
+    elseif not adler32 then
+        return exit(ngx.HTTP_ACCEPTED, "upload incomplete", nil, ranges)
+    end
+
+    local digest = cksumutil.format_digest_header({ adler32 = adler32 }, want_digests)
+    if metadata.exists then
+        return exit(ngx.HTTP_NO_CONTENT, nil, digest)
+    end
+    return exit(ngx.HTTP_CREATED, "file created", digest)
+end
+
+-- Digests asked for are computed while receiving, along with the configured ones
+local adler32, digest_values = nil, nil
+if body_file then
+    err, adler32, digest_values = fileutil.sink_body_file(file_path, body_file, reader,
+        cksumutil.upload_digests(want_digests))
+else
+    err, adler32, digest_values = fileutil.sink_to_file(file_path, reader, false,
+        cksumutil.upload_digests(want_digests), tonumber(ngx.var.http_content_length))
+end
 if err then
     -- TODO: choose more appropriate status code based on error
     return exit(ngx.HTTP_INTERNAL_SERVER_ERROR, err)
 end
 
-local digest = nil
-if ngx.var.http_want_digest == "adler32" then
-    digest = string.format("adler32=%s", adler32)
-end
+local digest = cksumutil.format_digest_header(digest_values, want_digests)
 
 if metadata.exists then
     return exit(ngx.HTTP_NO_CONTENT)
@@ -1,15 +1,20 @@
+import contextlib
 import datetime
 import json
 import os
 import random
+import re
 import time
 import socket
 import subprocess
 import uuid
 import logging
+import zlib
 
 from dataclasses import dataclass
-from typing import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import Callable, Iterator, Optional
 
 import httpx
 import jwt
@@ -18,8 +23,64 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 
+from .util import NginxServer
+
 logger = logging.getLogger()
 
+SEGMENTED_DATA = bytes(range(256)) * 4099
+# config.json keys of setup_server that servers with the production defaults
+# keep, see start_nginx_server
+PRODUCTION_KEYS = ("openidc_pubkey", "health_check_id", "upload_durability", "upload_drop_cache")
+
+
+def pytest_addoption(parser: pytest.Parser):
+    group = parser.getgroup("benchmark", "nginx-webdav benchmarks (see test_benchmark.py)")
+    group.addoption(
+        "--benchmark",
+        metavar="PATH",
+        help="run the benchmarks and write their results to this JSON file",
+    )
+    group.addoption(
+        "--benchmark-baseline",
+        metavar="PATH",
+        help="fail if the results regressed from those in this JSON file",
+    )
+    group.addoption(
+        "--benchmark-tolerance",
+        type=float,
+        default=0.1,
+        help="relative change in throughput or p99 latency that counts as a regression",
+    )
+    group.addoption(
+        "--benchmark-max-bytes",
+        type=int,
+        default=2 * 1024**3,
+        help="skip cases that would keep more than this many bytes on the server",
+    )
+    parser.addoption(
+        "--tmpfs-size",
+        default="100M",
+        help="size of the test server's storage, e.g. 8G for the benchmarks",
+    )
+    parser.addoption(
+        "--storage-dir",
+        metavar="PATH",
+        help="store the test server's data in this (empty, world-writable) host "
+        "directory instead of a tmpfs, e.g. to benchmark --upload-durability",
+    )
+    parser.addoption(
+        "--upload-durability",
+        choices=["none", "fsync", "writeback"],
+        default="none",
+        help="the test server's upload_durability, see nginx/lua/config.lua",
+    )
+    parser.addoption(
+        "--upload-drop-cache",
+        action="store_true",
+        help="set the test server's upload_drop_cache",
+    )
+
+
 @dataclass
 class MockIdP:
     public_key_pem: str
@@ -73,6 +134,20 @@ def _wlcg_token(oidc_mock_idp: MockIdP, scope: str) -> str:
     return oidc_mock_idp.encode_jwt(token)
 
 
+@pytest.fixture(scope="session")
+def wlcg_header(oidc_mock_idp: MockIdP) -> Callable[[str], dict[str, str]]:
+    """Make the headers of a request with a WLCG token of the given scope
+
+    For tests that need narrower scopes than the fixtures below, e.g.
+    wlcg_header("openid storage.read:/public").
+    """
+
+    def make(scope: str) -> dict[str, str]:
+        return {"Authorization": f"Bearer {_wlcg_token(oidc_mock_idp, scope)}"}
+
+    return make
+
+
 @pytest.fixture(scope="session")
 def wlcg_read_header(oidc_mock_idp: MockIdP) -> dict[str, str]:
     """A WLCG token with read access to /
@@ -118,7 +193,8 @@ def wlcg_modify_header(oidc_mock_idp: MockIdP) -> dict[str, str]:
 
 
 @pytest.fixture(scope="session")
-def setup_server(oidc_mock_idp: MockIdP):
+def setup_server(oidc_mock_idp: MockIdP, request: pytest.FixtureRequest) -> Iterator[dict]:
+    """Build the image, yielding the config.json it contains"""
     # Make sure we are in the right place: one up from tests/
     assert os.getcwd() == os.path.dirname(os.path.dirname(__file__))
 
@@ -126,11 +202,29 @@ def setup_server(oidc_mock_idp: MockIdP):
     config = {
         "openidc_pubkey": oidc_mock_idp.public_key_pem,
         "receive_buffer_size": 4096,
+        "io_buffer_pool_size": 8,
         # Give the container a (hopefully) unique ID that is returned in a
         # health check so that we can verify that the service we started is the
         # same one we're connecting to
         "health_check_id": random.randint(0, 1024*1024*1024),
         "performance_marker_timeout": 2,
+        # stripe the test peer's bigdata.bin.*ranges* sources
+        "tpc_stripes": 4,
+        "tpc_stripe_min_size": 1024,
+        # queue a third transfer from the test peer, see test_tpc_pull_queued
+        "tpc_max_active_per_host": 2,
+        # checksum files without a stored adler32 in 64 KiB segments
+        "checksum_segment_size": 64 * 1024,
+        # list directories in several batches and responses, see test_propfind.py
+        "propfind_max_entries": 5,
+        "propfind_batch_size": 2,
+        # Server-Timing headers and JSON access log lines, see test_put_timing
+        "request_timing": True,
+        "json_access_log": True,
+        # look for stale temporary uploads every second, see test_stale_upload_removed
+        "stale_upload_sweep_interval": 1,
+        "upload_durability": request.config.getoption("--upload-durability"),
+        "upload_drop_cache": request.config.getoption("--upload-drop-cache"),
     }
     with open("nginx/lua/config.json", "w") as f:
         json.dump(config, f)
@@ -140,18 +234,24 @@ def setup_server(oidc_mock_idp: MockIdP):
         ["podman", "build", "-t", "nginx-webdav", "nginx", "-f", "nginx.dockerfile"]
     )
 
-    yield
+    yield config
 
     # Clean up
     os.remove("nginx/lua/config.json")
 
 
-@pytest.fixture(scope="module")
-def nginx_server(setup_server) -> Iterator[str]:
-    """A running nginx-webdav server for testing
+@contextlib.contextmanager
+def run_container(
+    request: pytest.FixtureRequest,
+    port: int = 8080,
+    config_path: Optional[str] = None,
+    storage_dir: Optional[str] = None,
+) -> Iterator[str]:
+    """Run the nginx-webdav image, yielding the container ID once it is up
 
-    It's nice to have a module-scoped fixture for the server, so we can
-    reduce the number of irrelevant log messages in the test output.
+    The server is published on port. With config_path, that config.json is
+    used instead of the one in the image, and with storage_dir, the data is
+    kept there instead of in a tmpfs.
     """
     # Start podman container
     podman_cmd = [
@@ -159,10 +259,17 @@ def nginx_server(setup_server) -> Iterator[str]:
         "run",
         "-d",
         "-p",
-        "8080:8080",
-        "--tmpfs",
-        "/var/www/webdav:rw,size=100M,mode=1777",
+        f"{port}:8080",
     ]
+    if config_path:
+        podman_cmd += ["-v", f"{os.path.abspath(config_path)}:/etc/nginx/lua/config.json:ro"]
+    if storage_dir:
+        podman_cmd += ["-v", f"{os.path.abspath(storage_dir)}:/var/www/webdav:rw"]
+    else:
+        podman_cmd += [
+            "--tmpfs",
+            f"/var/www/webdav:rw,size={request.config.getoption('--tmpfs-size')},mode=1777",
+        ]
     podman_cmd.append("nginx-webdav")
     container_id = subprocess.check_output(podman_cmd).decode().strip()
 
@@ -179,21 +286,234 @@ def nginx_server(setup_server) -> Iterator[str]:
         stderr=subprocess.DEVNULL,
         check=True,
     )
+    # a larger file without a stored checksum, see test_head.py
+    subprocess.run(
+        [
+            "podman",
+            "exec",
+            "-i",
+            container_id,
+            "dd",
+            "of=/var/www/webdav/segmented.bin",
+        ],
+        input=SEGMENTED_DATA,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
 
     # Wait for the container to start
     for _ in range(10):
         try:
             time.sleep(0.1)
-            httpx.get("http://localhost:8080/webdav_health/")
+            httpx.get(f"http://localhost:{port}/webdav_health/")
             break
         except httpx.HTTPError:
             pass
 
-    yield "http://localhost:8080/webdav"
+    try:
+        yield container_id
+    finally:
+        # Dump container logs
+        subprocess.check_call(["podman", "logs", container_id])
+
+        # Stop podman container and clean up
+        subprocess.check_call(["podman", "stop", container_id], stdout=subprocess.DEVNULL)
+        subprocess.check_call(["podman", "rm", container_id], stdout=subprocess.DEVNULL)
+
+
+@pytest.fixture(scope="module")
+def nginx_container(setup_server, request: pytest.FixtureRequest) -> Iterator[str]:
+    """The podman container ID of nginx_server, e.g. to look at its files
+
+    It's nice to have a module-scoped fixture for the server, so we can
+    reduce the number of irrelevant log messages in the test output.
+    """
+    storage_dir = request.config.getoption("--storage-dir")
+    with run_container(request, storage_dir=storage_dir) as container_id:
+        yield container_id
+
+
+@pytest.fixture(scope="module")
+def nginx_server(nginx_container: str) -> str:
+    """A running nginx-webdav server for testing"""
+    return "http://localhost:8080/webdav"
+
+
+@pytest.fixture(scope="module")
+def start_nginx_server(
+    setup_server: dict,
+    request: pytest.FixtureRequest,
+    tmp_path_factory: pytest.TempPathFactory,
+) -> Iterator[Callable[..., NginxServer]]:
+    """Start another server with some config.json values changed
+
+    The servers run on ports from 8090 up, with their data in a tmpfs or in
+    storage_dir, until the end of the module. They can run next to
+    nginx_server. With test_settings=False, the changes apply to the config.lua
+    defaults instead of the test settings of setup_server, as in production;
+    only the keys the tests need to talk to the server and the --upload-*
+    options are kept.
+    """
+    with contextlib.ExitStack() as stack:
+        servers: list[NginxServer] = []
+
+        def start(
+            changes: dict, test_settings: bool = True, storage_dir: Optional[str] = None
+        ) -> NginxServer:
+            port = 8090 + len(servers)
+            if test_settings:
+                config = {**setup_server, **changes}
+            else:
+                config = {**{key: setup_server[key] for key in PRODUCTION_KEYS}, **changes}
+            config_path = tmp_path_factory.mktemp("config") / "config.json"
+            config_path.write_text(json.dumps(config))
+            container_id = stack.enter_context(
+                run_container(
+                    request, port=port, config_path=str(config_path), storage_dir=storage_dir
+                )
+            )
+            servers.append(
+                NginxServer(f"http://localhost:{port}/webdav", container_id, config)
+            )
+            return servers[-1]
+
+        yield start
+
+
+class PeerHandler(BaseHTTPRequestHandler):
+    """The remote end of third-party copies, see peer_server
+
+    Every request needs "Authorization: Bearer opensesame".
+    """
+
+    # files received by PUT, keyed by path
+    uploads: dict[str, bytes] = {}
+    # files served by GET, with ranges, keyed by path: (block, size, adler32)
+    # of size bytes that repeat block, so that large files need not be in memory
+    generated: dict[str, tuple[bytes, int, int]] = {}
+
+    def _auth(self):
+        if "Authorization" not in self.headers:
+            logger.info("No Authorization header")
+            self.send_response(httpx.codes.UNAUTHORIZED)
+            self.end_headers()
+            return False
+        if self.headers["Authorization"] != "Bearer opensesame":
+            logger.info("Invalid Authorization header")
+            self.send_response(httpx.codes.FORBIDDEN)
+            self.end_headers()
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._auth():
+            return
+
+        if self.path == "/hello.txt":
+            code = httpx.codes.OK
+            data = b"Hello, world!"
+            nbytes = len(data)
+            self.send_response(code)
+            self.send_header("Content-type", "application/octet-stream")
+            self.send_header("Content-length", str(nbytes))
+            self.send_header("Digest", "adler32=205e048a")
+            self.end_headers()
+            self.wfile.write(data)
+        elif self.path.startswith("/bigdata.bin"):
+            code = httpx.codes.OK
+            nchunks = 10
+            chunk = b"Hello, world!" * 1000
+            data = chunk * nchunks
+            adler32 = 0x37F631F0
+            start, end = 0, len(data) - 1
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if match and "ranges" in self.path:
+                code = httpx.codes.PARTIAL_CONTENT
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else end
+            self.send_response(code)
+            self.send_header("Content-type", "application/octet-stream")
+            self.send_header("Content-length", str(end - start + 1))
+            if code == httpx.codes.PARTIAL_CONTENT:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            if "adler32" in self.path:
+                self.send_header("Digest", f"adler32={adler32:08x}")
+            self.end_headers()
+            for pos in range(start, end + 1, len(chunk)):
+                self.wfile.write(data[pos : min(pos + len(chunk), end + 1)])
+                if "slow" in self.path:
+                    self.wfile.flush()
+                    time.sleep(1)
+        elif self.path in self.generated:
+            code = self._get_generated(*self.generated[self.path])
+        else:
+            code = httpx.codes.NOT_FOUND
+            self.send_response(code)
+            self.end_headers()
+
+        logger.info(f"GET {self.path} {code}")
+
+    def _get_generated(self, block: bytes, size: int, adler32: int) -> int:
+        start, end = 0, size - 1
+        code = httpx.codes.OK
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            code = httpx.codes.PARTIAL_CONTENT
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else end
+        self.send_response(code)
+        self.send_header("Content-type", "application/octet-stream")
+        self.send_header("Content-length", str(end - start + 1))
+        if code == httpx.codes.PARTIAL_CONTENT:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Digest", f"adler32={adler32:08x}")
+        self.end_headers()
+        # the data repeats every block, so any range is a slice of it
+        pos = start
+        while pos <= end:
+            offset = pos % len(block)
+            chunk = block[offset : offset + min(len(block) - offset, end + 1 - pos)]
+            self.wfile.write(chunk)
+            pos += len(chunk)
+        return code
+
+    def do_PUT(self):
+        if not self._auth():
+            return
+
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        self.uploads[self.path] = data
+        code = httpx.codes.CREATED
+        self.send_response(code)
+        if self.headers.get("Want-Digest") == "adler32":
+            self.send_header("Digest", f"adler32={zlib.adler32(data):08x}")
+        self.send_header("Content-length", "0")
+        self.end_headers()
+
+        logger.info(f"PUT {self.path} {code}")
 
-    # Dump container logs
-    subprocess.check_call(["podman", "logs", container_id])
 
-    # Stop podman container and clean up
-    subprocess.check_call(["podman", "stop", container_id], stdout=subprocess.DEVNULL)
-    subprocess.check_call(["podman", "rm", container_id], stdout=subprocess.DEVNULL)
+@pytest.fixture(scope="session")
+def peer_server() -> Iterator[str]:
+    """A server on the host for the container to copy from and to, see PeerHandler"""
+    server_address = ("", 8081)
+    httpd = ThreadingHTTPServer(server_address, PeerHandler)
+    thread = Thread(target=httpd.serve_forever)
+    thread.start()
+
+    yield "http://host.docker.internal:8081"
+
+    httpd.shutdown()
+    thread.join()
+
+
+@pytest.fixture(scope="session")
+def peer_uploads(peer_server: str) -> dict[str, bytes]:
+    """The files PUT to peer_server, keyed by path"""
+    return PeerHandler.uploads
+
+
+@pytest.fixture(scope="session")
+def peer_generated(peer_server: str) -> dict[str, tuple[bytes, int, int]]:
+    """Add (block, size, adler32) at a path to serve size bytes repeating block there"""
+    return PeerHandler.generated
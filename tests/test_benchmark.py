@@ -0,0 +1,280 @@
+"""Throughput and latency benchmarks
+
+Skipped unless pytest is run with --benchmark, e.g.
+
+    pytest tests/test_benchmark.py --tmpfs-size 8G --benchmark results.json
+    pytest tests/test_benchmark.py --tmpfs-size 8G --benchmark new.json \\
+        --benchmark-baseline results.json
+
+Every operation is run for each file size and concurrency level, and the
+throughput and p50/p99 latency are written to the JSON file. With a baseline,
+cases whose throughput dropped or whose p99 latency rose by more than
+--benchmark-tolerance are reported and fail the run. Two result files can also
+be compared offline with: python -m tests.test_benchmark baseline.json new.json
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import subprocess
+import sys
+import time
+import zlib
+from dataclasses import asdict, dataclass
+from typing import AsyncIterator, Callable, Iterable, Iterator
+
+import httpx
+import numpy
+import pytest
+
+from .util import NginxServer, assert_status
+
+logger = logging.getLogger(__name__)
+
+SIZES = {
+    "1KB": 1024,
+    "1MB": 1024**2,
+    "64MB": 64 * 1024**2,
+    "1GB": 1024**3,
+}
+CONCURRENCY = [1, 8, 32]
+OPERATIONS = ["put", "get", "head_digest", "tpc_pull"]
+
+# Data is generated from this block so that large files need not be in memory
+BLOCK = numpy.random.Generator(numpy.random.PCG64(seed=42)).bytes(1024**2)
+# Repeat each case until about this many bytes were moved, to get enough samples
+TARGET_BYTES = 256 * 1024**2
+MAX_ROUNDS = 20
+
+
+def generate(size: int) -> Iterator[bytes]:
+    for start in range(0, size, len(BLOCK)):
+        yield BLOCK[: min(len(BLOCK), size - start)]
+
+
+def adler32(size: int) -> int:
+    value = 1
+    for block in generate(size):
+        value = zlib.adler32(block, value)
+    return value
+
+
+@dataclass
+class Result:
+    operation: str
+    size: str
+    concurrency: int
+    requests: int
+    mb_per_s: float
+    p50_ms: float
+    p99_ms: float
+
+    @property
+    def key(self) -> str:
+        return f"{self.operation}/{self.size}/{self.concurrency}"
+
+
+def compare(
+    baseline: Iterable[Result], results: Iterable[Result], tolerance: float
+) -> list[str]:
+    """Describe the results that regressed from the baseline"""
+    previous = {result.key: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result.key)
+        if not before:
+            continue
+        if result.mb_per_s < before.mb_per_s * (1 - tolerance):
+            regressions.append(
+                f"{result.key}: throughput {before.mb_per_s:.1f} -> {result.mb_per_s:.1f} MB/s"
+            )
+        if result.p99_ms > before.p99_ms * (1 + tolerance):
+            regressions.append(
+                f"{result.key}: p99 latency {before.p99_ms:.1f} -> {result.p99_ms:.1f} ms"
+            )
+    return regressions
+
+
+def load(path: str) -> list[Result]:
+    with open(path) as f:
+        return [Result(**result) for result in json.load(f)["results"]]
+
+
+@pytest.fixture(scope="module")
+def benchmark_server(
+    request: pytest.FixtureRequest, start_nginx_server: Callable[..., NginxServer]
+) -> NginxServer:
+    """A server with the production defaults of config.lua
+
+    nginx_server runs with the test settings of setup_server, like tiny
+    receive buffers, which would make the numbers meaningless.
+    """
+    if not request.config.getoption("--benchmark"):
+        pytest.skip("benchmarks only run with --benchmark")
+    return start_nginx_server(
+        {}, test_settings=False, storage_dir=request.config.getoption("--storage-dir")
+    )
+
+
+@pytest.fixture(scope="module")
+def benchmark_results(
+    benchmark_server: NginxServer, request: pytest.FixtureRequest
+) -> Iterator[list[Result]]:
+    path = request.config.getoption("--benchmark")
+    results: list[Result] = []
+
+    yield results
+
+    commit = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+    ).stdout.strip()
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "metadata": {
+                    "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    "commit": commit,
+                    # the config.json of the server, the rest are config.lua defaults
+                    "config": {
+                        key: value
+                        for key, value in benchmark_server.config.items()
+                        if key not in ("openidc_pubkey", "health_check_id")
+                    },
+                },
+                "results": [asdict(result) for result in results],
+            },
+            f,
+            indent=2,
+        )
+    baseline = request.config.getoption("--benchmark-baseline")
+    if baseline:
+        regressions = compare(
+            load(baseline), results, request.config.getoption("--benchmark-tolerance")
+        )
+        for regression in regressions:
+            logger.error("regression: %s", regression)
+        if regressions:
+            pytest.fail(f"{len(regressions)} benchmark regressions, see the log")
+
+
+async def timed(
+    client: httpx.AsyncClient, method: str, url: str, **kwargs
+) -> tuple[float, int]:
+    """Send a request, discarding the response body, and return its latency and size
+
+    A third-party copy must end with a success line, like in test_tpc.py
+    """
+    start = time.monotonic()
+    nbytes = 0
+    tail = b""
+    async with client.stream(method, url, **kwargs) as response:
+        async for chunk in response.aiter_raw():
+            nbytes += len(chunk)
+            tail = (tail + chunk)[-256:]
+        if response.status_code not in (
+            httpx.codes.OK,
+            httpx.codes.CREATED,
+            httpx.codes.NO_CONTENT,
+            httpx.codes.ACCEPTED,
+        ):
+            raise AssertionError(f"{method} {url}: {response.status_code}")
+    lines = tail.strip().splitlines()
+    if method == "COPY" and not (lines and lines[-1].startswith(b"success")):
+        raise AssertionError(f"{method} {url}: {tail.decode(errors='replace')}")
+    return time.monotonic() - start, nbytes
+
+
+async def agenerate(size: int) -> AsyncIterator[bytes]:
+    for block in generate(size):
+        yield block
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("concurrency", CONCURRENCY)
+@pytest.mark.parametrize("size_name", SIZES)
+async def test_benchmark(
+    benchmark_server: NginxServer,
+    wlcg_modify_header: dict[str, str],
+    peer_server: str,
+    peer_generated: dict[str, tuple[bytes, int, int]],
+    benchmark_results: list[Result],
+    request: pytest.FixtureRequest,
+    size_name: str,
+    concurrency: int,
+):
+    size = SIZES[size_name]
+    # one file per worker for the uploads and one for the copies
+    if 2 * size * concurrency > request.config.getoption("--benchmark-max-bytes"):
+        pytest.skip(f"{concurrency} x {size_name} exceeds --benchmark-max-bytes")
+    rounds = max(1, min(MAX_ROUNDS, TARGET_BYTES // (size * concurrency)))
+    directory = f"{benchmark_server.url}/bench/{size_name}_{concurrency}"
+    source = f"/bench/{size}.bin"
+    if source not in peer_generated:
+        peer_generated[source] = (BLOCK, size, adler32(size))
+
+    def request_args(operation: str, worker: int) -> tuple[str, str, dict]:
+        path = f"{directory}/{worker}.bin"
+        if operation == "put":
+            return "PUT", path, {"content": agenerate(size)}
+        if operation == "get":
+            return "GET", path, {}
+        if operation == "head_digest":
+            return "HEAD", path, {"headers": {"Want-Digest": "adler32"}}
+        headers = {
+            "Source": f"{peer_server}{source}",
+            "TransferHeaderAuthorization": "Bearer opensesame",
+        }
+        return "COPY", f"{directory}/tpc_{worker}.bin", {"headers": headers}
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(
+        headers=wlcg_modify_header, limits=limits, timeout=600
+    ) as client:
+        for operation in OPERATIONS:
+
+            async def worker(index: int) -> list[float]:
+                latencies = []
+                for _ in range(rounds):
+                    method, url, kwargs = request_args(operation, index)
+                    latency, _ = await timed(client, method, url, **kwargs)
+                    latencies.append(latency)
+                return latencies
+
+            start = time.monotonic()
+            per_worker = await asyncio.gather(*map(worker, range(concurrency)))
+            elapsed = time.monotonic() - start
+            latencies = [latency for worker_latencies in per_worker for latency in worker_latencies]
+            moved = 0 if operation == "head_digest" else size * len(latencies)
+            result = Result(
+                operation=operation,
+                size=size_name,
+                concurrency=concurrency,
+                requests=len(latencies),
+                mb_per_s=moved / elapsed / 1e6,
+                p50_ms=float(numpy.percentile(latencies, 50)) * 1e3,
+                p99_ms=float(numpy.percentile(latencies, 99)) * 1e3,
+            )
+            logger.info(
+                "%s: %.1f MB/s, p50 %.1f ms, p99 %.1f ms over %d requests",
+                result.key,
+                result.mb_per_s,
+                result.p50_ms,
+                result.p99_ms,
+                result.requests,
+            )
+            benchmark_results.append(result)
+
+        for index in range(concurrency):
+            for path in (f"{directory}/{index}.bin", f"{directory}/tpc_{index}.bin"):
+                response = await client.delete(path)
+                assert_status(response, httpx.codes.NO_CONTENT)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        sys.exit(f"usage: {sys.argv[0]} BASELINE RESULTS [TOLERANCE]")
+    tolerance = float(sys.argv[3]) if len(sys.argv) == 4 else 0.1
+    regressions = compare(load(sys.argv[1]), load(sys.argv[2]), tolerance)
+    print("\n".join(regressions) or "no regressions")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,134 @@
+import os
+import zlib
+
+import numpy
+import pytest
+
+from webdav_client import (
+    PerfMarker,
+    TransferResult,
+    WebDAVClient,
+    parse_adler32,
+    parse_tpc_lines,
+)
+
+
+def test_parse_tpc_lines():
+    lines = [
+        "Perf Marker",
+        "    Timestamp: 1700000000",
+        "    State: Running",
+        "    State description: transfer",
+        "    Stripe Index: 0",
+        "    Stripe Bytes Transferred: 4096",
+        "    Total Stripe Count: 2",
+        "End",
+        "success: Created",
+        "ignored",
+    ]
+    events = list(parse_tpc_lines(lines))
+    assert len(events) == 2
+    marker = events[0]
+    assert isinstance(marker, PerfMarker)
+    assert marker.timestamp == 1700000000
+    assert marker.stripe_bytes_transferred == 4096
+    assert marker.total_stripe_count == 2
+    assert marker.fields["State description"] == "transfer"
+    assert events[1] == TransferResult(True, "Created")
+
+    assert list(parse_tpc_lines(["failure: rejected GET: Not Found"])) == [
+        TransferResult(False, "rejected GET: Not Found")
+    ]
+    assert list(parse_tpc_lines(["no source provided"])) == [
+        TransferResult(False, "no source provided")
+    ]
+    # cut off in the middle of a marker
+    assert list(parse_tpc_lines(["Perf Marker", "    State: Running"])) == [
+        TransferResult(False, "response ended without a result")
+    ]
+    with pytest.raises(ValueError):
+        list(parse_tpc_lines(["Perf Marker", "garbage"]))
+
+
+def test_parse_adler32():
+    assert parse_adler32("adler32=0B2C04E1") == "0b2c04e1"
+    assert parse_adler32("crc32c=abc, adler32=0b2c04e1") == "0b2c04e1"
+    assert parse_adler32("md5=abc") is None
+    assert parse_adler32(None) is None
+
+
+@pytest.mark.asyncio
+async def test_client_bulk_upload_download(
+    nginx_server: str,
+    wlcg_modify_header: dict[str, str],
+    tmp_path,
+):
+    rng = numpy.random.Generator(numpy.random.PCG64(seed=42))
+    sources = tmp_path / "sources"
+    sources.mkdir()
+    data = {}
+    for i in range(40):
+        # empty, smaller and larger than the client's chunks
+        data[i] = rng.bytes([0, 1000, 1024 * 1024 + 7][i % 3])
+        (sources / f"{i}.bin").write_bytes(data[i])
+
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+    async with WebDAVClient(
+        nginx_server, headers=wlcg_modify_header, concurrency=8
+    ) as client:
+        uploads = [
+            result
+            async for result in client.upload_many(
+                (f"/client/bulk/{i}.bin", sources / f"{i}.bin") for i in data
+            )
+        ]
+        assert len(uploads) == len(data)
+        for result in uploads:
+            assert result.error is None, result
+            i = int(os.path.basename(result.remote_path).split(".")[0])
+            assert result.bytes == len(data[i])
+            assert result.adler32 == f"{zlib.adler32(data[i]):08x}"
+
+        results = [
+            result
+            async for result in client.download_many(
+                (f"/client/bulk/{i}.bin", downloads / f"{i}.bin")
+                for i in [*data, "missing"]
+            )
+        ]
+        assert len(results) == len(data) + 1
+        failed = [result for result in results if result.error]
+        assert [result.remote_path for result in failed] == ["/client/bulk/missing.bin"]
+        assert "404" in failed[0].error
+        assert not (downloads / "missing.bin").exists()
+        for i in data:
+            assert (downloads / f"{i}.bin").read_bytes() == data[i]
+
+
+@pytest.mark.asyncio
+async def test_client_stage_out_10k(
+    nginx_server: str,
+    wlcg_modify_header: dict[str, str],
+    tmp_path,
+):
+    # a job's stage-out of many small files, fed from a generator
+    count = 10_000
+    source = tmp_path / "output.bin"
+    data = b"Hello, world!" * 80
+    source.write_bytes(data)
+    adler32 = f"{zlib.adler32(data):08x}"
+
+    uploaded = 0
+    failed = []
+    async with WebDAVClient(
+        nginx_server, headers=wlcg_modify_header, concurrency=32
+    ) as client:
+        async for result in client.upload_many(
+            (f"/client/stage_out/{i // 1000}/{i}.bin", source) for i in range(count)
+        ):
+            uploaded += 1
+            if result.error or result.adler32 != adler32:
+                failed.append(result)
+    assert uploaded == count
+    assert failed == []
@@ -1,8 +1,15 @@
+import base64
+import hashlib
+import http.client
+import os
+import socket
+import time
 import zlib
+from typing import Callable
 
 import httpx
 
-from .util import assert_status
+from .util import assert_status, container_exec
 
 
 def test_crud_file(
@@ -25,24 +32,21 @@ def test_crud_file(
     assert response.text == data
 
     response = httpx.put(path, headers=wlcg_create_header, content=data + "plus more")
-    # TODO: this should be FORBIDDEN, but allowed for wlcg_modify_header
+    assert_status(response, httpx.codes.FORBIDDEN)
+    assert response.text == "no permission to modify this resource\n"
+
+    response = httpx.put(path, headers=wlcg_modify_header, content=data + "plus more")
     assert_status(response, httpx.codes.NO_CONTENT)
 
     response = httpx.get(path, headers=wlcg_create_header)
     assert_status(response, httpx.codes.OK)
     assert response.text == data + "plus more"
 
-    # TODO: once the above is fixed, this should be uncommented
-    # response = httpx.put(path, headers=wlcg_create_header, data=data + "with some extra data")
-    # assert_status(response, httpx.codes.CREATED)
-
     response = httpx.delete(path, headers=wlcg_create_header)
-    # TODO: this should be FORBIDDEN, but allowed for wlcg_modify_header
-    assert_status(response, httpx.codes.NO_CONTENT)
+    assert_status(response, httpx.codes.FORBIDDEN)
 
-    # TODO: once the above is fixed, this should be uncommented
-    # response = httpx.delete(path, headers=wlcg_modify_header)
-    # assert_status(response, httpx.codes.NO_CONTENT)
+    response = httpx.delete(path, headers=wlcg_modify_header)
+    assert_status(response, httpx.codes.NO_CONTENT)
 
     response = httpx.get(path, headers=wlcg_create_header)
     assert_status(response, httpx.codes.NOT_FOUND)
@@ -98,6 +102,28 @@ def test_put_wantdigest(
     assert response.headers["Digest"] == f"adler32={expected_adler32:08x}"
 
 
+def test_put_wantdigest_multi(
+    nginx_server: str,
+    wlcg_create_header: dict[str, str],
+):
+    path = f"{nginx_server}/test_digest_multi.txt"
+    data = b"Hello, world!" * 1000
+    expected_md5 = base64.b64encode(hashlib.md5(data).digest()).decode()
+    expected_sha256 = base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+    headers = dict(wlcg_create_header)
+    headers["Want-Digest"] = "SHA-256;q=0.5, md5, unknown, adler32;q=0"
+    response = httpx.put(path, headers=headers, content=data)
+    assert_status(response, httpx.codes.CREATED)
+    assert response.headers["Digest"] == f"md5={expected_md5},sha-256={expected_sha256}"
+
+    # the digests are stored, so HEAD can report them
+    headers["Want-Digest"] = "md5;q=0.1, adler32"
+    response = httpx.head(path, headers=headers)
+    assert_status(response, httpx.codes.OK)
+    assert response.headers["Digest"] == f"adler32={zlib.adler32(data):08x},md5={expected_md5}"
+
+
 def test_put_mkdir(
     nginx_server: str,
     wlcg_create_header: dict[str, str],
@@ -114,4 +140,317 @@ def test_put_mkdir(
 
     response = httpx.put(path, headers=wlcg_create_header, content=data)
     assert_status(response, httpx.codes.INTERNAL_SERVER_ERROR)
-    assert response.text == "failed to open file: /var/www/webdav/test_mkdir/blah.txt/more.txt: Not a directory\n"
\ No newline at end of file
+    assert response.text == "failed to open file: /var/www/webdav/test_mkdir/blah.txt/more.txt: Not a directory\n"
+
+
+def test_put_known_directory(
+    nginx_server: str,
+    nginx_container: str,
+    wlcg_create_header: dict[str, str],
+    wlcg_modify_header: dict[str, str],
+):
+    health = nginx_server.removesuffix("webdav") + "webdav_health?stats=1"
+
+    def cache_hits() -> int:
+        response = httpx.get(health)
+        assert_status(response, httpx.codes.OK)
+        for line in response.text.splitlines():
+            if line.startswith("dir_cache_hits "):
+                return int(line.split()[1])
+        return 0
+
+    directory = f"{nginx_server}/test_known_dir"
+    response = httpx.put(f"{directory}/one.txt", headers=wlcg_create_header, content="one")
+    assert_status(response, httpx.codes.CREATED)
+
+    before = cache_hits()
+    response = httpx.put(f"{directory}/two.txt", headers=wlcg_create_header, content="two")
+    assert_status(response, httpx.codes.CREATED)
+    assert cache_hits() > before
+
+    # a removed directory is created again
+    for name in ("one.txt", "two.txt", ""):
+        response = httpx.delete(f"{directory}/{name}", headers=wlcg_modify_header)
+        assert_status(response, httpx.codes.NO_CONTENT)
+    response = httpx.put(f"{directory}/three.txt", headers=wlcg_create_header, content="three")
+    assert_status(response, httpx.codes.CREATED)
+    response = httpx.get(f"{directory}/three.txt", headers=wlcg_create_header)
+    assert_status(response, httpx.codes.OK)
+    assert response.text == "three"
+
+    # a directory removed behind the server's back is still cached as known,
+    # so opening the file fails and it is retried after making the directory
+    container_exec(nginx_container, "rm", "-rf", "/var/www/webdav/test_known_dir", user="nobody")
+    before = cache_hits()
+    response = httpx.put(f"{directory}/four.txt", headers=wlcg_create_header, content="four")
+    assert_status(response, httpx.codes.CREATED)
+    assert cache_hits() > before
+    response = httpx.get(f"{directory}/four.txt", headers=wlcg_create_header)
+    assert_status(response, httpx.codes.OK)
+    assert response.text == "four"
+
+
+def test_put_timing(nginx_server: str, wlcg_create_header: dict[str, str]):
+    response = httpx.put(
+        f"{nginx_server}/test_timing/file.txt",
+        headers=wlcg_create_header,
+        content=b"Hello, world!" * 1000,
+    )
+    assert_status(response, httpx.codes.CREATED)
+    phases = {}
+    for metric in response.headers["Server-Timing"].split(", "):
+        name, duration, _ = metric.split(";", 2)
+        assert duration.startswith("dur=")
+        phases[name] = float(duration.removeprefix("dur="))
+    for name in ("auth", "mkdir", "recv", "cksum", "xattr", "commit"):
+        assert phases[name] >= 0
+
+    response = httpx.get(f"{nginx_server}/test_timing/file.txt", headers=wlcg_create_header)
+    assert_status(response, httpx.codes.OK)
+    assert response.headers["Server-Timing"].startswith("auth;dur=")
+
+    # chunked bodies, in memory and in a file (see test_put_keepalive)
+    for name, data in (("small", b"Hello, world!" * 1000), ("large", b"Hello, world!" * 300_000)):
+        response = httpx.put(
+            f"{nginx_server}/test_timing/chunked_{name}.txt",
+            headers=wlcg_create_header,
+            content=iter([data]),
+        )
+        assert_status(response, httpx.codes.CREATED)
+        names = [metric.split(";", 1)[0] for metric in response.headers["Server-Timing"].split(", ")]
+        for phase in ("auth", "mkdir", "recv", "cksum", "xattr", "commit"):
+            assert phase in names
+
+
+def test_put_error_status(nginx_server: str, wlcg_create_header: dict[str, str]):
+    endpoint = nginx_server.removesuffix("webdav") + "metrics"
+
+    def count(status: int) -> float:
+        response = httpx.get(endpoint)
+        assert_status(response, httpx.codes.OK)
+        series = f'webdav_requests_total{{method="PUT",status="{status}"}} '
+        for line in response.text.splitlines():
+            if line.startswith(series):
+                return float(line.removeprefix(series))
+        return 0
+
+    response = httpx.put(f"{nginx_server}/test_status.txt", headers=wlcg_create_header, content="file")
+    assert_status(response, httpx.codes.CREATED)
+    before = count(500), count(444)
+    # the connection is closed after the response, which must not change the recorded status
+    response = httpx.put(
+        f"{nginx_server}/test_status.txt/more.txt", headers=wlcg_create_header, content="more"
+    )
+    assert_status(response, httpx.codes.INTERNAL_SERVER_ERROR)
+    # each worker publishes its updates every metrics_sync_interval
+    time.sleep(1.5)
+    assert (count(500), count(444)) == (before[0] + 1, before[1])
+
+
+def test_scoped_path(
+    nginx_server: str, wlcg_header: Callable[[str], dict[str, str]]
+):
+    headers = wlcg_header(
+        "openid storage.read:/scoped/public storage.create:/scoped/user"
+    )
+    data = "Hello, world!"
+
+    response = httpx.put(f"{nginx_server}/scoped/user/a.txt", headers=headers, content=data)
+    assert_status(response, httpx.codes.CREATED)
+
+    # a sibling with a common name prefix is not covered by the scope
+    response = httpx.put(f"{nginx_server}/scoped/username.txt", headers=headers, content=data)
+    assert_status(response, httpx.codes.FORBIDDEN)
+
+    # neither is escaping it, whether literally or percent-encoded
+    response = httpx.put(
+        f"{nginx_server}/scoped/user/%2e%2e/public/b.txt", headers=headers, content=data
+    )
+    assert_status(response, httpx.codes.FORBIDDEN)
+
+    response = httpx.get(f"{nginx_server}/scoped/user/a.txt", headers=headers)
+    assert_status(response, httpx.codes.FORBIDDEN)
+    assert response.text == "no permission to read this resource\n"
+
+
+def test_put_interrupted(
+    nginx_server: str,
+    nginx_container: str,
+    wlcg_create_header: dict[str, str],
+    wlcg_modify_header: dict[str, str],
+):
+    path = f"{nginx_server}/test_interrupted.txt"
+    data = b"Hello, world!" * 1000
+
+    response = httpx.put(path, headers=wlcg_create_header, content=data)
+    assert_status(response, httpx.codes.CREATED)
+
+    # the client goes away halfway through an overwrite
+    url = httpx.URL(path)
+    with socket.create_connection((url.host, url.port)) as sock:
+        request = (
+            f"PUT {url.raw_path.decode()} HTTP/1.1\r\n"
+            f"Host: {url.host}:{url.port}\r\n"
+            f"Authorization: {wlcg_modify_header['Authorization']}\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "\r\n"
+        )
+        sock.sendall(request.encode() + data[: len(data) // 2])
+    time.sleep(0.5)
+
+    # the previous file is untouched, and no partial upload is left behind
+    response = httpx.get(path, headers=wlcg_create_header)
+    assert_status(response, httpx.codes.OK)
+    assert response.content == data
+
+    # (autoindex hides dotfiles, so look at the directory itself)
+    names = container_exec(nginx_container, "ls", "-a", "/var/www/webdav").split()
+    assert not [name for name in names if name.startswith(".test_interrupted.txt.")]
+
+
+def test_stale_upload_removed(
+    nginx_server: str,
+    nginx_container: str,
+    wlcg_create_header: dict[str, str],
+):
+    # as if a worker died in the middle of uploads, long ago and just now
+    directory = "/var/www/webdav/test_stale"
+    stale = f"{directory}/.data.bin.1234.1700000000000.1.upload"
+    recent = f"{directory}/.data.bin.1234.1700000000000.2.upload"
+    # and of an upload in ranges whose state expired
+    partial = f"{directory}/.ranged.bin.partial"
+    container_exec(nginx_container, "mkdir", "-p", directory, user="nobody")
+    container_exec(nginx_container, "touch", "-d", "2 days ago", stale, partial, user="nobody")
+    container_exec(nginx_container, "touch", recent, user="nobody")
+
+    # the test server sweeps every second
+    time.sleep(2)
+    names = container_exec(nginx_container, "ls", "-a", directory).split()
+    assert os.path.basename(stale) not in names
+    assert os.path.basename(partial) not in names
+    assert os.path.basename(recent) in names
+
+
+def test_put_keepalive(
+    nginx_server: str, nginx_container: str, wlcg_create_header: dict[str, str]
+):
+    url = httpx.URL(nginx_server)
+    conn = http.client.HTTPConnection(url.host, url.port)
+    conn.connect()
+    sock = conn.sock
+    data = b"Hello, world!" * 1000
+
+    def put(name: str, headers: dict[str, str], body):
+        conn.request(
+            "PUT",
+            f"{url.path}/{name}",
+            body=body,
+            headers={**wlcg_create_header, **headers},
+            encode_chunked="Content-Length" not in headers,
+        )
+        response = conn.getresponse()
+        response.read()
+        assert response.status == httpx.codes.CREATED
+        # a response that closes the connection makes http.client drop its socket
+        assert conn.sock is sock
+
+    for i in range(3):
+        put(f"test_keepalive_{i}.txt", {"Content-Length": str(len(data))}, data)
+    put(
+        "test_keepalive_continue.txt",
+        {"Content-Length": str(len(data)), "Expect": "100-continue"},
+        data,
+    )
+    put("test_keepalive_chunked.txt", {}, iter([data[:5000], data[5000:]]))
+    # larger than client_body_buffer_size, so received into a file and renamed into place
+    large = data * 300
+    put("test_keepalive_chunked_large.txt", {}, iter([large[:1_000_000], large[1_000_000:]]))
+    conn.close()
+
+    for name, content in [
+        ("test_keepalive_0.txt", data),
+        ("test_keepalive_chunked.txt", data),
+        ("test_keepalive_chunked_large.txt", large),
+    ]:
+        response = httpx.get(f"{nginx_server}/{name}", headers=wlcg_create_header)
+        assert_status(response, httpx.codes.OK)
+        assert response.content == content
+    # like the files written by the server, not private like nginx's body file
+    mode = container_exec(
+        nginx_container, "stat", "-c", "%a", "/var/www/webdav/test_keepalive_chunked_large.txt"
+    )
+    assert mode.strip() == "644"
+
+
+def test_copy_move_local(
+    nginx_server: str,
+    wlcg_read_header: dict[str, str],
+    wlcg_create_header: dict[str, str],
+    wlcg_modify_header: dict[str, str],
+):
+    src = f"{nginx_server}/test_local_src.bin"
+    data = b"Hello, world!" * 100_000
+    digest = f"adler32={zlib.adler32(data):08x}"
+    response = httpx.put(src, headers=wlcg_create_header, content=data)
+    assert_status(response, httpx.codes.CREATED)
+
+    copy = f"{nginx_server}/test_local/copy.bin"
+    response = httpx.request(
+        "COPY", src, headers={**wlcg_read_header, "Destination": copy}
+    )
+    assert_status(response, httpx.codes.FORBIDDEN)
+    assert response.text == "no permission to create the destination\n"
+
+    response = httpx.request(
+        "COPY", src, headers={**wlcg_create_header, "Destination": copy}
+    )
+    assert_status(response, httpx.codes.CREATED)
+    response = httpx.get(copy, headers=wlcg_read_header)
+    assert_status(response, httpx.codes.OK)
+    assert response.content == data
+    # the stored checksum came with it
+    response = httpx.head(copy, headers={**wlcg_read_header, "Want-Digest": "adler32"})
+    assert_status(response, httpx.codes.OK)
+    assert response.headers["Digest"] == digest
+
+    # a path works too, replacing needs storage.modify
+    headers = {**wlcg_create_header, "Destination": "/webdav/test_local/copy.bin"}
+    response = httpx.request("COPY", src, headers=headers)
+    assert_status(response, httpx.codes.FORBIDDEN)
+    headers = {**wlcg_modify_header, "Destination": "/webdav/test_local/copy.bin"}
+    response = httpx.request("COPY", src, headers={**headers, "Overwrite": "F"})
+    assert_status(response, 412)
+    response = httpx.request("COPY", src, headers=headers)
+    assert_status(response, httpx.codes.NO_CONTENT)
+
+    moved = f"{nginx_server}/test_local/moved.bin"
+    response = httpx.request(
+        "MOVE", copy, headers={**wlcg_create_header, "Destination": moved}
+    )
+    assert_status(response, httpx.codes.FORBIDDEN)
+    response = httpx.request(
+        "MOVE", copy, headers={**wlcg_modify_header, "Destination": moved}
+    )
+    assert_status(response, httpx.codes.CREATED)
+    response = httpx.get(copy, headers=wlcg_read_header)
+    assert_status(response, httpx.codes.NOT_FOUND)
+    response = httpx.head(moved, headers={**wlcg_read_header, "Want-Digest": "adler32"})
+    assert_status(response, httpx.codes.OK)
+    assert response.headers["Digest"] == digest
+
+    for destination in ("/webdav/test_local/../../escaped.bin", "/elsewhere.bin"):
+        response = httpx.request(
+            "MOVE", moved, headers={**wlcg_modify_header, "Destination": destination}
+        )
+        assert_status(response, httpx.codes.BAD_REQUEST)
+    response = httpx.request(
+        "MOVE",
+        moved,
+        headers={**wlcg_modify_header, "Destination": "http://elsewhere:8080/webdav/x"},
+    )
+    assert_status(response, httpx.codes.BAD_GATEWAY)
+    response = httpx.request(
+        "MOVE", f"{nginx_server}/test_local/missing.bin",
+        headers={**wlcg_modify_header, "Destination": moved},
+    )
+    assert_status(response, httpx.codes.NOT_FOUND)
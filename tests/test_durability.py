@@ -0,0 +1,79 @@
+import json
+import subprocess
+import zlib
+from typing import Callable
+
+import httpx
+import pytest
+
+from .util import NginxServer, assert_status
+
+
+@pytest.fixture(scope="module", params=["writeback", "fsync"])
+def durable_server(
+    request: pytest.FixtureRequest, start_nginx_server: Callable[[dict], NginxServer]
+) -> str:
+    server = start_nginx_server(
+        {
+            "upload_durability": request.param,
+            # write back several times per upload
+            "upload_writeback_interval": 64 * 1024,
+            "upload_drop_cache": True,
+        }
+    )
+    return server.url
+
+
+def test_put_durable(durable_server: str, wlcg_create_header: dict[str, str]):
+    data = bytes(range(256)) * 4099
+    digest = f"adler32={zlib.adler32(data):08x}"
+    headers = {**wlcg_create_header, "Want-Digest": "adler32"}
+
+    response = httpx.put(f"{durable_server}/durable/put.bin", headers=headers, content=data)
+    assert_status(response, httpx.codes.CREATED)
+    assert response.headers["Digest"] == digest
+
+    chunks = [data[:100_000], data[100_000:]]
+    response = httpx.put(f"{durable_server}/durable/chunked.bin", headers=headers, content=iter(chunks))
+    assert_status(response, httpx.codes.CREATED)
+    assert response.headers["Digest"] == digest
+
+    # the last range commits the file, see partialput.end_range
+    middle = len(data) // 2
+    for first, last in [(middle, len(data) - 1), (0, middle - 1)]:
+        response = httpx.put(
+            f"{durable_server}/durable/ranged.bin",
+            headers={**headers, "Content-Range": f"bytes {first}-{last}/{len(data)}"},
+            content=data[first : last + 1],
+        )
+    assert_status(response, httpx.codes.CREATED)
+    assert response.headers["Digest"] == digest
+
+    for name in ("put.bin", "chunked.bin", "ranged.bin"):
+        response = httpx.get(f"{durable_server}/durable/{name}", headers=wlcg_create_header)
+        assert_status(response, httpx.codes.OK)
+        assert response.content == data
+
+
+def test_invalid_durability(setup_server: dict, tmp_path):
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({**setup_server, "upload_durability": "sometimes"}))
+    # nginx loads the config in init_by_lua, where this error stops it from starting
+    output = subprocess.check_output(
+        [
+            "podman",
+            "run",
+            "--rm",
+            "-v",
+            f"{config_path}:/etc/nginx/lua/config.json:ro",
+            "--entrypoint",
+            "resty",
+            "nginx-webdav",
+            "-I",
+            "/etc/nginx/lua",
+            "-e",
+            'print(require("config").load("/etc/nginx/lua/config.json"))',
+        ],
+        text=True,
+    )
+    assert output.strip() == "/etc/nginx/lua/config.json: invalid upload_durability: sometimes"
@@ -1,7 +1,10 @@
+import asyncio
 import zlib
 
 import httpx
+import pytest
 
+from .conftest import SEGMENTED_DATA
 from .util import assert_status
 
 
@@ -30,3 +33,52 @@ def test_head_adler32(nginx_server: str, wlcg_read_header: dict[str, str]):
     assert response.headers["Content-Length"] == "13"
     adler32 = zlib.adler32(b"Hello, world!")
     assert response.headers["Digest"] == f"adler32={adler32:08x}"
+
+
+@pytest.mark.asyncio
+async def test_head_adler32_concurrent(nginx_server: str, wlcg_read_header: dict[str, str]):
+    headers = dict(wlcg_read_header)
+    headers["Want-Digest"] = "adler32"
+    async with httpx.AsyncClient(base_url=nginx_server, headers=headers) as client:
+        responses = await asyncio.gather(
+            *(client.head("/hello.txt") for _ in range(16))
+        )
+    adler32 = zlib.adler32(b"Hello, world!")
+    for response in responses:
+        assert_status(response, httpx.codes.OK)
+        assert response.headers["Digest"] == f"adler32={adler32:08x}"
+
+
+def test_head_adler32_cached(nginx_server: str, wlcg_read_header: dict[str, str]):
+    health = nginx_server.removesuffix("webdav") + "webdav_health?stats=1"
+
+    def cache_hits() -> int:
+        response = httpx.get(health)
+        assert_status(response, httpx.codes.OK)
+        for line in response.text.splitlines():
+            if line.startswith("metadata_cache_hits "):
+                return int(line.split()[1])
+        return 0
+
+    headers = dict(wlcg_read_header)
+    headers["Want-Digest"] = "adler32"
+    adler32 = zlib.adler32(b"Hello, world!")
+    for _ in range(3):
+        response = httpx.head(f"{nginx_server}/hello.txt", headers=headers)
+        assert_status(response, httpx.codes.OK)
+        assert response.headers["Digest"] == f"adler32={adler32:08x}"
+
+    before = cache_hits()
+    response = httpx.head(f"{nginx_server}/hello.txt", headers=headers)
+    assert response.headers["Digest"] == f"adler32={adler32:08x}"
+    assert cache_hits() == before + 1
+
+
+def test_head_adler32_segmented(nginx_server: str, wlcg_read_header: dict[str, str]):
+    # larger than checksum_segment_size, so the checksum is computed in parallel
+    headers = dict(wlcg_read_header)
+    headers["Want-Digest"] = "adler32"
+    response = httpx.head(f"{nginx_server}/segmented.bin", headers=headers)
+    assert_status(response, httpx.codes.OK)
+    assert response.headers["Content-Length"] == str(len(SEGMENTED_DATA))
+    assert response.headers["Digest"] == f"adler32={zlib.adler32(SEGMENTED_DATA):08x}"
@@ -1,3 +1,6 @@
+import time
+import zlib
+
 import httpx
 
 from .util import assert_status
@@ -37,3 +40,77 @@ def test_hello(nginx_server: str, wlcg_read_header: dict[str, str]):
 def test_list(nginx_server: str, wlcg_read_header: dict[str, str]):
     response = httpx.get(f"{nginx_server}", headers=wlcg_read_header)
     assert_status(response, httpx.codes.OK)
+
+
+def test_token_cache(nginx_server: str, wlcg_read_header: dict[str, str]):
+    health = nginx_server.removesuffix("webdav") + "webdav_health?stats=1"
+
+    def counters() -> dict[str, int]:
+        response = httpx.get(health)
+        assert_status(response, httpx.codes.OK)
+        lines = response.text.splitlines()[1:]
+        return {name: int(value) for name, value in map(str.split, lines)}
+
+    response = httpx.get(f"{nginx_server}/hello.txt", headers=wlcg_read_header)
+    assert_status(response, httpx.codes.OK)
+    before = counters()
+    for _ in range(5):
+        response = httpx.get(f"{nginx_server}/hello.txt", headers=wlcg_read_header)
+        assert_status(response, httpx.codes.OK)
+    after = counters()
+    assert after["jwt_cache_hits"] == before["jwt_cache_hits"] + 5
+    assert after.get("jwt_cache_misses") == before.get("jwt_cache_misses")
+
+
+def test_metrics(nginx_server: str, wlcg_read_header: dict[str, str]):
+    endpoint = nginx_server.removesuffix("webdav") + "metrics"
+
+    def scrape() -> dict[str, float]:
+        response = httpx.get(endpoint)
+        assert_status(response, httpx.codes.OK)
+        samples = {}
+        for line in response.text.splitlines():
+            if line and not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        return samples
+
+    requests = 'webdav_requests_total{method="GET",status="200"}'
+    latency = 'webdav_request_duration_seconds_count{method="GET",status="200"}'
+    before = scrape()
+    for _ in range(3):
+        response = httpx.get(f"{nginx_server}/hello.txt", headers=wlcg_read_header)
+        assert_status(response, httpx.codes.OK)
+    # each worker publishes its updates every metrics_sync_interval
+    time.sleep(1.5)
+    after = scrape()
+    assert after[requests] == before.get(requests, 0) + 3
+    assert after[latency] == before.get(latency, 0) + 3
+    assert after['webdav_response_bytes_total{method="GET"}'] > 0
+    assert after.get("webdav_active_uploads", 0) == 0
+
+
+def test_io_buffer_pool(nginx_server: str, wlcg_create_header: dict[str, str]):
+    endpoint = nginx_server.removesuffix("webdav") + "metrics"
+    data = b"0123456789abcdef" * 1024**2
+    response = httpx.put(
+        f"{nginx_server}/test_buffer_pool.bin",
+        headers={**wlcg_create_header, "Want-Digest": "adler32"},
+        content=data,
+    )
+    assert_status(response, httpx.codes.CREATED)
+    assert response.headers["Digest"] == f"adler32={zlib.adler32(data):08x}"
+    time.sleep(1.5)
+
+    response = httpx.get(endpoint)
+    assert_status(response, httpx.codes.OK)
+    samples = dict(
+        line.rsplit(" ", 1)
+        for line in response.text.splitlines()
+        if line and not line.startswith("#")
+    )
+    # a few buffers (io_buffer_pool_size is 8) were reused for thousands of
+    # chunks and all returned once the upload was done
+    assert float(samples["webdav_io_buffers_in_use"]) == 0
+    assert float(samples["webdav_io_buffers_allocated"]) > 0
+    assert any(name.startswith("webdav_lua_memory_bytes{") for name in samples)
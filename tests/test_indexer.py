@@ -0,0 +1,124 @@
+import time
+import zlib
+from typing import Callable
+
+import httpx
+import pytest
+
+from .util import NginxServer, assert_status, container_exec, get_xattrs
+
+ADLER32_XATTR = "user.nginx-webdav.adler32"
+STAMP_XATTR = "user.nginx-webdav.adler32-stamp"
+
+# what `seq 1 100000` writes
+SEQ_DATA = "".join(f"{i}\n" for i in range(1, 100_001)).encode()
+
+
+@pytest.fixture(scope="module")
+def indexer_server(start_nginx_server: Callable[[dict], NginxServer]) -> NginxServer:
+    return start_nginx_server(
+        {
+            "checksum_indexer": True,
+            # crawl again a second after finishing
+            "checksum_indexer_interval": 1,
+            "checksum_indexer_bandwidth": 0,
+        }
+    )
+
+
+def wait_for_xattr(container_id: str, path: str, name: str, value: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while get_xattrs(container_id, path).get(name) != value:
+        assert time.monotonic() < deadline, f"{path} has no {name}={value}"
+        time.sleep(0.5)
+
+
+def mtime(container_id: str, path: str) -> int:
+    return int(container_exec(container_id, "stat", "-c", "%Y", path))
+
+
+def test_put_stamp(
+    nginx_server: str,
+    nginx_container: str,
+    wlcg_create_header: dict[str, str],
+):
+    data = b"Hello, world!" * 1000
+    response = httpx.put(f"{nginx_server}/test_stamp.txt", headers=wlcg_create_header, content=data)
+    assert_status(response, httpx.codes.CREATED)
+
+    path = "/var/www/webdav/test_stamp.txt"
+    xattrs = get_xattrs(nginx_container, path)
+    assert xattrs[ADLER32_XATTR] == f"{zlib.adler32(data):08x}"
+    assert xattrs[STAMP_XATTR] == f"{len(data)}:{mtime(nginx_container, path)}"
+
+
+def test_indexer_crawl(indexer_server: NginxServer):
+    container = indexer_server.container_id
+    # placed by another tool, so without any stored checksum
+    path = "/var/www/webdav/test_crawl/sub/seq.txt"
+    container_exec(container, "mkdir", "-p", "/var/www/webdav/test_crawl/sub", user="nobody")
+    container_exec(container, "sh", "-c", f"seq 1 100000 > {path}", user="nobody")
+
+    wait_for_xattr(container, path, ADLER32_XATTR, f"{zlib.adler32(SEQ_DATA):08x}")
+    xattrs = get_xattrs(container, path)
+    assert xattrs[STAMP_XATTR] == f"{len(SEQ_DATA)}:{mtime(container, path)}"
+
+
+def test_indexer_stale_stamp(indexer_server: NginxServer, wlcg_create_header: dict[str, str]):
+    container = indexer_server.container_id
+    url = f"{indexer_server.url}/test_stale_stamp.txt"
+    data = b"Hello, world!" * 1000
+    response = httpx.put(url, headers=wlcg_create_header, content=data)
+    assert_status(response, httpx.codes.CREATED)
+
+    # changed in place by another tool, keeping the size, so the stamp is stale
+    path = "/var/www/webdav/test_stale_stamp.txt"
+    changed = b"J" + data[1:]
+    later = mtime(container, path) + 10
+    container_exec(
+        container,
+        "sh",
+        "-c",
+        f"printf J | dd of={path} conv=notrunc status=none && touch -m -d @{later} {path}",
+        user="nobody",
+    )
+
+    wait_for_xattr(container, path, ADLER32_XATTR, f"{zlib.adler32(changed):08x}")
+    xattrs = get_xattrs(container, path)
+    assert xattrs[STAMP_XATTR] == f"{len(data)}:{later}"
+    response = httpx.head(url, headers={**wlcg_create_header, "Want-Digest": "adler32"})
+    assert_status(response, httpx.codes.OK)
+    assert response.headers["Digest"] == f"adler32={zlib.adler32(changed):08x}"
+
+
+def test_copy_stale_stamp(
+    nginx_server: str,
+    nginx_container: str,
+    wlcg_create_header: dict[str, str],
+):
+    data = b"Hello, world!" * 1000
+    src = f"{nginx_server}/test_copy_stale_src.txt"
+    response = httpx.put(src, headers=wlcg_create_header, content=data)
+    assert_status(response, httpx.codes.CREATED)
+
+    # changed in place by another tool, so the stored adler32 is stale
+    path = "/var/www/webdav/test_copy_stale_src.txt"
+    changed = b"J" + data[1:]
+    later = mtime(nginx_container, path) + 10
+    container_exec(
+        nginx_container,
+        "sh",
+        "-c",
+        f"printf J | dd of={path} conv=notrunc status=none && touch -m -d @{later} {path}",
+        user="nobody",
+    )
+
+    copy = f"{nginx_server}/test_copy_stale_copy.txt"
+    response = httpx.request("COPY", src, headers={**wlcg_create_header, "Destination": copy})
+    assert_status(response, httpx.codes.CREATED)
+    # the stale value was not carried over as current, so it is computed again
+    xattrs = get_xattrs(nginx_container, "/var/www/webdav/test_copy_stale_copy.txt")
+    assert ADLER32_XATTR not in xattrs
+    response = httpx.head(copy, headers={**wlcg_create_header, "Want-Digest": "adler32"})
+    assert_status(response, httpx.codes.OK)
+    assert response.headers["Digest"] == f"adler32={zlib.adler32(changed):08x}"
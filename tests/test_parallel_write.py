@@ -1,10 +1,11 @@
 import asyncio
+import zlib
 
 import httpx
 import numpy
 import pytest
 
-from .util import assert_status
+from .util import assert_status, container_exec
 
 
 @pytest.mark.asyncio
@@ -30,3 +31,90 @@ async def test_parallel_write(
             assert_status(response, httpx.codes.CREATED)
 
         await asyncio.gather(*map(run, range(32)))
+
+
+@pytest.mark.asyncio
+async def test_parallel_ranged_put(
+    nginx_server: str,
+    wlcg_create_header: dict[str, str],
+):
+    rng = numpy.random.Generator(numpy.random.PCG64(seed=42))
+    data = rng.bytes(8 * 1024 * 1024 + 123)
+    total = len(data)
+    chunk = 1024 * 1024
+    ranges = [(start, min(start + chunk, total) - 1) for start in range(0, total, chunk)]
+
+    async with httpx.AsyncClient(
+        base_url=nginx_server, headers=wlcg_create_header
+    ) as client:
+
+        async def put_range(first: int, last: int) -> httpx.Response:
+            return await client.put(
+                "/test_ranged.bin",
+                headers={
+                    "Content-Range": f"bytes {first}-{last}/{total}",
+                    "Want-Digest": "adler32",
+                },
+                content=data[first : last + 1],
+            )
+
+        # everything but the second range, as if the upload was interrupted
+        missing = ranges.pop(1)
+        responses = await asyncio.gather(*(put_range(*r) for r in ranges))
+        for response in responses:
+            assert_status(response, httpx.codes.ACCEPTED)
+
+        response = await client.get("/test_ranged.bin")
+        assert_status(response, httpx.codes.NOT_FOUND)
+
+        # resume: ask which ranges arrived, and send the rest
+        response = await client.put(
+            "/test_ranged.bin", headers={"Content-Range": f"bytes */{total}"}
+        )
+        assert_status(response, httpx.codes.ACCEPTED)
+        assert response.headers["Range"] == f"bytes=0-{chunk - 1},{2 * chunk}-{total - 1}"
+
+        response = await put_range(0, 10)
+        assert_status(response, httpx.codes.CONFLICT)
+
+        response = await put_range(*missing)
+        assert_status(response, httpx.codes.CREATED)
+        assert response.headers["Digest"] == f"adler32={zlib.adler32(data):08x}"
+
+        response = await client.get("/test_ranged.bin")
+        assert_status(response, httpx.codes.OK)
+        assert response.content == data
+
+
+def test_ranged_put_stale_partial(
+    nginx_server: str,
+    nginx_container: str,
+    wlcg_create_header: dict[str, str],
+):
+    # a longer .partial file left from an upload whose state is gone
+    container_exec(
+        nginx_container,
+        "dd",
+        "if=/dev/urandom",
+        "of=/var/www/webdav/.test_stale_partial.bin.partial",
+        "bs=64k",
+        "count=4",
+        user="nobody",
+    )
+    data = b"Hello, world!" * 100
+    total = len(data)
+    for first, last in ((600, total - 1), (0, 599)):
+        response = httpx.put(
+            f"{nginx_server}/test_stale_partial.bin",
+            headers={
+                **wlcg_create_header,
+                "Content-Range": f"bytes {first}-{last}/{total}",
+            },
+            content=data[first : last + 1],
+        )
+    assert_status(response, httpx.codes.CREATED)
+    assert response.headers["Digest"] == f"adler32={zlib.adler32(data):08x}"
+
+    response = httpx.get(f"{nginx_server}/test_stale_partial.bin", headers=wlcg_create_header)
+    assert_status(response, httpx.codes.OK)
+    assert response.content == data
@@ -0,0 +1,128 @@
+import zlib
+import xml.etree.ElementTree as ET
+
+import httpx
+import pytest
+
+from .util import assert_status
+
+DAV = "{DAV:}"
+NW = "{urn:nginx-webdav}"
+
+
+@pytest.fixture(scope="module")
+def listing(nginx_server: str, wlcg_create_header: dict[str, str]) -> dict[str, bytes]:
+    """A directory of 12 files and a subdirectory, more than propfind_max_entries (5)"""
+    files = {f"file_{i:02d}.txt": f"content {i}".encode() * i for i in range(12)}
+    # a name that needs escaping in a URL
+    files["sub dir/nested.txt"] = b"nested"
+    for name, data in files.items():
+        response = httpx.put(
+            f"{nginx_server}/propfind/{name}", headers=wlcg_create_header, content=data
+        )
+        assert_status(response, httpx.codes.CREATED)
+    return files
+
+
+def propfind(url: str, headers: dict[str, str]) -> tuple[httpx.Response, ET.Element]:
+    response = httpx.request("PROPFIND", url, headers=headers)
+    assert_status(response, httpx.codes.MULTI_STATUS)
+    return response, ET.fromstring(response.content)
+
+
+def props(response: ET.Element) -> dict[str, str]:
+    prop = response.find(f"{DAV}propstat/{DAV}prop")
+    assert prop is not None
+    # resourcetype has an element, e.g. collection, the others text
+    return {
+        child.tag: child.text or "".join(element.tag for element in child)
+        for child in prop
+    }
+
+
+def test_propfind_file(
+    nginx_server: str,
+    wlcg_read_header: dict[str, str],
+    listing: dict[str, bytes],
+):
+    url = f"{nginx_server}/propfind/file_03.txt"
+    _, root = propfind(url, {**wlcg_read_header, "Depth": "0"})
+    responses = root.findall(f"{DAV}response")
+    assert len(responses) == 1
+    assert responses[0].findtext(f"{DAV}href") == "/webdav/propfind/file_03.txt"
+    found = props(responses[0])
+    data = listing["file_03.txt"]
+    assert found[f"{DAV}getcontentlength"] == str(len(data))
+    assert found[f"{DAV}getlastmodified"].endswith(" GMT")
+    assert f"adler32={zlib.adler32(data):08x}" in found[
+        "{http://www.dcache.org/2013/webdav}Checksums"
+    ]
+
+    response = httpx.request("PROPFIND", url, headers={"Depth": "0"})
+    assert_status(response, httpx.codes.UNAUTHORIZED)
+
+    response = httpx.request(
+        "PROPFIND", f"{nginx_server}/propfind/missing.txt", headers=wlcg_read_header
+    )
+    assert_status(response, httpx.codes.FORBIDDEN)
+
+    response = httpx.request(
+        "PROPFIND",
+        f"{nginx_server}/propfind/missing.txt",
+        headers={**wlcg_read_header, "Depth": "0"},
+    )
+    assert_status(response, httpx.codes.NOT_FOUND)
+
+
+def test_propfind_directory(
+    nginx_server: str,
+    wlcg_read_header: dict[str, str],
+    listing: dict[str, bytes],
+):
+    url = f"{nginx_server}/propfind"
+    headers = {**wlcg_read_header, "Depth": "1"}
+    found: dict[str, dict[str, str]] = {}
+    pages = 0
+    while True:
+        _, root = propfind(url, headers)
+        pages += 1
+        continuation = None
+        for response in root.findall(f"{DAV}response"):
+            href = response.findtext(f"{DAV}href")
+            status = response.findtext(f"{DAV}status")
+            if status:
+                assert status == "HTTP/1.1 507 Insufficient Storage"
+                assert href == "/webdav/propfind/"
+                continuation = response.findtext(f"{NW}continuation")
+                continue
+            assert href not in found
+            found[href] = props(response)
+        if not continuation:
+            break
+        headers["Continuation"] = continuation
+
+    # the directory itself, 12 files and the subdirectory, 5 per page
+    assert pages == 3
+    assert len(found) == 14
+    assert found["/webdav/propfind"][f"{DAV}resourcetype"] == f"{DAV}collection"
+    # the request path is stored as sent, so the href leads back to the same name
+    subdir = found["/webdav/propfind/sub%20dir/"]
+    assert subdir[f"{DAV}displayname"] == "sub%20dir"
+    assert f"{DAV}getcontentlength" not in subdir
+    response = httpx.get(
+        httpx.URL(nginx_server).join("/webdav/propfind/sub%20dir/nested.txt"),
+        headers=wlcg_read_header,
+    )
+    assert_status(response, httpx.codes.OK)
+    assert response.content == listing["sub dir/nested.txt"]
+    for name, data in listing.items():
+        if "/" not in name:
+            entry = found[f"/webdav/propfind/{name}"]
+            assert entry[f"{DAV}getcontentlength"] == str(len(data))
+    # hidden files, e.g. uploads in progress, are not listed
+    assert not any(href.rsplit("/", 1)[-1].startswith(".") for href in found)
+
+    response = httpx.request(
+        "PROPFIND", url, headers={**wlcg_read_header, "Depth": "1", "Continuation": "x"}
+    )
+    assert_status(response, httpx.codes.BAD_REQUEST)
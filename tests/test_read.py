@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+
+import httpx
+import numpy
+import pytest
+
+from .util import assert_status
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture(scope="module")
+def read_files(
+    nginx_server: str, wlcg_create_header: dict[str, str]
+) -> dict[str, bytes]:
+    """Files on both sides of the default directio threshold (8m)"""
+    rng = numpy.random.Generator(numpy.random.PCG64(seed=42))
+    files = {
+        "read_small.bin": rng.bytes(64 * 1024),
+        "read_large.bin": rng.bytes(24 * 1024 * 1024),
+    }
+    for name, data in files.items():
+        response = httpx.put(
+            f"{nginx_server}/{name}", headers=wlcg_create_header, content=data
+        )
+        assert_status(response, httpx.codes.CREATED)
+    return files
+
+
+def test_read_whole(
+    nginx_server: str,
+    wlcg_read_header: dict[str, str],
+    read_files: dict[str, bytes],
+):
+    for name, data in read_files.items():
+        response = httpx.get(f"{nginx_server}/{name}", headers=wlcg_read_header)
+        assert_status(response, httpx.codes.OK)
+        assert response.content == data
+
+
+def test_read_range(
+    nginx_server: str,
+    wlcg_read_header: dict[str, str],
+    read_files: dict[str, bytes],
+):
+    data = read_files["read_large.bin"]
+    chunk = 1024 * 1024
+    with httpx.Client(headers=wlcg_read_header) as client:
+        for start in range(0, len(data), 5 * chunk):
+            headers = {"Range": f"bytes={start}-{start + chunk - 1}"}
+            response = client.get(f"{nginx_server}/read_large.bin", headers=headers)
+            assert_status(response, httpx.codes.PARTIAL_CONTENT)
+            assert response.content == data[start : start + chunk]
+
+    response = httpx.get(
+        f"{nginx_server}/read_large.bin",
+        headers={**wlcg_read_header, "Range": "bytes=-100"},
+    )
+    assert_status(response, httpx.codes.PARTIAL_CONTENT)
+    assert response.content == data[-100:]
+
+    response = httpx.get(
+        f"{nginx_server}/read_large.bin",
+        headers={"Range": "bytes=0-99"},
+    )
+    assert_status(response, httpx.codes.UNAUTHORIZED)
+
+
+@pytest.mark.asyncio
+async def test_read_worker_blocking(
+    nginx_server: str,
+    wlcg_read_header: dict[str, str],
+    read_files: dict[str, bytes],
+):
+    """Measure throughput and how long reads stall other requests
+
+    While several downloads run, a health check is sent every 10 ms; its
+    latency is the time the workers were busy with the downloads. The numbers
+    are logged for comparison between READ_* settings (see README.md).
+    """
+    health = nginx_server.removesuffix("webdav") + "webdav_health"
+
+    async with httpx.AsyncClient(headers=wlcg_read_header, timeout=60) as client:
+
+        async def download(name: str, headers: dict[str, str]) -> int:
+            response = await client.get(f"{nginx_server}/{name}", headers=headers)
+            assert response.status_code in (httpx.codes.OK, httpx.codes.PARTIAL_CONTENT)
+            return len(response.content)
+
+        async def probe(done: asyncio.Event) -> list[float]:
+            latencies = []
+            while not done.is_set():
+                start = time.monotonic()
+                response = await client.get(health)
+                assert_status(response, httpx.codes.OK)
+                latencies.append(time.monotonic() - start)
+                await asyncio.sleep(0.01)
+            return latencies
+
+        cases = {
+            "sendfile": ("read_small.bin", {}),
+            "directio": ("read_large.bin", {}),
+            "range": ("read_large.bin", {"Range": "bytes=1048576-9437183"}),
+        }
+        for mode, (name, headers) in cases.items():
+            done = asyncio.Event()
+            prober = asyncio.create_task(probe(done))
+            start = time.monotonic()
+            sizes = await asyncio.gather(*(download(name, headers) for _ in range(8)))
+            elapsed = time.monotonic() - start
+            done.set()
+            latencies = await prober
+            logger.info(
+                "read mode %s: %.1f MB/s, health check latency max %.1f ms (%d probes)",
+                mode,
+                sum(sizes) / elapsed / 1e6,
+                max(latencies, default=0.0) * 1e3,
+                len(latencies),
+            )
@@ -1,81 +1,13 @@
 import logging
 import time
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from threading import Thread
-from typing import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 
 import httpx
 import pytest
 
-from .util import assert_status
+from webdav_client import PerfMarker, TransferResult, WebDAVClient, parse_tpc_lines
 
-logger = logging.getLogger("RequestHandler")
-
-
-class RequestHandler(BaseHTTPRequestHandler):
-    def _auth(self):
-        if "Authorization" not in self.headers:
-            logger.info("No Authorization header")
-            self.send_response(httpx.codes.UNAUTHORIZED)
-            self.end_headers()
-            return False
-        if self.headers["Authorization"] != "Bearer opensesame":
-            logger.info("Invalid Authorization header")
-            self.send_response(httpx.codes.FORBIDDEN)
-            self.end_headers()
-            return False
-        return True
-
-    def do_GET(self):
-        if not self._auth():
-            return
-
-        if self.path == "/hello.txt":
-            code = httpx.codes.OK
-            data = b"Hello, world!"
-            nbytes = len(data)
-            self.send_response(code)
-            self.send_header("Content-type", "application/octet-stream")
-            self.send_header("Content-length", str(nbytes))
-            self.send_header("Digest", "adler32=205e048a")
-            self.end_headers()
-            self.wfile.write(data)
-        elif self.path.startswith("/bigdata.bin"):
-            code = httpx.codes.OK
-            nchunks = 10
-            chunk = b"Hello, world!" * 1000
-            nbytes = len(chunk) * nchunks
-            adler32 = 0x37F631F0
-            self.send_response(httpx.codes.OK)
-            self.send_header("Content-type", "application/octet-stream")
-            self.send_header("Content-length", str(nbytes))
-            if "adler32" in self.path:
-                self.send_header("Digest", f"adler32={adler32:08x}")
-            self.end_headers()
-            for _ in range(nchunks):
-                self.wfile.write(chunk)
-                if "slow" in self.path:
-                    self.wfile.flush()
-                    time.sleep(1)
-        else:
-            code = httpx.codes.NOT_FOUND
-            self.send_response(code)
-            self.end_headers()
-
-        logger.info(f"GET {self.path} {code}")
-
-
-@pytest.fixture(scope="module")
-def peer_server() -> Iterable[str]:
-    server_address = ("", 8081)
-    httpd = HTTPServer(server_address, RequestHandler)
-    thread = Thread(target=httpd.serve_forever)
-    thread.start()
-
-    yield "http://host.docker.internal:8081"
-
-    httpd.shutdown()
-    thread.join()
+from .util import assert_status
 
 
 def test_tpc_pull_nonexistent(
@@ -134,7 +66,7 @@ def test_tpc_pull(
 
 def test_tpc_pull_bigdata(
     nginx_server: str,
-    wlcg_create_header: dict[str, str],
+    wlcg_modify_header: dict[str, str],
     peer_server: str,
     caplog,
 ):
@@ -143,7 +75,7 @@ def test_tpc_pull_bigdata(
     src = f"{peer_server}/bigdata.bin"
     dst = f"{nginx_server}/bigdata_tpc_pull.bin"
 
-    headers = dict(wlcg_create_header)
+    headers = dict(wlcg_modify_header)
     headers["Source"] = src
     headers["TransferHeaderAuthorization"] = "Bearer opensesame"
 
@@ -166,14 +98,14 @@ def test_tpc_pull_bigdata(
     assert response.status_code == httpx.codes.ACCEPTED
     assert response.text.strip() == "success: Created"
 
-    response = httpx.get(dst, headers=wlcg_create_header)
+    response = httpx.get(dst, headers=wlcg_modify_header)
     assert_status(response, httpx.codes.OK)
     assert response.content == b"Hello, world!" * 10_000
 
 
 def test_tpc_pull_perfmarkers(
     nginx_server: str,
-    wlcg_create_header: dict[str, str],
+    wlcg_modify_header: dict[str, str],
     peer_server: str,
     caplog,
 ):
@@ -182,43 +114,172 @@ def test_tpc_pull_perfmarkers(
     src = f"{peer_server}/bigdata.bin.adler32.slow"
     dst = f"{nginx_server}/bigdata_tpc_pull.bin"
 
-    headers = dict(wlcg_create_header)
+    headers = dict(wlcg_modify_header)
     headers["Source"] = src
     headers["TransferHeaderAuthorization"] = "Bearer opensesame"
 
-    def read_permarker(lines: Iterator[str]):
-        data: dict[str, str] = {}
-        while True:
-            line = next(lines)
-            if line == "End":
-                yield data
-                break
-            if ": " not in line:
-                raise RuntimeError(f"Invalid line: {line}")
-            key, value = line.split(": ", 1)
-            data[key.lstrip()] = value
-
-    def read_response(lines: Iterator[str]):
-        while True:
-            line = next(lines)
-            if line == "Perf Marker":
-                yield from read_permarker(lines)
-            elif line == "success: Created":
-                yield {"success": "Created"}
-                break
-            else:
-                raise RuntimeError(f"Unexpected line: {line}")
-
     start = time.monotonic()
     markers = []
     with httpx.stream("COPY", dst, headers=headers, timeout=10) as response:
         assert response.status_code == httpx.codes.ACCEPTED
-        for data in read_response(response.iter_lines()):
-            if "Stripe Transfer Time" in data:
-                assert (
-                    float(data["Stripe Transfer Time"]) - (time.monotonic() - start)
-                    < 0.1
-                )
-            markers.append(data)
+        for event in parse_tpc_lines(response.iter_lines()):
+            if isinstance(event, PerfMarker):
+                assert event.stripe_transfer_time - (time.monotonic() - start) < 0.1
+            markers.append(event)
     assert len(markers) >= 2
-    assert "success" in markers[-1]
+    assert markers[-1] == TransferResult(True, "Created")
+
+
+@pytest.mark.asyncio
+async def test_tpc_pull_many(
+    nginx_server: str,
+    wlcg_modify_header: dict[str, str],
+    peer_server: str,
+):
+    async with WebDAVClient(nginx_server, headers=wlcg_modify_header) as client:
+        events: dict[str, list] = {}
+        async for path, event in client.tpc_pull_many(
+            [
+                ("/tpc_pull_many_0.bin", f"{peer_server}/bigdata.bin.adler32.slow"),
+                ("/tpc_pull_many_1.bin", f"{peer_server}/bigdata.bin.adler32.slow"),
+                ("/tpc_pull_many_2.bin", f"{peer_server}/nonexistent.bin"),
+            ],
+            transfer_headers={"Authorization": "Bearer opensesame"},
+        ):
+            events.setdefault(path, []).append(event)
+
+    for i in range(2):
+        *markers, result = events[f"/tpc_pull_many_{i}.bin"]
+        assert result == TransferResult(True, "Created")
+        assert markers and all(isinstance(m, PerfMarker) for m in markers)
+    result = events["/tpc_pull_many_2.bin"][-1]
+    assert isinstance(result, TransferResult) and not result.success
+
+
+def test_tpc_pull_queued(
+    nginx_server: str,
+    wlcg_modify_header: dict[str, str],
+    peer_server: str,
+    caplog,
+):
+    caplog.set_level(logging.INFO)
+
+    headers = dict(wlcg_modify_header)
+    headers["Source"] = f"{peer_server}/bigdata.bin.adler32.slow"
+    headers["TransferHeaderAuthorization"] = "Bearer opensesame"
+
+    def pull(i: int) -> list[str]:
+        dst = f"{nginx_server}/bigdata_tpc_pull_queued_{i}.bin"
+        response = httpx.request("COPY", dst, headers=headers, timeout=60)
+        assert response.status_code == httpx.codes.ACCEPTED
+        return response.text.splitlines()
+
+    # tpc_max_active_per_host is 2 in conftest.py, so one of them waits
+    with ThreadPoolExecutor(3) as executor:
+        results = list(executor.map(pull, range(3)))
+    for lines in results:
+        assert lines[-1] == "success: Created"
+    queued = [lines for lines in results if "    State: Queued" in lines]
+    assert len(queued) == 1
+    lines = queued[0]
+    assert lines.index("    State: Queued") < lines.index("    State: Running")
+    assert "    Stripe Status: QUEUED" in lines
+
+
+def test_tpc_pull_queued_abandoned(
+    nginx_server: str,
+    wlcg_modify_header: dict[str, str],
+    peer_server: str,
+    caplog,
+):
+    caplog.set_level(logging.INFO)
+
+    headers = dict(wlcg_modify_header)
+    headers["TransferHeaderAuthorization"] = "Bearer opensesame"
+
+    def pull(i: int) -> list[str]:
+        dst = f"{nginx_server}/bigdata_tpc_pull_abandoned_{i}.bin"
+        source = {"Source": f"{peer_server}/bigdata.bin.adler32.slow"}
+        response = httpx.request("COPY", dst, headers={**headers, **source}, timeout=60)
+        assert response.status_code == httpx.codes.ACCEPTED
+        return response.text.splitlines()
+
+    with ThreadPoolExecutor(2) as executor:
+        running = [executor.submit(pull, i) for i in range(2)]
+        time.sleep(1)
+        # tpc_max_active_per_host is 2 in conftest.py, so this one waits,
+        # and its client goes away once it is told so
+        headers["Source"] = f"{peer_server}/bigdata.bin.adler32.slow?abandoned"
+        dst = f"{nginx_server}/bigdata_tpc_pull_abandoned.bin"
+        with httpx.stream("COPY", dst, headers=headers, timeout=60) as response:
+            assert response.status_code == httpx.codes.ACCEPTED
+            for line in response.iter_lines():
+                if line == "    State: Queued":
+                    break
+        for future in running:
+            assert future.result()[-1] == "success: Created"
+
+    # the abandoned waiter left the queue instead of taking a freed slot
+    time.sleep(3)
+    assert not [r for r in caplog.records if "abandoned" in r.getMessage()]
+    response = httpx.head(dst, headers=wlcg_modify_header)
+    assert_status(response, httpx.codes.NOT_FOUND)
+
+
+def test_tpc_pull_striped(
+    nginx_server: str,
+    wlcg_create_header: dict[str, str],
+    peer_server: str,
+    caplog,
+):
+    caplog.set_level(logging.INFO)
+
+    src = f"{peer_server}/bigdata.bin.adler32.ranges.slow"
+    dst = f"{nginx_server}/bigdata_tpc_pull_striped.bin"
+
+    headers = dict(wlcg_create_header)
+    headers["Source"] = src
+    headers["TransferHeaderAuthorization"] = "Bearer opensesame"
+
+    response = httpx.request("COPY", dst, headers=headers, timeout=10)
+    assert response.status_code == httpx.codes.ACCEPTED
+    lines = response.text.splitlines()
+    assert lines[-1] == "success: Created"
+    # see tpc_stripes in conftest.py
+    assert "    Total Stripe Count: 4" in lines
+    assert "    Stripe Index: 3" in lines
+
+    response = httpx.get(dst, headers=wlcg_create_header)
+    assert_status(response, httpx.codes.OK)
+    assert response.content == b"Hello, world!" * 10_000
+
+
+def test_tpc_push(
+    nginx_server: str,
+    wlcg_create_header: dict[str, str],
+    peer_server: str,
+    peer_uploads: dict[str, bytes],
+    caplog,
+):
+    caplog.set_level(logging.INFO)
+
+    src = f"{nginx_server}/tpc_push.bin"
+    data = b"Hello, world!" * 10_000
+    response = httpx.put(src, headers=wlcg_create_header, content=data)
+    assert_status(response, httpx.codes.CREATED)
+
+    headers = dict(wlcg_create_header)
+    headers["Destination"] = f"{peer_server}/tpc_push.bin"
+    response = httpx.request("COPY", src, headers=headers)
+    assert_status(response, httpx.codes.ACCEPTED)
+    assert response.text.strip() == "failure: rejected PUT: 401 Unauthorized"
+
+    headers["TransferHeaderAuthorization"] = "Bearer opensesame"
+    response = httpx.request("COPY", src, headers=headers)
+    assert_status(response, httpx.codes.ACCEPTED)
+    assert response.text.splitlines()[-1] == "success: Created"
+    assert peer_uploads["/tpc_push.bin"] == data
+
+    headers["Destination"] = f"{peer_server}/tpc_push_missing.bin"
+    response = httpx.request("COPY", f"{nginx_server}/missing.bin", headers=headers)
+    assert_status(response, httpx.codes.NOT_FOUND)
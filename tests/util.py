@@ -1,7 +1,42 @@
+import subprocess
+from dataclasses import dataclass
+
 import httpx
 
 
+@dataclass
+class NginxServer:
+    """A server started by the start_nginx_server fixture"""
+
+    url: str
+    container_id: str
+    # the config.json it runs with
+    config: dict
+
+
 def assert_status(response: httpx.Response, status_code: httpx.codes):
     assert response.status_code == status_code, (
         f"{response.status_code} != {status_code}\nText: {response.text}"
-    )
\ No newline at end of file
+    )
+
+
+def container_exec(container_id: str, *command: str, user: str = "root") -> str:
+    """Run a command in the test server's container, returning its output
+
+    The server runs as nobody, so files it should be able to remove must be
+    made with user="nobody".
+    """
+    return subprocess.check_output(
+        ["podman", "exec", "--user", user, container_id, *command], text=True
+    )
+
+
+def get_xattrs(container_id: str, path: str) -> dict[str, str]:
+    """The user.* extended attributes of a file in the container"""
+    output = container_exec(container_id, "getfattr", "--dump", "--absolute-names", path)
+    xattrs = {}
+    for line in output.splitlines():
+        name, sep, value = line.partition("=")
+        if sep:
+            xattrs[name] = value.strip('"')
+    return xattrs
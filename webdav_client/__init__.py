@@ -0,0 +1,27 @@
+"""Python client for bulk transfers with nginx-webdav
+
+See WebDAVClient, and the README for an example.
+"""
+
+from .client import FileTransfer, TransferError, WebDAVClient, parse_adler32
+from .tpc import (
+    PerfMarker,
+    TPCEvent,
+    TPCResponseParser,
+    TransferResult,
+    aparse_tpc_lines,
+    parse_tpc_lines,
+)
+
+__all__ = [
+    "FileTransfer",
+    "PerfMarker",
+    "TPCEvent",
+    "TPCResponseParser",
+    "TransferError",
+    "TransferResult",
+    "WebDAVClient",
+    "aparse_tpc_lines",
+    "parse_adler32",
+    "parse_tpc_lines",
+]
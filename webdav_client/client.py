@@ -0,0 +1,302 @@
+"""Asynchronous bulk transfers to and from nginx-webdav"""
+
+import asyncio
+import os
+import time
+import zlib
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Optional, TypeVar, Union
+
+import httpx
+
+from .tpc import TPCEvent, TransferResult, aparse_tpc_lines
+
+# Size of the chunks files are read and written in
+CHUNK_SIZE = 1024 * 1024
+
+Item = TypeVar("Item")
+Result = TypeVar("Result")
+
+
+class TransferError(Exception):
+    """A transfer failed, including when its checksums did not match"""
+
+
+@dataclass
+class FileTransfer:
+    """The outcome of one upload or download of a bulk transfer"""
+
+    remote_path: str
+    local_path: str
+    bytes: int = 0
+    # as sent by the server, e.g. "0b2c04e1"
+    adler32: Optional[str] = None
+    seconds: float = 0.0
+    # None if the transfer succeeded
+    error: Optional[str] = None
+
+
+def parse_adler32(digest: Optional[str]) -> Optional[str]:
+    """The adler32 value of an RFC 3230 Digest header, None if it has none"""
+    for item in (digest or "").split(","):
+        name, sep, value = item.strip().partition("=")
+        if sep and name.lower() == "adler32":
+            return value.lower()
+    return None
+
+
+class WebDAVClient:
+    """A pool of connections to one nginx-webdav server
+
+    Use it as an async context manager. Paths are relative to base_url, and
+    headers (e.g. the Authorization with a token) are sent with every request.
+    Each of the bulk methods runs at most `concurrency` transfers at once, each
+    on its own pooled connection, and yields their outcomes as they finish, so
+    that the items can come from a generator of any length.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        headers: Optional[dict[str, str]] = None,
+        concurrency: int = 16,
+        timeout: float = 60.0,
+    ):
+        self.concurrency = concurrency
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(
+                max_connections=concurrency, max_keepalive_connections=concurrency
+            ),
+        )
+
+    async def __aenter__(self) -> "WebDAVClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def upload(self, remote_path: str, local_path: Union[str, os.PathLike]) -> FileTransfer:
+        """PUT a local file, raising TransferError if it fails
+
+        The adler32 of the data is computed while it is sent and compared with
+        the one the server computed (the Digest header of the response).
+        """
+        start = time.monotonic()
+        size = os.path.getsize(local_path)
+        adler32 = 1
+        sent = 0
+
+        async def body():
+            nonlocal adler32, sent
+            with open(local_path, "rb") as f:
+                while chunk := await asyncio.to_thread(f.read, CHUNK_SIZE):
+                    adler32 = zlib.adler32(chunk, adler32)
+                    sent += len(chunk)
+                    yield chunk
+
+        response = await self.client.put(
+            remote_path,
+            headers={"Content-Length": str(size), "Want-Digest": "adler32"},
+            content=body(),
+        )
+        if response.status_code not in (httpx.codes.CREATED, httpx.codes.NO_CONTENT):
+            raise TransferError(
+                f"PUT {remote_path}: {response.status_code} {response.text.strip()}"
+            )
+        if sent != size:
+            raise TransferError(f"{local_path} changed size while it was uploaded")
+        local = f"{adler32:08x}"
+        remote = parse_adler32(response.headers.get("Digest"))
+        if remote != local:
+            raise TransferError(
+                f"PUT {remote_path}: adler32 mismatch: local {local} remote {remote}"
+            )
+        return FileTransfer(
+            remote_path, os.fspath(local_path), sent, remote, time.monotonic() - start
+        )
+
+    async def download(self, remote_path: str, local_path: Union[str, os.PathLike]) -> FileTransfer:
+        """GET a file into a local file, raising TransferError if it fails
+
+        The adler32 of the data is computed while it is received and compared
+        with the Digest header of the response, or if it has none, with the
+        one from a HEAD with Want-Digest. On failure the local file is removed.
+        """
+        start = time.monotonic()
+        adler32 = 1
+        received = 0
+        try:
+            with open(local_path, "wb") as f:
+                async with self.client.stream("GET", remote_path) as response:
+                    if response.status_code != httpx.codes.OK:
+                        await response.aread()
+                        raise TransferError(
+                            f"GET {remote_path}: {response.status_code} {response.text.strip()}"
+                        )
+                    digest = response.headers.get("Digest")
+                    async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                        adler32 = zlib.adler32(chunk, adler32)
+                        received += len(chunk)
+                        await asyncio.to_thread(f.write, chunk)
+            remote = parse_adler32(digest)
+            if remote is None:
+                response = await self.client.head(
+                    remote_path, headers={"Want-Digest": "adler32"}
+                )
+                remote = parse_adler32(response.headers.get("Digest"))
+            local = f"{adler32:08x}"
+            if remote != local:
+                raise TransferError(
+                    f"GET {remote_path}: adler32 mismatch: local {local} remote {remote}"
+                )
+        except BaseException:
+            try:
+                os.remove(local_path)
+            except FileNotFoundError:
+                pass
+            raise
+        return FileTransfer(
+            remote_path, os.fspath(local_path), received, remote, time.monotonic() - start
+        )
+
+    async def tpc_pull(
+        self,
+        remote_path: str,
+        source: str,
+        transfer_headers: Optional[dict[str, str]] = None,
+    ) -> AsyncIterator[TPCEvent]:
+        """Copy the URL source to remote_path, yielding the progress as it is reported
+
+        transfer_headers are passed to the source, e.g. {"Authorization": ...}
+        is sent as TransferHeaderAuthorization. The last event is a TransferResult.
+        """
+        async for event in self._tpc(remote_path, "Source", source, transfer_headers):
+            yield event
+
+    async def tpc_push(
+        self,
+        remote_path: str,
+        destination: str,
+        transfer_headers: Optional[dict[str, str]] = None,
+    ) -> AsyncIterator[TPCEvent]:
+        """Copy remote_path to the URL destination, like tpc_pull"""
+        async for event in self._tpc(remote_path, "Destination", destination, transfer_headers):
+            yield event
+
+    async def _tpc(
+        self,
+        remote_path: str,
+        header: str,
+        url: str,
+        transfer_headers: Optional[dict[str, str]],
+    ) -> AsyncIterator[TPCEvent]:
+        headers = {header: url}
+        for name, value in (transfer_headers or {}).items():
+            headers["TransferHeader" + name] = value
+        # the timeout applies to each line, which come every performance_marker_timeout
+        async with self.client.stream("COPY", remote_path, headers=headers) as response:
+            if response.status_code != httpx.codes.ACCEPTED:
+                await response.aread()
+                yield TransferResult(
+                    False, f"{response.status_code} {response.text.strip()}"
+                )
+                return
+            async for event in aparse_tpc_lines(response.aiter_lines()):
+                yield event
+
+    async def upload_many(
+        self, items: Iterable[tuple[str, Union[str, os.PathLike]]]
+    ) -> AsyncIterator[FileTransfer]:
+        """Upload (remote_path, local_path) pairs, yielding each outcome as it finishes
+
+        A failed upload does not stop the others. Its FileTransfer has the error.
+        """
+
+        async def run(item: tuple[str, Union[str, os.PathLike]]) -> FileTransfer:
+            remote_path, local_path = item
+            try:
+                return await self.upload(remote_path, local_path)
+            except (TransferError, httpx.HTTPError, OSError) as e:
+                return FileTransfer(remote_path, os.fspath(local_path), error=str(e))
+
+        async for result in self._bounded(items, run):
+            yield result
+
+    async def download_many(
+        self, items: Iterable[tuple[str, Union[str, os.PathLike]]]
+    ) -> AsyncIterator[FileTransfer]:
+        """Download (remote_path, local_path) pairs, like upload_many"""
+
+        async def run(item: tuple[str, Union[str, os.PathLike]]) -> FileTransfer:
+            remote_path, local_path = item
+            try:
+                return await self.download(remote_path, local_path)
+            except (TransferError, httpx.HTTPError, OSError) as e:
+                return FileTransfer(remote_path, os.fspath(local_path), error=str(e))
+
+        async for result in self._bounded(items, run):
+            yield result
+
+    async def tpc_pull_many(
+        self,
+        items: Iterable[tuple[str, str]],
+        transfer_headers: Optional[dict[str, str]] = None,
+    ) -> AsyncIterator[tuple[str, TPCEvent]]:
+        """Pull (remote_path, source) pairs, yielding (remote_path, event) as the events arrive
+
+        Every transfer ends with a TransferResult, also when the request itself failed.
+        """
+        queue: asyncio.Queue[Optional[tuple[str, TPCEvent]]] = asyncio.Queue()
+
+        async def run(item: tuple[str, str]) -> None:
+            remote_path, source = item
+            try:
+                async for event in self.tpc_pull(remote_path, source, transfer_headers):
+                    await queue.put((remote_path, event))
+            except (httpx.HTTPError, ValueError) as e:
+                await queue.put((remote_path, TransferResult(False, str(e))))
+
+        async def run_all() -> None:
+            try:
+                async for _ in self._bounded(items, run):
+                    pass
+            finally:
+                queue.put_nowait(None)
+
+        task = asyncio.ensure_future(run_all())
+        try:
+            while (entry := await queue.get()) is not None:
+                yield entry
+            # raises what went wrong besides the transfers
+            await task
+        finally:
+            task.cancel()
+
+    async def _bounded(
+        self, items: Iterable[Item], run: Callable[[Item], Awaitable[Result]]
+    ) -> AsyncIterator[Result]:
+        """Run run(item) for the items, at most self.concurrency at once, yielding the results as they finish"""
+        iterator = iter(items)
+        running: set[asyncio.Future] = set()
+        try:
+            while True:
+                for item in iterator:
+                    running.add(asyncio.ensure_future(run(item)))
+                    if len(running) >= self.concurrency:
+                        break
+                if not running:
+                    return
+                done, running = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in running:
+                future.cancel()
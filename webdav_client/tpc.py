@@ -0,0 +1,140 @@
+"""Events in the response body of a third-party copy (COPY with Source or Destination)
+
+The server answers 202 Accepted right away and then streams the progress as
+plain text lines: a performance marker every few seconds, and a last line
+starting with "success:" or "failure:". For example::
+
+    Perf Marker
+        Timestamp: 1700000000
+        State: Running
+        ...
+        Total Stripe Count: 1
+    End
+    success: Created
+"""
+
+from dataclasses import dataclass, field
+from typing import AsyncIterable, Iterable, Iterator, Optional, Union
+
+
+@dataclass
+class PerfMarker:
+    """The progress of one stripe of a transfer"""
+
+    timestamp: int
+    state: str
+    description: str
+    stripe_index: int
+    stripe_start_time: int
+    stripe_last_transferred: int
+    stripe_transfer_time: int
+    stripe_bytes_transferred: int
+    stripe_status: str
+    total_stripe_count: int
+    # every "key: value" line of the marker, including ones not known here
+    fields: dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def from_fields(cls, fields: dict[str, str]) -> "PerfMarker":
+        def number(key: str) -> int:
+            try:
+                return int(float(fields.get(key, "0")))
+            except ValueError:
+                return 0
+
+        return cls(
+            timestamp=number("Timestamp"),
+            state=fields.get("State", ""),
+            description=fields.get("State description", ""),
+            stripe_index=number("Stripe Index"),
+            stripe_start_time=number("Stripe Start Time"),
+            stripe_last_transferred=number("Stripe Last Transferred"),
+            stripe_transfer_time=number("Stripe Transfer Time"),
+            stripe_bytes_transferred=number("Stripe Bytes Transferred"),
+            stripe_status=fields.get("Stripe Status", ""),
+            total_stripe_count=number("Total Stripe Count"),
+            fields=fields,
+        )
+
+
+@dataclass
+class TransferResult:
+    """The outcome of a transfer, the last event of its response"""
+
+    success: bool
+    # e.g. "Created", or the reason of the failure
+    message: str
+
+
+TPCEvent = Union[PerfMarker, TransferResult]
+
+
+class TPCResponseParser:
+    """Turns the lines of a third-party copy response into events, one line at a time
+
+    Lines that are not part of a marker and do not start with "success:" or
+    "failure:" end the transfer as a failure with that line as the message,
+    since the server sends such lines only for errors (e.g. "no source provided").
+    """
+
+    def __init__(self) -> None:
+        self._marker: Optional[dict[str, str]] = None
+        self.result: Optional[TransferResult] = None
+
+    def feed(self, line: str) -> Optional[TPCEvent]:
+        """Parse the next line, returning the event it completes if any"""
+        line = line.rstrip("\r\n")
+        if self.result is not None:
+            # nothing is expected after the result
+            return None
+        if self._marker is not None:
+            if line == "End":
+                marker = PerfMarker.from_fields(self._marker)
+                self._marker = None
+                return marker
+            key, sep, value = line.partition(":")
+            if not sep:
+                raise ValueError(f"invalid performance marker line: {line!r}")
+            self._marker[key.strip()] = value.strip()
+            return None
+        if line == "Perf Marker":
+            self._marker = {}
+            return None
+        if not line.strip():
+            return None
+        status, sep, message = line.partition(":")
+        if sep and status in ("success", "failure"):
+            self.result = TransferResult(status == "success", message.strip())
+        else:
+            self.result = TransferResult(False, line.strip())
+        return self.result
+
+    def close(self) -> TransferResult:
+        """The result of the transfer, a failure if the response ended without one"""
+        if self.result is None:
+            self.result = TransferResult(False, "response ended without a result")
+        return self.result
+
+
+def parse_tpc_lines(lines: Iterable[str]) -> Iterator[TPCEvent]:
+    """Parse the lines of a complete response into events, ending with a TransferResult"""
+    parser = TPCResponseParser()
+    for line in lines:
+        event = parser.feed(line)
+        if event is not None:
+            yield event
+        if parser.result is not None:
+            return
+    yield parser.close()
+
+
+async def aparse_tpc_lines(lines: AsyncIterable[str]):
+    """Parse the lines of a streamed response into events as they arrive"""
+    parser = TPCResponseParser()
+    async for line in lines:
+        event = parser.feed(line)
+        if event is not None:
+            yield event
+        if parser.result is not None:
+            return
+    yield parser.close()